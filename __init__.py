@@ -27,7 +27,16 @@ def nostrmarket_renderer():
 nostr_client: NostrClient = NostrClient()
 
 
-from .tasks import wait_for_nostr_events, wait_for_paid_invoices  # noqa
+from .jobs import stop_jobs  # noqa
+from .tasks import (  # noqa
+    archive_periodically,
+    expire_orders_periodically,
+    resume_jobs,
+    wait_for_merchant_notifications,
+    wait_for_nostr_events,
+    wait_for_outbox_events,
+    wait_for_paid_invoices,
+)
 from .views import *  # noqa
 from .views_api import *  # noqa
 
@@ -41,6 +50,7 @@ async def nostrmarket_stop():
         except Exception as ex:
             logger.warning(ex)
 
+    stop_jobs()
     await nostr_client.stop()
 
 
@@ -62,7 +72,47 @@ def nostrmarket_start():
     task2 = create_permanent_unique_task(
         "ext_nostrmarket_subscribe_to_nostr_client", _subscribe_to_nostr_client
     )
+
+    async def _wait_for_outbox_events():
+        # wait for this extension to initialize
+        await asyncio.sleep(15)
+        await wait_for_outbox_events(nostr_client)
+
     task3 = create_permanent_unique_task(
         "ext_nostrmarket_wait_for_events", _wait_for_nostr_events
     )
-    scheduled_tasks.extend([task1, task2, task3])
+    task4 = create_permanent_unique_task(
+        "ext_nostrmarket_send_outbox_events", _wait_for_outbox_events
+    )
+    task5 = create_permanent_unique_task(
+        "ext_nostrmarket_monitor_subscriptions", nostr_client.monitor_subscriptions
+    )
+    task6 = create_permanent_unique_task(
+        "ext_nostrmarket_merchant_notifications", wait_for_merchant_notifications
+    )
+
+    async def _resume_jobs():
+        # wait for this extension to initialize
+        await asyncio.sleep(20)
+        await resume_jobs()
+
+    task7 = create_permanent_unique_task("ext_nostrmarket_resume_jobs", _resume_jobs)
+
+    async def _expire_orders():
+        # wait for this extension to initialize
+        await asyncio.sleep(30)
+        await expire_orders_periodically()
+
+    task8 = create_permanent_unique_task(
+        "ext_nostrmarket_expire_orders", _expire_orders
+    )
+
+    async def _archive():
+        # wait for this extension to initialize
+        await asyncio.sleep(60)
+        await archive_periodically()
+
+    task9 = create_permanent_unique_task("ext_nostrmarket_archive", _archive)
+    scheduled_tasks.extend(
+        [task1, task2, task3, task4, task5, task6, task7, task8, task9]
+    )
@@ -0,0 +1,150 @@
+import copy
+from collections import OrderedDict
+from typing import Any
+
+from pydantic import BaseModel
+
+
+class LRUCache:
+    """
+    Small in-memory cache. The least recently used entries are evicted
+    once more than `maxsize` entries are stored.
+    """
+
+    def __init__(self, maxsize: int = 1_000):
+        self.maxsize = maxsize
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, key, default: Any = None) -> Any:
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def set(self, key, value: Any):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default: Any = None) -> Any:
+        return self.entries.pop(key, default)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class CatalogCache:
+    """
+    Parsed stalls, products and zones, per merchant.
+
+    Entries are keyed by the crud query (eg: ("stall", stall_id)). All the
+    entries of a merchant are dropped by every catalog crud mutator
+    (write-through invalidation). Merchants are evicted least recently used
+    first, when there are too many or when the (estimated) size of the cached
+    objects goes over `max_bytes`. Reads return the cached objects themselves:
+    callers that change them must change a copy.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        max_merchants: int = 100,
+        max_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.enabled = enabled
+        self.max_merchants = max_merchants
+        self.max_bytes = max_bytes
+        # merchant_id -> {query key: value}
+        self.merchants: OrderedDict = OrderedDict()
+        # merchant_id -> estimated size of the cached values, in bytes
+        self.merchant_sizes: dict[str, int] = {}
+        # merchant_id -> incremented on every invalidation
+        self.generations: dict[str, int] = {}
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, merchant_id: str, key: tuple) -> tuple[bool, Any]:
+        """Returns (found, value). The value can be `None` (nothing in the db)."""
+        entries = self.merchants.get(merchant_id) if self.enabled else None
+        if entries is None or key not in entries:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.merchants.move_to_end(merchant_id)
+        return True, entries[key]
+
+    def generation(self, merchant_id: str) -> int:
+        """Must be taken before reading the value from the database."""
+        return self.generations.get(merchant_id, 0)
+
+    def set(self, merchant_id: str, key: tuple, value: Any, generation: int):
+        if not self.enabled:
+            return
+        if generation != self.generation(merchant_id):
+            # invalidated while the value was being read, it might be stale
+            return
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            return
+        entries = self.merchants.setdefault(merchant_id, {})
+        self.merchants.move_to_end(merchant_id)
+        if key in entries:
+            # replaced, its size is counted again below
+            size -= _estimate_size(entries[key])
+        # the caller keeps (and might change) the value it just read
+        entries[key] = copy.deepcopy(value)
+        self.merchant_sizes[merchant_id] = (
+            self.merchant_sizes.get(merchant_id, 0) + size
+        )
+        self.size_bytes += size
+
+        while len(self.merchants) > self.max_merchants or (
+            self.size_bytes > self.max_bytes and len(self.merchants) > 1
+        ):
+            oldest_merchant_id = next(iter(self.merchants))
+            self.merchants.pop(oldest_merchant_id)
+            self.size_bytes -= self.merchant_sizes.pop(oldest_merchant_id, 0)
+
+    def invalidate(self, merchant_id: str):
+        self.generations[merchant_id] = self.generation(merchant_id) + 1
+        self.merchants.pop(merchant_id, None)
+        self.size_bytes -= self.merchant_sizes.pop(merchant_id, 0)
+
+    def clear(self):
+        self.merchants.clear()
+        self.merchant_sizes.clear()
+        self.size_bytes = 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "merchants": len(self.merchants),
+            "size_bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _estimate_size(value: Any) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, (list, tuple)):
+        return sum(_estimate_size(v) for v in value)
+    if isinstance(value, BaseModel):
+        return len(value.json())
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return len(str(value))
+
+
+# set `enabled=False` to always read the catalog from the database
+catalog_cache = CatalogCache(enabled=True)
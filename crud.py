@@ -1,12 +1,23 @@
+import base64
 import json
+import time
+import zlib
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager
 
+from lnbits.db import Connection
 from lnbits.helpers import urlsafe_short_hash
+from pydantic import BaseModel
 
 from . import db
+from .cache import LRUCache, catalog_cache
 from .models import (
     Customer,
     CustomerProfile,
     DirectMessage,
+    DirectMessageType,
+    Job,
+    JobStatus,
     Merchant,
     MerchantConfig,
     Order,
@@ -16,6 +27,83 @@ from .models import (
     Stall,
     Zone,
 )
+from .nostr.event import NostrEvent
+from .nostr.send_queue import frame_priority
+
+
+class _DeferredCommit:
+    """
+    Wraps the sqlalchemy connection of a lnbits `Connection`: the commit done
+    by each crud statement is skipped, the unit of work commits once at the end.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def commit(self):
+        pass
+
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+
+
+# id of the connection of an open unit of work -> called once it is committed
+_after_commit_callbacks: dict[int, list[Callable[[], None]]] = {}
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[Connection]:
+    """
+    Run several crud calls in a single database transaction.
+    The database lock is held until the commit and is not reentrant: the
+    yielded connection must be passed to every crud call inside the block, and
+    slow work (signing, network calls) must be done before or after it.
+    """
+    callbacks: list[Callable[[], None]] = []
+    async with db.connect() as conn:
+        sa_conn = conn.conn
+        conn.conn = _DeferredCommit(sa_conn)
+        _after_commit_callbacks[id(conn)] = callbacks
+        try:
+            yield conn
+            await sa_conn.commit()
+        except Exception:
+            await sa_conn.rollback()
+            raise
+        finally:
+            conn.conn = sa_conn
+            _after_commit_callbacks.pop(id(conn), None)
+        # still holding the database lock: no other reader has seen the new rows
+        for callback in callbacks:
+            callback()
+
+
+def run_after_commit(callback: Callable[[], None], conn: Connection | None = None):
+    """Call now or, inside a unit of work, once the transaction is committed."""
+    callbacks = _after_commit_callbacks.get(id(conn)) if conn else None
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+def _invalidate(callback: Callable[[], None], conn: Connection | None = None):
+    """Drop cached data now and, inside a transaction, again after the commit."""
+    callback()
+    if conn and id(conn) in _after_commit_callbacks:
+        # until the commit, readers can still get (and cache) the old rows
+        run_after_commit(callback, conn)
+
+
+def _invalidate_catalog(merchant_id: str, conn: Connection | None = None):
+    _invalidate(lambda: catalog_cache.invalidate(merchant_id), conn)
+
+
+# an event must not overwrite the row of a more recent event
+_OLDER_EVENT_CONDITION = """
+    AND (event_created_at IS NULL OR event_created_at < :event_created_at)
+"""
+
 
 ######################################## MERCHANT ######################################
 
@@ -86,6 +174,15 @@ async def get_merchant_by_pubkey(public_key: str) -> Merchant | None:
     return Merchant.from_row(row) if row else None
 
 
+async def get_merchant_by_id(merchant_id: str) -> Merchant | None:
+    row: dict = await db.fetchone(
+        """SELECT * FROM nostrmarket.merchants WHERE id = :id""",
+        {"id": merchant_id},
+    )
+
+    return Merchant.from_row(row) if row else None
+
+
 async def get_merchants_ids_with_pubkeys() -> list[tuple[str, str]]:
     rows: list[dict] = await db.fetchall(
         """SELECT id, public_key FROM nostrmarket.merchants""",
@@ -103,8 +200,8 @@ async def get_merchant_for_user(user_id: str) -> Merchant | None:
     return Merchant.from_row(row) if row else None
 
 
-async def delete_merchant(merchant_id: str) -> None:
-    await db.execute(
+async def delete_merchant(merchant_id: str, conn: Connection | None = None) -> None:
+    await (conn or db).execute(
         "DELETE FROM nostrmarket.merchants WHERE id = :id",
         {
             "id": merchant_id,
@@ -112,6 +209,34 @@ async def delete_merchant(merchant_id: str) -> None:
     )
 
 
+async def count_merchant_rows(table: str, merchant_id: str) -> int:
+    row: dict = await db.fetchone(
+        f"""
+        SELECT COUNT(*) AS count FROM nostrmarket.{table}
+        WHERE merchant_id = :merchant_id
+        """,
+        {"merchant_id": merchant_id},
+    )
+    return row["count"] if row else 0
+
+
+async def delete_merchant_rows(table: str, merchant_id: str, limit: int) -> int:
+    """
+    Delete (at most `limit`) rows of a merchant from a table with an `id` key.
+    Returns the number of deleted rows. Used to delete large tables in chunks.
+    """
+    rows: list[dict] = await db.fetchall(
+        f"""
+        SELECT id FROM nostrmarket.{table}
+        WHERE merchant_id = :merchant_id LIMIT :limit
+        """,
+        {"merchant_id": merchant_id, "limit": limit},
+    )
+    await _delete_rows(db, table, [row["id"] for row in rows])
+    _invalidate_catalog(merchant_id)
+    return len(rows)
+
+
 ######################################## ZONES ########################################
 
 
@@ -131,6 +256,7 @@ async def create_zone(merchant_id: str, data: Zone) -> Zone:
             "regions": json.dumps(data.countries),
         },
     )
+    _invalidate_catalog(merchant_id)
 
     zone = await get_zone(merchant_id, zone_id)
     assert zone, "Newly created zone couldn't be retrieved"
@@ -152,11 +278,18 @@ async def update_zone(merchant_id: str, z: Zone) -> Zone | None:
             "merchant_id": merchant_id,
         },
     )
+    _invalidate_catalog(merchant_id)
     assert z.id
     return await get_zone(merchant_id, z.id)
 
 
 async def get_zone(merchant_id: str, zone_id: str) -> Zone | None:
+    key = ("zone", zone_id)
+    found, zone = catalog_cache.get(merchant_id, key)
+    if found:
+        return zone
+    generation = catalog_cache.generation(merchant_id)
+
     row: dict = await db.fetchone(
         "SELECT * FROM nostrmarket.zones WHERE merchant_id = :merchant_id AND id = :id",
         {
@@ -164,15 +297,25 @@ async def get_zone(merchant_id: str, zone_id: str) -> Zone | None:
             "id": zone_id,
         },
     )
-    return Zone.from_row(row) if row else None
+    zone = Zone.from_row(row) if row else None
+    catalog_cache.set(merchant_id, key, zone, generation)
+    return zone
 
 
 async def get_zones(merchant_id: str) -> list[Zone]:
+    key = ("zones",)
+    found, zones = catalog_cache.get(merchant_id, key)
+    if found:
+        return zones
+    generation = catalog_cache.generation(merchant_id)
+
     rows: list[dict] = await db.fetchall(
         "SELECT * FROM nostrmarket.zones WHERE merchant_id = :merchant_id",
         {"merchant_id": merchant_id},
     )
-    return [Zone.from_row(row) for row in rows]
+    zones = [Zone.from_row(row) for row in rows]
+    catalog_cache.set(merchant_id, key, zones, generation)
+    return zones
 
 
 async def delete_zone(merchant_id: str, zone_id: str) -> None:
@@ -184,22 +327,26 @@ async def delete_zone(merchant_id: str, zone_id: str) -> None:
             "id": zone_id,
         },
     )
+    _invalidate_catalog(merchant_id)
 
 
 async def delete_merchant_zones(merchant_id: str) -> None:
     await db.execute(
-        "DELETE FROM nostrmarket.zones WHERE merchant_id = ?",
+        "DELETE FROM nostrmarket.zones WHERE merchant_id = :merchant_id",
         {"merchant_id": merchant_id},
     )
+    _invalidate_catalog(merchant_id)
 
 
 ######################################## STALL ########################################
 
 
-async def create_stall(merchant_id: str, data: Stall) -> Stall:
+async def create_stall(
+    merchant_id: str, data: Stall, conn: Connection | None = None
+) -> Stall:
     stall_id = data.id or urlsafe_short_hash()
 
-    await db.execute(
+    await (conn or db).execute(
         """
         INSERT INTO nostrmarket.stalls
         (
@@ -228,14 +375,24 @@ async def create_stall(merchant_id: str, data: Stall) -> Stall:
             "meta": json.dumps(data.config.dict()),
         },
     )
+    _invalidate_catalog(merchant_id, conn)
 
-    stall = await get_stall(merchant_id, stall_id)
+    stall = await get_stall(merchant_id, stall_id, conn)
     assert stall, f"Newly created stall couldn't be retrieved. Id: {stall_id}"
     return stall
 
 
-async def get_stall(merchant_id: str, stall_id: str) -> Stall | None:
-    row: dict = await db.fetchone(
+async def get_stall(
+    merchant_id: str, stall_id: str, conn: Connection | None = None
+) -> Stall | None:
+    # inside a transaction, the cache might not see its changes yet
+    key = ("stall", stall_id)
+    found, stall = (False, None) if conn else catalog_cache.get(merchant_id, key)
+    if found:
+        return stall
+    generation = catalog_cache.generation(merchant_id)
+
+    row: dict = await (conn or db).fetchone(
         """
         SELECT * FROM nostrmarket.stalls
         WHERE merchant_id = :merchant_id AND id = :id
@@ -245,10 +402,19 @@ async def get_stall(merchant_id: str, stall_id: str) -> Stall | None:
             "id": stall_id,
         },
     )
-    return Stall.from_row(row) if row else None
+    stall = Stall.from_row(row) if row else None
+    if not conn:
+        catalog_cache.set(merchant_id, key, stall, generation)
+    return stall
 
 
 async def get_stalls(merchant_id: str, pending: bool | None = False) -> list[Stall]:
+    key = ("stalls", pending)
+    found, stalls = catalog_cache.get(merchant_id, key)
+    if found:
+        return stalls
+    generation = catalog_cache.generation(merchant_id)
+
     rows: list[dict] = await db.fetchall(
         """
         SELECT * FROM nostrmarket.stalls
@@ -259,29 +425,30 @@ async def get_stalls(merchant_id: str, pending: bool | None = False) -> list[Sta
             "pending": pending,
         },
     )
-    return [Stall.from_row(row) for row in rows]
-
-
-async def get_last_stall_update_time() -> int:
-    row: dict = await db.fetchone(
-        """
-            SELECT event_created_at FROM nostrmarket.stalls
-            ORDER BY event_created_at DESC LIMIT 1
-        """,
-        {},
-    )
-    return row["event_created_at"] or 0 if row else 0
-
-
-async def update_stall(merchant_id: str, stall: Stall) -> Stall | None:
-    await db.execute(
-        """
+    stalls = [Stall.from_row(row) for row in rows]
+    catalog_cache.set(merchant_id, key, stalls, generation)
+    return stalls
+
+
+async def update_stall(
+    merchant_id: str,
+    stall: Stall,
+    conn: Connection | None = None,
+    only_if_newer: bool = False,
+) -> Stall | None:
+    """
+    only_if_newer: the stall is only updated if its saved event is older
+        (eg: stalls received from the relays).
+    """
+    await (conn or db).execute(
+        f"""
             UPDATE nostrmarket.stalls
             SET wallet = :wallet, name = :name, currency = :currency,
                 pending = :pending, event_id = :event_id,
                 event_created_at = :event_created_at,
                 zones = :zones, meta = :meta
             WHERE merchant_id = :merchant_id AND id = :id
+            {_OLDER_EVENT_CONDITION if only_if_newer else ""}
         """,
         {
             "wallet": stall.wallet,
@@ -298,12 +465,15 @@ async def update_stall(merchant_id: str, stall: Stall) -> Stall | None:
             "id": stall.id,
         },
     )
+    _invalidate_catalog(merchant_id, conn)
     assert stall.id
-    return await get_stall(merchant_id, stall.id)
+    return await get_stall(merchant_id, stall.id, conn)
 
 
-async def delete_stall(merchant_id: str, stall_id: str) -> None:
-    await db.execute(
+async def delete_stall(
+    merchant_id: str, stall_id: str, conn: Connection | None = None
+) -> None:
+    await (conn or db).execute(
         """
             DELETE FROM nostrmarket.stalls
             WHERE merchant_id = :merchant_id AND id = :id
@@ -313,6 +483,7 @@ async def delete_stall(merchant_id: str, stall_id: str) -> None:
             "id": stall_id,
         },
     )
+    _invalidate_catalog(merchant_id, conn)
 
 
 async def delete_merchant_stalls(merchant_id: str) -> None:
@@ -320,15 +491,18 @@ async def delete_merchant_stalls(merchant_id: str) -> None:
         "DELETE FROM nostrmarket.stalls WHERE merchant_id = :merchant_id",
         {"merchant_id": merchant_id},
     )
+    _invalidate_catalog(merchant_id)
 
 
 ######################################## PRODUCTS ######################################
 
 
-async def create_product(merchant_id: str, data: Product) -> Product:
+async def create_product(
+    merchant_id: str, data: Product, conn: Connection | None = None
+) -> Product:
     product_id = data.id or urlsafe_short_hash()
 
-    await db.execute(
+    await (conn or db).execute(
         """
         INSERT INTO nostrmarket.products
         (
@@ -359,22 +533,33 @@ async def create_product(merchant_id: str, data: Product) -> Product:
             "meta": json.dumps(data.config.dict()),
         },
     )
-    product = await get_product(merchant_id, product_id)
+    _invalidate_catalog(merchant_id, conn)
+    product = await get_product(merchant_id, product_id, conn)
     assert product, "Newly created product couldn't be retrieved"
 
     return product
 
 
-async def update_product(merchant_id: str, product: Product) -> Product:
+async def update_product(
+    merchant_id: str,
+    product: Product,
+    conn: Connection | None = None,
+    only_if_newer: bool = False,
+) -> Product:
+    """
+    only_if_newer: the product is only updated if its saved event is older
+        (eg: products received from the relays).
+    """
     assert product.id
-    await db.execute(
-        """
+    await (conn or db).execute(
+        f"""
         UPDATE nostrmarket.products
         SET name = :name, price = :price, quantity = :quantity,
             active = :active, pending = :pending, event_id =:event_id,
             event_created_at = :event_created_at, image_urls = :image_urls,
             category_list = :category_list, meta = :meta
         WHERE merchant_id = :merchant_id AND id = :id
+        {_OLDER_EVENT_CONDITION if only_if_newer else ""}
         """,
         {
             "name": product.name,
@@ -391,29 +576,44 @@ async def update_product(merchant_id: str, product: Product) -> Product:
             "id": product.id,
         },
     )
-    updated_product = await get_product(merchant_id, product.id)
+    _invalidate_catalog(merchant_id, conn)
+    updated_product = await get_product(merchant_id, product.id, conn)
     assert updated_product, "Updated product couldn't be retrieved"
 
     return updated_product
 
 
-async def update_product_quantity(product_id: str, new_quantity: int) -> Product | None:
-    await db.execute(
+async def update_product_quantity(
+    product_id: str, new_quantity: int, conn: Connection | None = None
+) -> Product | None:
+    await (conn or db).execute(
         """
             UPDATE nostrmarket.products SET quantity = :quantity
             WHERE id = :id
         """,
         {"quantity": new_quantity, "id": product_id},
     )
-    row: dict = await db.fetchone(
+    row: dict = await (conn or db).fetchone(
         "SELECT * FROM nostrmarket.products WHERE id = :id",
         {"id": product_id},
     )
-    return Product.from_row(row) if row else None
-
-
-async def get_product(merchant_id: str, product_id: str) -> Product | None:
-    row: dict = await db.fetchone(
+    if not row:
+        return None
+    _invalidate_catalog(row["merchant_id"], conn)
+    return Product.from_row(row)
+
+
+async def get_product(
+    merchant_id: str, product_id: str, conn: Connection | None = None
+) -> Product | None:
+    # inside a transaction, the cache might not see its changes yet
+    key = ("product", product_id)
+    found, product = (False, None) if conn else catalog_cache.get(merchant_id, key)
+    if found:
+        return product
+    generation = catalog_cache.generation(merchant_id)
+
+    row: dict = await (conn or db).fetchone(
         """
             SELECT * FROM nostrmarket.products
             WHERE merchant_id = :merchant_id AND id = :id
@@ -424,12 +624,21 @@ async def get_product(merchant_id: str, product_id: str) -> Product | None:
         },
     )
     # TODO: remove from_row
-    return Product.from_row(row) if row else None
+    product = Product.from_row(row) if row else None
+    if not conn:
+        catalog_cache.set(merchant_id, key, product, generation)
+    return product
 
 
 async def get_products(
     merchant_id: str, stall_id: str, pending: bool | None = False
 ) -> list[Product]:
+    key = ("products", stall_id, pending)
+    found, products = catalog_cache.get(merchant_id, key)
+    if found:
+        return products
+    generation = catalog_cache.generation(merchant_id)
+
     rows: list[dict] = await db.fetchall(
         """
         SELECT * FROM nostrmarket.products
@@ -438,13 +647,39 @@ async def get_products(
         """,
         {"merchant_id": merchant_id, "stall_id": stall_id, "pending": pending},
     )
-    return [Product.from_row(row) for row in rows]
+    products = [Product.from_row(row) for row in rows]
+    catalog_cache.set(merchant_id, key, products, generation)
+    return products
+
+
+async def get_catalog_event_times(merchant_id: str) -> dict[tuple[int, str], int]:
+    """
+    The `event_created_at` of all the stalls (kind 30017) and products
+    (kind 30018) of a merchant, by (kind, id).
+    """
+    event_times: dict[tuple[int, str], int] = {}
+    for kind, table in [(30017, "stalls"), (30018, "products")]:
+        rows: list[dict] = await db.fetchall(
+            f"""
+            SELECT id, event_created_at FROM nostrmarket.{table}
+            WHERE merchant_id = :merchant_id
+            """,
+            {"merchant_id": merchant_id},
+        )
+        for row in rows:
+            event_times[(kind, row["id"])] = row["event_created_at"] or 0
+    return event_times
 
 
 async def get_products_by_ids(
     merchant_id: str, product_ids: list[str]
 ) -> list[Product]:
     # todo: revisit
+    cache_key = ("products_by_ids", *sorted(product_ids))
+    found, products = catalog_cache.get(merchant_id, cache_key)
+    if found:
+        return products
+    generation = catalog_cache.generation(merchant_id)
 
     keys = []
     values = {"merchant_id": merchant_id}
@@ -461,7 +696,9 @@ async def get_products_by_ids(
         """,
         values,
     )
-    return [Product.from_row(row) for row in rows]
+    products = [Product.from_row(row) for row in rows]
+    catalog_cache.set(merchant_id, cache_key, products, generation)
+    return products
 
 
 async def get_wallet_for_product(product_id: str) -> str | None:
@@ -477,19 +714,10 @@ async def get_wallet_for_product(product_id: str) -> str | None:
     return row["wallet"] if row else None
 
 
-async def get_last_product_update_time() -> int:
-    row: dict = await db.fetchone(
-        """
-            SELECT event_created_at FROM nostrmarket.products
-            ORDER BY event_created_at DESC LIMIT 1
-        """,
-        {},
-    )
-    return row["event_created_at"] or 0 if row else 0
-
-
-async def delete_product(merchant_id: str, product_id: str) -> None:
-    await db.execute(
+async def delete_product(
+    merchant_id: str, product_id: str, conn: Connection | None = None
+) -> None:
+    await (conn or db).execute(
         """
             DELETE FROM nostrmarket.products
             WHERE merchant_id = :merchant_id AND id = :id
@@ -499,20 +727,16 @@ async def delete_product(merchant_id: str, product_id: str) -> None:
             "id": product_id,
         },
     )
-
-
-async def delete_merchant_products(merchant_id: str) -> None:
-    await db.execute(
-        "DELETE FROM nostrmarket.products WHERE merchant_id = :merchant_id",
-        {"merchant_id": merchant_id},
-    )
+    _invalidate_catalog(merchant_id, conn)
 
 
 ######################################## ORDERS ########################################
 
 
-async def create_order(merchant_id: str, o: Order) -> Order:
-    await db.execute(
+async def create_order(
+    merchant_id: str, o: Order, conn: Connection | None = None
+) -> Order:
+    await (conn or db).execute(
         """
         INSERT INTO nostrmarket.orders (
             merchant_id,
@@ -565,14 +789,19 @@ async def create_order(merchant_id: str, o: Order) -> Order:
             "total": o.total,
         },
     )
-    order = await get_order(merchant_id, o.id)
+    order = await get_order(merchant_id, o.id, conn=conn)
     assert order, "Newly created order couldn't be retrieved"
 
     return order
 
 
-async def get_order(merchant_id: str, order_id: str) -> Order | None:
-    row: dict = await db.fetchone(
+async def get_order(
+    merchant_id: str,
+    order_id: str,
+    include_archived: bool = False,
+    conn: Connection | None = None,
+) -> Order | None:
+    row: dict = await (conn or db).fetchone(
         """
             SELECT * FROM nostrmarket.orders
             WHERE merchant_id = :merchant_id AND id = :id
@@ -582,11 +811,20 @@ async def get_order(merchant_id: str, order_id: str) -> Order | None:
             "id": order_id,
         },
     )
-    return Order.from_row(row) if row else None
-
-
-async def get_order_by_event_id(merchant_id: str, event_id: str) -> Order | None:
-    row: dict = await db.fetchone(
+    if row:
+        return Order.from_row(row)
+    if include_archived:
+        return await _get_archived_order(merchant_id, "id", order_id, conn)
+    return None
+
+
+async def get_order_by_event_id(
+    merchant_id: str,
+    event_id: str,
+    include_archived: bool = False,
+    conn: Connection | None = None,
+) -> Order | None:
+    row: dict = await (conn or db).fetchone(
         """
             SELECT * FROM nostrmarket.orders
             WHERE merchant_id = :merchant_id AND  event_id = :event_id
@@ -596,10 +834,16 @@ async def get_order_by_event_id(merchant_id: str, event_id: str) -> Order | None
             "event_id": event_id,
         },
     )
-    return Order.from_row(row) if row else None
+    if row:
+        return Order.from_row(row)
+    if include_archived:
+        return await _get_archived_order(merchant_id, "event_id", event_id, conn)
+    return None
 
 
-async def get_orders(merchant_id: str, **kwargs) -> list[Order]:
+async def get_orders(
+    merchant_id: str, include_archived: bool = False, **kwargs
+) -> list[Order]:
     q = " AND ".join(
         [
             f"{field[0]} = :{field[0]}"
@@ -616,12 +860,16 @@ async def get_orders(merchant_id: str, **kwargs) -> list[Order]:
     rows: list[dict] = await db.fetchall(
         f"""
         SELECT * FROM nostrmarket.orders
-        WHERE merchant_id = :merchant_id {('AND ' + q) if q else ''}
+        WHERE merchant_id = :merchant_id {("AND " + q) if q else ""}
         ORDER BY event_created_at DESC
         """,
         values,
     )
-    return [Order.from_row(row) for row in rows]
+    orders = [Order.from_row(row) for row in rows]
+    if include_archived:
+        orders += await _get_archived_orders(merchant_id, **kwargs)
+        orders.sort(key=lambda o: o.event_created_at or 0, reverse=True)
+    return orders
 
 
 async def get_orders_for_stall(
@@ -652,7 +900,9 @@ async def get_orders_for_stall(
     return [Order.from_row(row) for row in rows]
 
 
-async def update_order(merchant_id: str, order_id: str, **kwargs) -> Order | None:
+async def update_order(
+    merchant_id: str, order_id: str, conn: Connection | None = None, **kwargs
+) -> Order | None:
     q = ", ".join(
         [
             f"{field[0]} = :{field[0]}"
@@ -665,7 +915,7 @@ async def update_order(merchant_id: str, order_id: str, **kwargs) -> Order | Non
         if field[1] is None:
             continue
         values[field[0]] = field[1]
-    await db.execute(
+    await (conn or db).execute(
         f"""
             UPDATE nostrmarket.orders
             SET {q} WHERE merchant_id = :merchant_id and id = :id
@@ -673,12 +923,13 @@ async def update_order(merchant_id: str, order_id: str, **kwargs) -> Order | Non
         values,
     )
 
-    return await get_order(merchant_id, order_id)
+    return await get_order(merchant_id, order_id, conn=conn)
 
 
 async def update_order_paid_status(order_id: str, paid: bool) -> Order | None:
+    # an invoice can still be paid after the order was marked as expired
     await db.execute(
-        "UPDATE nostrmarket.orders SET paid = :paid  WHERE id = :id",
+        "UPDATE nostrmarket.orders SET paid = :paid, expired = false WHERE id = :id",
         {"paid": paid, "id": order_id},
     )
     row: dict = await db.fetchone(
@@ -707,35 +958,127 @@ async def update_order_shipped_status(
     return Order.from_row(row) if row else None
 
 
-async def delete_merchant_orders(merchant_id: str) -> None:
+async def expire_unpaid_orders(created_before: int, limit: int) -> list[Order]:
+    """
+    Mark (at most `limit`) unpaid orders created before `created_before` as
+    expired. Returns the orders that were marked.
+    """
+    rows: list[dict] = await db.fetchall(
+        f"""
+        SELECT id FROM nostrmarket.orders
+        WHERE paid = false AND expired = false
+              AND time < {db.timestamp_placeholder("created_before")}
+        LIMIT :limit
+        """,
+        {"created_before": created_before, "limit": limit},
+    )
+    if not rows:
+        return []
+
+    keys = []
+    values = {}
+    for i, row in enumerate(rows):
+        key = f"id_{i}"
+        keys.append(f":{key}")
+        values[key] = row["id"]
+
     await db.execute(
-        "DELETE FROM nostrmarket.orders WHERE merchant_id = :merchant_id",
-        {"merchant_id": merchant_id},
+        f"""
+        UPDATE nostrmarket.orders SET expired = true
+        WHERE paid = false AND id IN ({", ".join(keys)})
+        """,
+        values,
     )
+    # orders paid in the meantime are not expired
+    rows = await db.fetchall(
+        f"""
+        SELECT * FROM nostrmarket.orders
+        WHERE paid = false AND expired = true AND id IN ({", ".join(keys)})
+        """,
+        values,
+    )
+    return [Order.from_row(row) for row in rows]
 
 
 ######################################## MESSAGES ######################################
 
 
 async def create_direct_message(
-    merchant_id: str, dm: PartialDirectMessage
+    merchant_id: str, dm: PartialDirectMessage, conn: Connection | None = None
 ) -> DirectMessage:
+    if dm.event_id and _maybe_archived(dm.event_created_at):
+        # relays keep sending the old messages
+        archived = await _get_archived_direct_message(merchant_id, dm.event_id, conn)
+        if archived:
+            return archived
     dm_id = urlsafe_short_hash()
-    await db.execute(
+    await _insert_direct_message(conn or db, merchant_id, dm_id, dm)
+    if dm.event_id:
+        msg = await get_direct_message_by_event_id(merchant_id, dm.event_id, conn)
+    else:
+        msg = await get_direct_message(merchant_id, dm_id, conn)
+    assert msg, "Newly created dm couldn't be retrieved"
+    return msg
+
+
+async def create_direct_messages(dms: list[tuple[str, PartialDirectMessage]]):
+    """
+    Insert many (merchant_id, dm) pairs in a single transaction.
+    Unlike `create_direct_message()` the rows are not read back.
+    """
+    async with unit_of_work() as conn:
+        archived = await _get_archived_event_ids(
+            conn,
+            [
+                (merchant_id, dm.event_id)
+                for merchant_id, dm in dms
+                if dm.event_id and _maybe_archived(dm.event_created_at)
+            ],
+        )
+        for merchant_id, dm in dms:
+            if (merchant_id, dm.event_id) in archived:
+                continue
+            await _insert_direct_message(conn, merchant_id, urlsafe_short_hash(), dm)
+    # the unread counts changed
+    for merchant_id in {merchant_id for merchant_id, _ in dms}:
+        customers_cache.pop(merchant_id)
+
+
+# last `inserted_at` given to a message
+_last_inserted_at = 0
+
+
+def _insert_time() -> int:
+    """
+    Strictly increasing insert time of the messages, in microseconds.
+    Unlike `event_created_at` (set by the sender, or in the future for the
+    paced messages) it only grows, the unread count and the chat delta rely
+    on it.
+    """
+    global _last_inserted_at
+    _last_inserted_at = max(time.time_ns() // 1000, _last_inserted_at + 1)
+    return _last_inserted_at
+
+
+async def _insert_direct_message(
+    conn, merchant_id: str, dm_id: str, dm: PartialDirectMessage
+):
+    await conn.execute(
         """
         INSERT INTO nostrmarket.direct_messages
         (
             merchant_id, id, event_id, event_created_at,
-            message, public_key, type, incoming
+            message, public_key, type, incoming, inserted_at
         )
         VALUES
             (
             :merchant_id, :id, :event_id, :event_created_at,
-            :message, :public_key, :type, :incoming
+            :message, :public_key, :type, :incoming, :inserted_at
             )
         ON CONFLICT(event_id) DO NOTHING
         """,
         {
+            "inserted_at": _insert_time(),
             "merchant_id": merchant_id,
             "id": dm_id,
             "event_id": dm.event_id,
@@ -746,16 +1089,12 @@ async def create_direct_message(
             "incoming": dm.incoming,
         },
     )
-    if dm.event_id:
-        msg = await get_direct_message_by_event_id(merchant_id, dm.event_id)
-    else:
-        msg = await get_direct_message(merchant_id, dm_id)
-    assert msg, "Newly created dm couldn't be retrieved"
-    return msg
 
 
-async def get_direct_message(merchant_id: str, dm_id: str) -> DirectMessage | None:
-    row: dict = await db.fetchone(
+async def get_direct_message(
+    merchant_id: str, dm_id: str, conn: Connection | None = None
+) -> DirectMessage | None:
+    row: dict = await (conn or db).fetchone(
         """
             SELECT * FROM nostrmarket.direct_messages
             WHERE merchant_id = :merchant_id AND id = :id
@@ -769,9 +1108,9 @@ async def get_direct_message(merchant_id: str, dm_id: str) -> DirectMessage | No
 
 
 async def get_direct_message_by_event_id(
-    merchant_id: str, event_id: str
+    merchant_id: str, event_id: str, conn: Connection | None = None
 ) -> DirectMessage | None:
-    row: dict = await db.fetchone(
+    row: dict = await (conn or db).fetchone(
         """
         SELECT * FROM nostrmarket.direct_messages
         WHERE merchant_id = :merchant_id AND event_id = :event_id
@@ -784,63 +1123,532 @@ async def get_direct_message_by_event_id(
     return DirectMessage.from_row(row) if row else None
 
 
-async def get_direct_messages(merchant_id: str, public_key: str) -> list[DirectMessage]:
+async def get_direct_messages(
+    merchant_id: str,
+    public_key: str,
+    inserted_after: int | None = None,
+    until: int | None = None,
+    limit: int | None = None,
+    include_archived: bool = False,
+    before_id: str | None = None,
+) -> list[DirectMessage]:
+    """
+    Messages ordered by (`event_created_at`, `id`). With `inserted_after`,
+    only the messages inserted after it (`inserted_at`) are returned: the
+    delta of a chat, whatever their `event_created_at`. The `until` bound is
+    inclusive. With `before_id`, only the messages strictly before (`until`,
+    `before_id`) are returned, for paging. With a `limit` the most recent
+    messages are returned. Archived messages are only read when
+    `include_archived` is set.
+    """
+    values: dict = {"merchant_id": merchant_id, "public_key": public_key}
+    q = ""
+    if inserted_after is not None:
+        q += " AND inserted_at > :inserted_after"
+        values["inserted_after"] = inserted_after
+        # new messages are never in the archive (no `inserted_at` there)
+        include_archived = False
+    if until is not None and before_id is not None:
+        q += """ AND (
+            event_created_at < :until
+            OR (event_created_at = :until AND id < :before_id)
+        )"""
+        values["until"] = until
+        values["before_id"] = before_id
+    elif until is not None:
+        q += " AND event_created_at <= :until"
+        values["until"] = until
+    if limit:
+        values["limit"] = limit
+    order = "event_created_at DESC, id DESC LIMIT :limit" if limit else ""
+
     rows: list[dict] = await db.fetchall(
-        """
+        f"""
         SELECT * FROM nostrmarket.direct_messages
+        WHERE merchant_id = :merchant_id AND public_key = :public_key {q}
+        ORDER BY {order or "event_created_at, id"}
+        """,
+        values,
+    )
+    if limit:
+        rows.reverse()
+    messages = [DirectMessage.from_row(row) for row in rows]
+    if include_archived:
+        archived_rows: list[dict] = await db.fetchall(
+            f"""
+            SELECT data FROM nostrmarket.direct_messages_archive
+            WHERE merchant_id = :merchant_id AND public_key = :public_key {q}
+            ORDER BY {order or "event_created_at, id"}
+            """,
+            values,
+        )
+        messages += [_unpack(DirectMessage, row["data"]) for row in archived_rows]
+        messages.sort(key=lambda m: (m.event_created_at or 0, m.id))
+        if limit:
+            messages = messages[-limit:]
+    return messages
+
+
+async def get_last_outgoing_dm_time(merchant_id: str, public_key: str) -> int:
+    """The `event_created_at` of the last message sent to this customer."""
+    row: dict = await db.fetchone(
+        """
+        SELECT MAX(event_created_at) AS last_created_at
+        FROM nostrmarket.direct_messages
         WHERE merchant_id = :merchant_id AND public_key = :public_key
-        ORDER BY event_created_at
+        AND incoming = false
         """,
         {"merchant_id": merchant_id, "public_key": public_key},
     )
-    return [DirectMessage.from_row(row) for row in rows]
+    return (row["last_created_at"] if row else None) or 0
+
+
+async def get_order_direct_messages_page(
+    merchant_id: str, after: tuple[int, str] | None = None, limit: int = 500
+) -> list[DirectMessage]:
+    """
+    Messages with a customer order, archived ones included, ordered by
+    (event_created_at, id). `after` is the (event_created_at, id) of the last
+    message of the previous page.
+    """
+    created_at, dm_id = after or (-1, "")
+    values = {
+        "merchant_id": merchant_id,
+        "type": DirectMessageType.CUSTOMER_ORDER.value,
+        "created_at": created_at,
+        "id": dm_id,
+        "limit": limit,
+    }
+    where = """
+        WHERE merchant_id = :merchant_id AND type = :type
+        AND (
+            event_created_at > :created_at
+            OR (event_created_at = :created_at AND id > :id)
+        )
+        ORDER BY event_created_at, id LIMIT :limit
+    """
+    rows: list[dict] = await db.fetchall(
+        f"SELECT * FROM nostrmarket.direct_messages {where}", values
+    )
+    archived_rows: list[dict] = await db.fetchall(
+        f"SELECT data FROM nostrmarket.direct_messages_archive {where}", values
+    )
+    messages = [DirectMessage.from_row(row) for row in rows] + [
+        _unpack(DirectMessage, row["data"]) for row in archived_rows
+    ]
+    messages.sort(key=lambda m: (m.event_created_at or 0, m.id))
+    return messages[:limit]
+
+
+async def get_order_follow_up_messages(
+    merchant_id: str, public_keys: list[str], since: int
+) -> list[DirectMessage]:
+    """
+    Payment requests and order status updates sent to these customers,
+    archived ones included, starting from `since` (inclusive).
+    """
+    if not public_keys:
+        return []
+    keys = []
+    values: dict = {
+        "merchant_id": merchant_id,
+        "since": since,
+        "payment_request": DirectMessageType.PAYMENT_REQUEST.value,
+        "status_update": DirectMessageType.ORDER_PAID_OR_SHIPPED.value,
+    }
+    for i, v in enumerate(public_keys):
+        key = f"pk_{i}"
+        values[key] = v
+        keys.append(f":{key}")
+    where = f"""
+        WHERE merchant_id = :merchant_id
+        AND public_key IN ({", ".join(keys)})
+        AND type IN (:payment_request, :status_update) AND incoming = false
+        AND event_created_at >= :since
+    """
+    rows: list[dict] = await db.fetchall(
+        f"SELECT * FROM nostrmarket.direct_messages {where}", values
+    )
+    archived_rows: list[dict] = await db.fetchall(
+        f"SELECT data FROM nostrmarket.direct_messages_archive {where}", values
+    )
+    return [DirectMessage.from_row(row) for row in rows] + [
+        _unpack(DirectMessage, row["data"]) for row in archived_rows
+    ]
+
+
+async def count_order_direct_messages(merchant_id: str) -> int:
+    """Messages with a customer order, archived ones included."""
+    row: dict = await db.fetchone(
+        """
+        SELECT
+            (
+                SELECT COUNT(*) FROM nostrmarket.direct_messages
+                WHERE merchant_id = :merchant_id AND type = :type
+            ) + (
+                SELECT COUNT(*) FROM nostrmarket.direct_messages_archive
+                WHERE merchant_id = :merchant_id AND type = :type
+            ) AS count
+        """,
+        {
+            "merchant_id": merchant_id,
+            "type": DirectMessageType.CUSTOMER_ORDER.value,
+        },
+    )
+    return row["count"] if row else 0
+
+
+######################################## OUTBOX ########################################
 
 
-async def get_orders_from_direct_messages(merchant_id: str) -> list[DirectMessage]:
+async def create_outbox_event(
+    merchant_id: str,
+    event: NostrEvent,
+    conn: Connection | None = None,
+    priority: int | None = None,
+) -> None:
+    """priority: see `send_queue`, by default computed from the event kind."""
+    if priority is None:
+        priority = frame_priority(["EVENT", event.dict()])
+    await (conn or db).execute(
+        """
+        INSERT INTO nostrmarket.outbox
+               (event_id, merchant_id, event, event_created_at, priority)
+        VALUES (:event_id, :merchant_id, :event, :event_created_at, :priority)
+        ON CONFLICT(event_id) DO NOTHING
+        """,
+        {
+            "event_id": event.id,
+            "merchant_id": merchant_id,
+            "event": json.dumps(event.dict()),
+            "event_created_at": event.created_at,
+            "priority": priority,
+        },
+    )
+
+
+async def get_unsent_outbox_events(limit: int) -> list[tuple[int, NostrEvent]]:
+    """
+    (priority, event) pairs. Events scheduled in the future (`created_at`) are
+    not returned yet.
+    """
     rows: list[dict] = await db.fetchall(
         """
-        SELECT * FROM nostrmarket.direct_messages
-        WHERE merchant_id = :merchant_id AND type >= 0 ORDER BY event_created_at, type
+        SELECT priority, event FROM nostrmarket.outbox
+        WHERE acked = false AND attempts = 0 AND event_created_at <= :now
+        ORDER BY priority, event_created_at LIMIT :limit
         """,
-        {"merchant_id": merchant_id},
+        {"now": round(time.time()), "limit": limit},
     )
-    return [DirectMessage.from_row(row) for row in rows]
+    return [(row["priority"], NostrEvent(**json.loads(row["event"]))) for row in rows]
 
 
-async def get_last_direct_messages_time(merchant_id: str) -> int:
+async def count_unsent_outbox_events() -> int:
     row: dict = await db.fetchone(
         """
-            SELECT time FROM nostrmarket.direct_messages
-            WHERE merchant_id = :merchant_id ORDER BY time DESC LIMIT 1
+        SELECT COUNT(*) AS count FROM nostrmarket.outbox
+        WHERE acked = false AND attempts = 0
+        """
+    )
+    return row["count"] if row else 0
+
+
+async def get_unacked_outbox_events(
+    sent_before: int, max_attempts: int, limit: int
+) -> list[tuple[int, NostrEvent]]:
+    """(priority, event) pairs."""
+    rows: list[dict] = await db.fetchall(
+        """
+        SELECT priority, event FROM nostrmarket.outbox
+        WHERE acked = false AND attempts > 0 AND attempts < :max_attempts
+              AND last_sent_at < :sent_before
+        ORDER BY priority, event_created_at LIMIT :limit
+        """,
+        {"sent_before": sent_before, "max_attempts": max_attempts, "limit": limit},
+    )
+    return [(row["priority"], NostrEvent(**json.loads(row["event"]))) for row in rows]
+
+
+async def mark_outbox_events_sent(event_ids: list[str], sent_at: int) -> None:
+    if not event_ids:
+        return
+    keys = []
+    values: dict = {"sent_at": sent_at}
+    for i, v in enumerate(event_ids):
+        key = f"e_{i}"
+        values[key] = v
+        keys.append(f":{key}")
+    await db.execute(
+        f"""
+        UPDATE nostrmarket.outbox
+        SET attempts = attempts + 1, last_sent_at = :sent_at
+        WHERE event_id IN ({", ".join(keys)})
         """,
+        values,
+    )
+
+
+async def mark_outbox_event_acked(event_id: str) -> None:
+    await db.execute(
+        "UPDATE nostrmarket.outbox SET acked = true WHERE event_id = :event_id",
+        {"event_id": event_id},
+    )
+
+
+async def delete_outbox_events_older_than(created_before: int) -> None:
+    await db.execute(
+        """
+        DELETE FROM nostrmarket.outbox
+        WHERE event_created_at < :created_before
+        """,
+        {"created_before": created_before},
+    )
+
+
+async def delete_merchant_outbox_events(merchant_id: str) -> None:
+    await db.execute(
+        "DELETE FROM nostrmarket.outbox WHERE merchant_id = :merchant_id",
         {"merchant_id": merchant_id},
     )
-    return row["time"] if row else 0
 
 
-async def get_last_direct_messages_created_at() -> int:
+######################################## EVENTS ########################################
+
+
+async def create_events(events: list[NostrEvent]) -> None:
+    """Append raw events, in a single transaction. Known events are skipped."""
+    async with unit_of_work() as conn:
+        for event in events:
+            await conn.execute(
+                """
+                INSERT INTO nostrmarket.events
+                       (id, pubkey, kind, created_at, event)
+                VALUES (:id, :pubkey, :kind, :created_at, :event)
+                ON CONFLICT(id) DO NOTHING
+                """,
+                {
+                    "id": event.id,
+                    "pubkey": event.pubkey,
+                    "kind": event.kind,
+                    "created_at": event.created_at,
+                    "event": json.dumps(event.dict()),
+                },
+            )
+            for p_tag in set(event.tag_values("p")):
+                await conn.execute(
+                    """
+                    INSERT INTO nostrmarket.event_p_tags
+                           (event_id, p_tag, kind, created_at)
+                    VALUES (:event_id, :p_tag, :kind, :created_at)
+                    ON CONFLICT(event_id, p_tag) DO NOTHING
+                    """,
+                    {
+                        "event_id": event.id,
+                        "p_tag": p_tag,
+                        "kind": event.kind,
+                        "created_at": event.created_at,
+                    },
+                )
+
+
+def _merchant_events_query(
+    kinds: list[int] | None, cursor: str = ""
+) -> tuple[str, dict]:
+    """
+    Ids (and `created_at`) of the events published by or sent to (`p` tag)
+    the merchant `:public_key`, with the given kinds (all if None).
+    """
+    kind_keys = [f":kind_{i}" for i in range(len(kinds or []))]
+    values: dict = {f"kind_{i}": kind for i, kind in enumerate(kinds or [])}
+    kind_condition = f"AND kind IN ({', '.join(kind_keys)})" if kinds else ""
+    query = f"""
+        SELECT id, created_at FROM nostrmarket.events
+        WHERE pubkey = :public_key {kind_condition}
+        {cursor.format(id="id")}
+        UNION
+        SELECT event_id AS id, created_at FROM nostrmarket.event_p_tags
+        WHERE p_tag = :public_key {kind_condition}
+        {cursor.format(id="event_id")}
+    """
+    return query, values
+
+
+async def get_merchant_events_page(
+    public_key: str,
+    kinds: list[int],
+    after: tuple[int, str] | None = None,
+    limit: int = 500,
+) -> list[NostrEvent]:
+    """
+    Stored events published by or sent to (`p` tag) the merchant, ordered by
+    (created_at, id). `after` is the (created_at, id) of the last event of the
+    previous page.
+    """
+    created_at, event_id = after or (-1, "")
+    ids_query, values = _merchant_events_query(
+        kinds,
+        "AND (created_at > :created_at OR (created_at = :created_at AND {id} > :id))",
+    )
+    rows: list[dict] = await db.fetchall(
+        f"""
+        SELECT e.event FROM nostrmarket.events e
+        JOIN ({ids_query} ORDER BY created_at, id LIMIT :limit) AS page
+        ON page.id = e.id
+        ORDER BY e.created_at, e.id
+        """,
+        {
+            **values,
+            "public_key": public_key,
+            "created_at": created_at,
+            "id": event_id,
+            "limit": limit,
+        },
+    )
+    return [NostrEvent(**json.loads(row["event"])) for row in rows]
+
+
+async def count_merchant_events(public_key: str, kinds: list[int] | None) -> int:
+    """Events published by or sent to the merchant, all kinds if `kinds` is None."""
+    ids_query, values = _merchant_events_query(kinds)
     row: dict = await db.fetchone(
+        f"SELECT COUNT(*) AS count FROM ({ids_query}) AS merchant_events",
+        {**values, "public_key": public_key},
+    )
+    return row["count"] if row else 0
+
+
+async def delete_merchant_events(public_key: str, limit: int) -> int:
+    """
+    Delete (at most `limit`) stored events published by or sent to the
+    (already deleted) merchant. Events published by or sent to (`p` tag)
+    another local merchant are kept for it, only the merchant's `p` tag row
+    is deleted. Returns the number of events done.
+    """
+    # authored events kept for another merchant are not selected again
+    rows: list[dict] = await db.fetchall(
         """
-            SELECT event_created_at FROM nostrmarket.direct_messages
-            ORDER BY event_created_at DESC LIMIT 1
+        SELECT id FROM nostrmarket.events
+        WHERE pubkey = :public_key AND NOT EXISTS (
+            SELECT 1 FROM nostrmarket.event_p_tags t
+            JOIN nostrmarket.merchants m ON m.public_key = t.p_tag
+            WHERE t.event_id = nostrmarket.events.id AND t.p_tag <> :public_key
+        )
+        UNION
+        SELECT event_id AS id FROM nostrmarket.event_p_tags
+        WHERE p_tag = :public_key
+        LIMIT :limit
         """,
-        {},
+        {"public_key": public_key, "limit": limit},
     )
-    return row["event_created_at"] if row else 0
+    if not rows:
+        return 0
+    keys = []
+    values: dict = {"public_key": public_key}
+    for i, row in enumerate(rows):
+        values[f"id_{i}"] = row["id"]
+        keys.append(f":id_{i}")
+    ids = ", ".join(keys)
+    async with unit_of_work() as conn:
+        await conn.execute(
+            f"""
+            DELETE FROM nostrmarket.event_p_tags
+            WHERE p_tag = :public_key AND event_id IN ({ids})
+            """,
+            values,
+        )
+        await conn.execute(
+            f"""
+            DELETE FROM nostrmarket.events
+            WHERE id IN ({ids})
+            AND NOT EXISTS (
+                SELECT 1 FROM nostrmarket.merchants m
+                WHERE m.public_key = nostrmarket.events.pubkey
+                AND m.public_key <> :public_key
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM nostrmarket.event_p_tags t
+                JOIN nostrmarket.merchants m ON m.public_key = t.p_tag
+                WHERE t.event_id = nostrmarket.events.id
+                AND t.p_tag <> :public_key
+            )
+            """,
+            values,
+        )
+        await conn.execute(
+            f"""
+            DELETE FROM nostrmarket.event_p_tags
+            WHERE event_id IN ({ids}) AND NOT EXISTS (
+                SELECT 1 FROM nostrmarket.events e
+                WHERE e.id = nostrmarket.event_p_tags.event_id
+            )
+            """,
+            values,
+        )
+    return len(rows)
 
 
-async def delete_merchant_direct_messages(merchant_id: str) -> None:
+######################################## SYNC STATE ####################################
+
+
+async def get_sync_cursors() -> dict[str, dict[int, int]]:
+    rows: list[dict] = await db.fetchall(
+        "SELECT merchant_id, kind, last_created_at FROM nostrmarket.sync_state"
+    )
+    cursors: dict[str, dict[int, int]] = {}
+    for row in rows:
+        cursors.setdefault(row["merchant_id"], {})[row["kind"]] = row["last_created_at"]
+    return cursors
+
+
+async def update_sync_cursors(cursors: dict[tuple[str, int], int]) -> None:
+    async with unit_of_work() as conn:
+        for (merchant_id, kind), last_created_at in cursors.items():
+            await conn.execute(
+                """
+                INSERT INTO nostrmarket.sync_state AS s
+                       (merchant_id, kind, last_created_at)
+                VALUES (:merchant_id, :kind, :last_created_at)
+                ON CONFLICT (merchant_id, kind) DO UPDATE
+                SET last_created_at = excluded.last_created_at
+                WHERE s.last_created_at < excluded.last_created_at
+                """,
+                {
+                    "merchant_id": merchant_id,
+                    "kind": kind,
+                    "last_created_at": last_created_at,
+                },
+            )
+
+
+async def delete_merchant_sync_cursors(merchant_id: str) -> None:
     await db.execute(
-        "DELETE FROM nostrmarket.direct_messages WHERE merchant_id = :merchant_id",
+        "DELETE FROM nostrmarket.sync_state WHERE merchant_id = :merchant_id",
         {"merchant_id": merchant_id},
     )
 
 
 ######################################## CUSTOMERS #####################################
 
-
-async def create_customer(merchant_id: str, data: Customer) -> Customer:
-    await db.execute(
+# customers list (with profiles) by merchant id, for the chat list
+customers_cache = LRUCache(maxsize=1_000)
+
+_select_customers = """
+    SELECT c.merchant_id, c.public_key,
+           p.event_created_at, COALESCE(p.meta, c.meta) AS meta,
+           (
+               SELECT COUNT(*) FROM nostrmarket.direct_messages d
+               WHERE d.merchant_id = c.merchant_id AND d.public_key = c.public_key
+               AND d.incoming = true AND d.inserted_at > c.last_read_at
+           ) AS unread_messages
+    FROM nostrmarket.customers c
+    LEFT JOIN nostrmarket.customer_profiles p ON p.public_key = c.public_key
+"""
+
+
+async def create_customer(
+    merchant_id: str, data: Customer, conn: Connection | None = None
+) -> Customer:
+    await (conn or db).execute(
         """
         INSERT INTO nostrmarket.customers (merchant_id, public_key, meta)
         VALUES (:merchant_id, :public_key, :meta)
@@ -852,16 +1660,19 @@ async def create_customer(merchant_id: str, data: Customer) -> Customer:
         },
     )
 
-    customer = await get_customer(merchant_id, data.public_key)
+    _invalidate(lambda: customers_cache.pop(merchant_id), conn)
+    customer = await get_customer(merchant_id, data.public_key, conn)
     assert customer, "Newly created customer couldn't be retrieved"
     return customer
 
 
-async def get_customer(merchant_id: str, public_key: str) -> Customer | None:
-    row: dict = await db.fetchone(
-        """
-            SELECT * FROM nostrmarket.customers
-            WHERE merchant_id = :merchant_id AND public_key = :public_key
+async def get_customer(
+    merchant_id: str, public_key: str, conn: Connection | None = None
+) -> Customer | None:
+    row: dict = await (conn or db).fetchone(
+        f"""
+            {_select_customers}
+            WHERE c.merchant_id = :merchant_id AND c.public_key = :public_key
         """,
         {
             "merchant_id": merchant_id,
@@ -872,64 +1683,379 @@ async def get_customer(merchant_id: str, public_key: str) -> Customer | None:
 
 
 async def get_customers(merchant_id: str) -> list[Customer]:
-    rows: list[dict] = await db.fetchall(
-        "SELECT * FROM nostrmarket.customers WHERE merchant_id = :merchant_id",
-        {"merchant_id": merchant_id},
-    )
-    return [Customer.from_row(row) for row in rows]
+    customers = customers_cache.get(merchant_id)
+    if customers is None:
+        rows: list[dict] = await db.fetchall(
+            f"{_select_customers} WHERE c.merchant_id = :merchant_id",
+            {"merchant_id": merchant_id},
+        )
+        customers = [Customer.from_row(row) for row in rows]
+        customers_cache.set(merchant_id, customers)
+    # callers must not change the cached entries
+    return [c.copy(deep=True) for c in customers]
+
+
+async def update_customer_profiles(
+    profiles: dict[str, tuple[int, CustomerProfile]],
+) -> None:
+    """
+    Save the profiles (public_key -> (event_created_at, profile)).
+    A profile older than the saved one is ignored.
+    """
+    async with unit_of_work() as conn:
+        for public_key, (event_created_at, profile) in profiles.items():
+            await conn.execute(
+                """
+                INSERT INTO nostrmarket.customer_profiles AS p
+                       (public_key, event_created_at, meta)
+                VALUES (:public_key, :event_created_at, :meta)
+                ON CONFLICT (public_key) DO UPDATE
+                SET event_created_at = excluded.event_created_at,
+                    meta = excluded.meta
+                WHERE p.event_created_at < excluded.event_created_at
+                """,
+                {
+                    "public_key": public_key,
+                    "event_created_at": event_created_at,
+                    "meta": json.dumps(profile.dict()),
+                },
+            )
+    # profiles are shared by all merchants
+    customers_cache.clear()
 
 
-async def get_all_unique_customers() -> list[Customer]:
-    q = """
-            SELECT public_key, MAX(merchant_id) as merchant_id, MAX(event_created_at)
-            FROM nostrmarket.customers
-            GROUP BY public_key
-        """
-    rows: list[dict] = await db.fetchall(q)
-    return [Customer.from_row(row) for row in rows]
+def increment_customer_unread_messages(merchant_id: str, public_key: str):
+    """
+    Nothing is written, the count is computed from `last_read_at`.
+    Only keeps the cached customers list up to date.
+    """
+    for customer in customers_cache.get(merchant_id, []):
+        if customer.public_key == public_key:
+            customer.unread_messages += 1
 
 
-async def update_customer_profile(
-    public_key: str, event_created_at: int, profile: CustomerProfile
-):
+async def update_customer_no_unread_messages(merchant_id: str, public_key: str):
     await db.execute(
         """
         UPDATE nostrmarket.customers
-        SET event_created_at = :event_created_at, meta = :meta
-        WHERE public_key = :public_key
+        SET last_read_at = COALESCE(
+            (
+                SELECT MAX(inserted_at) FROM nostrmarket.direct_messages
+                WHERE merchant_id = :merchant_id AND public_key = :public_key
+                AND incoming = true
+            ),
+            last_read_at
+        )
+        WHERE merchant_id = :merchant_id AND public_key = :public_key
         """,
         {
-            "event_created_at": event_created_at,
-            "meta": json.dumps(profile.dict()),
+            "merchant_id": merchant_id,
             "public_key": public_key,
         },
     )
+    for customer in customers_cache.get(merchant_id, []):
+        if customer.public_key == public_key:
+            customer.unread_messages = 0
 
 
-async def increment_customer_unread_messages(merchant_id: str, public_key: str):
+async def delete_merchant_customers(merchant_id: str) -> None:
     await db.execute(
+        "DELETE FROM nostrmarket.customers WHERE merchant_id = :merchant_id",
+        {"merchant_id": merchant_id},
+    )
+    customers_cache.pop(merchant_id)
+
+
+######################################## JOBS ##########################################
+
+
+async def create_job(
+    merchant_id: str,
+    kind: str,
+    total: int = 0,
+    conn: Connection | None = None,
+    user_id: str | None = None,
+    cursor: str | None = None,
+) -> Job:
+    job = Job(
+        id=urlsafe_short_hash(),
+        merchant_id=merchant_id,
+        kind=kind,
+        total=total,
+        updated_at=int(time.time()),
+        user_id=user_id,
+        cursor=cursor,
+    )
+    await (conn or db).execute(
         """
-        UPDATE nostrmarket.customers
-        SET unread_messages = unread_messages + 1
-        WHERE merchant_id = :merchant_id AND public_key = :public_key
+        INSERT INTO nostrmarket.jobs
+               (id, merchant_id, kind, status, cursor, progress, total, errors,
+                updated_at, user_id)
+        VALUES (:id, :merchant_id, :kind, :status, :cursor, 0, :total, 0,
+                :updated_at, :user_id)
         """,
         {
-            "merchant_id": merchant_id,
-            "public_key": public_key,
+            "id": job.id,
+            "merchant_id": job.merchant_id,
+            "kind": job.kind,
+            "status": job.status,
+            "total": job.total,
+            "updated_at": job.updated_at,
+            "user_id": job.user_id,
+            "cursor": job.cursor,
         },
     )
+    return job
 
 
-# ??? two merchants
-async def update_customer_no_unread_messages(merchant_id: str, public_key: str):
+async def get_job(merchant_id: str, job_id: str) -> Job | None:
+    row: dict = await db.fetchone(
+        "SELECT * FROM nostrmarket.jobs WHERE merchant_id = :merchant_id AND id = :id",
+        {"merchant_id": merchant_id, "id": job_id},
+    )
+    return Job.from_row(row) if row else None
+
+
+async def get_last_job(merchant_id: str, kind: str) -> Job | None:
+    row: dict = await db.fetchone(
+        """
+        SELECT * FROM nostrmarket.jobs
+        WHERE merchant_id = :merchant_id AND kind = :kind
+        ORDER BY updated_at DESC LIMIT 1
+        """,
+        {"merchant_id": merchant_id, "kind": kind},
+    )
+    return Job.from_row(row) if row else None
+
+
+async def get_unfinished_jobs() -> list[Job]:
+    rows: list[dict] = await db.fetchall(
+        """
+        SELECT * FROM nostrmarket.jobs
+        WHERE status IN (:pending, :running) ORDER BY updated_at
+        """,
+        {"pending": JobStatus.PENDING.value, "running": JobStatus.RUNNING.value},
+    )
+    return [Job.from_row(row) for row in rows]
+
+
+async def update_job(job: Job) -> Job:
+    job.updated_at = int(time.time())
     await db.execute(
         """
-        UPDATE nostrmarket.customers
-        SET unread_messages = 0
-        WHERE merchant_id = :merchant_id AND public_key = :public_key
+        UPDATE nostrmarket.jobs
+        SET status = :status, cursor = :cursor, progress = :progress,
+            total = :total, errors = :errors, message = :message,
+            updated_at = :updated_at
+        WHERE id = :id
         """,
         {
-            "merchant_id": merchant_id,
-            "public_key": public_key,
+            "id": job.id,
+            "status": job.status,
+            "cursor": job.cursor,
+            "progress": job.progress,
+            "total": job.total,
+            "errors": job.errors,
+            "message": job.message,
+            "updated_at": job.updated_at,
         },
     )
+    return job
+
+
+async def delete_merchant_jobs(
+    merchant_id: str, keep_job_id: str = "", conn: Connection | None = None
+) -> None:
+    await (conn or db).execute(
+        """
+        DELETE FROM nostrmarket.jobs
+        WHERE merchant_id = :merchant_id AND id != :keep_job_id
+        """,
+        {"merchant_id": merchant_id, "keep_job_id": keep_job_id},
+    )
+
+
+######################################## ARCHIVE #######################################
+
+# direct messages and completed (shipped or expired) orders older than this are
+# moved to the (compressed) archive tables
+ARCHIVE_AFTER_SECONDS = 90 * 24 * 60 * 60
+
+
+def _maybe_archived(event_created_at: int | None) -> bool:
+    """Only events older than the archive cutoff can be in the archive."""
+    if event_created_at is None:
+        return False
+    return event_created_at < time.time() - ARCHIVE_AFTER_SECONDS
+
+
+async def archive_direct_messages(created_before: int, limit: int) -> int:
+    """
+    Move (at most `limit`) messages older than `created_before` to the archive.
+    Returns the number of archived messages.
+    """
+    async with unit_of_work() as conn:
+        rows: list[dict] = await conn.fetchall(
+            """
+            SELECT * FROM nostrmarket.direct_messages
+            WHERE event_created_at < :created_before
+            ORDER BY event_created_at LIMIT :limit
+            """,
+            {"created_before": created_before, "limit": limit},
+        )
+        for row in rows:
+            await _insert_archive_row(
+                conn,
+                "direct_messages_archive",
+                row,
+                DirectMessage.from_row(row),
+                {"type": row["type"], "incoming": row["incoming"]},
+            )
+        await _delete_rows(conn, "direct_messages", [row["id"] for row in rows])
+
+    # the unread counts might change
+    for merchant_id in {row["merchant_id"] for row in rows}:
+        customers_cache.pop(merchant_id)
+    return len(rows)
+
+
+async def archive_orders(created_before: int, limit: int) -> int:
+    """
+    Move (at most `limit`) shipped or expired orders older than
+    `created_before` to the archive. Returns the number of archived orders.
+    """
+    async with unit_of_work() as conn:
+        rows: list[dict] = await conn.fetchall(
+            """
+            SELECT * FROM nostrmarket.orders
+            WHERE event_created_at < :created_before
+                  AND ((paid = true AND shipped = true) OR expired = true)
+            ORDER BY event_created_at LIMIT :limit
+            """,
+            {"created_before": created_before, "limit": limit},
+        )
+        for row in rows:
+            await _insert_archive_row(conn, "orders_archive", row, Order.from_row(row))
+        await _delete_rows(conn, "orders", [row["id"] for row in rows])
+    return len(rows)
+
+
+async def _insert_archive_row(
+    conn, table: str, row: dict, item: BaseModel, lookup: dict | None = None
+):
+    """lookup: the columns, other than the common ones, kept as such."""
+    lookup = lookup or {}
+    columns = ", ".join(lookup)
+    keys = ", ".join(f":{c}" for c in lookup)
+    await conn.execute(
+        f"""
+        INSERT INTO nostrmarket.{table}
+        (merchant_id, id, event_id, event_created_at, public_key, data
+         {", " + columns if lookup else ""})
+        VALUES
+        (:merchant_id, :id, :event_id, :event_created_at, :public_key, :data
+         {", " + keys if lookup else ""})
+        ON CONFLICT(id) DO NOTHING
+        """,
+        {
+            "merchant_id": row["merchant_id"],
+            "id": row["id"],
+            "event_id": row["event_id"],
+            "event_created_at": row["event_created_at"],
+            "public_key": row["public_key"],
+            "data": _pack(item),
+            **lookup,
+        },
+    )
+
+
+async def _delete_rows(conn, table: str, ids: list[str]):
+    if not ids:
+        return
+    keys = []
+    values = {}
+    for i, id_ in enumerate(ids):
+        key = f"id_{i}"
+        keys.append(f":{key}")
+        values[key] = id_
+    await conn.execute(
+        f"DELETE FROM nostrmarket.{table} WHERE id IN ({', '.join(keys)})",
+        values,
+    )
+
+
+async def _get_archived_direct_message(
+    merchant_id: str, event_id: str, conn: Connection | None = None
+) -> DirectMessage | None:
+    row: dict = await (conn or db).fetchone(
+        """
+        SELECT data FROM nostrmarket.direct_messages_archive
+        WHERE merchant_id = :merchant_id AND event_id = :event_id
+        """,
+        {"merchant_id": merchant_id, "event_id": event_id},
+    )
+    return _unpack(DirectMessage, row["data"]) if row else None
+
+
+async def _get_archived_event_ids(
+    conn, merchant_events: list[tuple[str, str]]
+) -> set[tuple[str, str]]:
+    """Which of the (merchant_id, event_id) pairs are in the archive."""
+    if not merchant_events:
+        return set()
+    conditions = []
+    values = {}
+    for i, (merchant_id, event_id) in enumerate(merchant_events):
+        conditions.append(
+            f"(merchant_id = :merchant_id_{i} AND event_id = :event_id_{i})"
+        )
+        values[f"merchant_id_{i}"] = merchant_id
+        values[f"event_id_{i}"] = event_id
+    rows: list[dict] = await conn.fetchall(
+        f"""
+        SELECT merchant_id, event_id FROM nostrmarket.direct_messages_archive
+        WHERE {" OR ".join(conditions)}
+        """,
+        values,
+    )
+    return {(row["merchant_id"], row["event_id"]) for row in rows}
+
+
+async def _get_archived_order(
+    merchant_id: str, field: str, value: str, conn: Connection | None = None
+) -> Order | None:
+    row: dict = await (conn or db).fetchone(
+        f"""
+        SELECT data FROM nostrmarket.orders_archive
+        WHERE merchant_id = :merchant_id AND {field} = :value
+        """,
+        {"merchant_id": merchant_id, "value": value},
+    )
+    return _unpack(Order, row["data"]) if row else None
+
+
+async def _get_archived_orders(merchant_id: str, **kwargs) -> list[Order]:
+    values = {"merchant_id": merchant_id}
+    public_key = kwargs.pop("public_key", None)
+    if public_key:
+        values["public_key"] = public_key
+    rows: list[dict] = await db.fetchall(
+        f"""
+        SELECT data FROM nostrmarket.orders_archive
+        WHERE merchant_id = :merchant_id
+        {"AND public_key = :public_key" if public_key else ""}
+        """,
+        values,
+    )
+    orders = [_unpack(Order, row["data"]) for row in rows]
+    # only the lookup columns are stored as such, filter on the rest here
+    filters = {k: v for k, v in kwargs.items() if v is not None}
+    return [o for o in orders if all(getattr(o, k) == v for k, v in filters.items())]
+
+
+def _pack(item: BaseModel) -> str:
+    return base64.b64encode(zlib.compress(item.json().encode())).decode()
+
+
+def _unpack(cls, data: str):
+    return cls.parse_raw(zlib.decompress(base64.b64decode(data)))
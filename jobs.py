@@ -0,0 +1,57 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+
+from loguru import logger
+
+from .crud import update_job
+from .models import Job, JobStatus
+
+JobRunner = Callable[[Job], Awaitable[None]]
+
+# running jobs (and their tasks) by id. Keeps a reference to the tasks and
+# avoids double starts.
+running_jobs: dict[str, tuple[Job, asyncio.Task]] = {}
+
+
+def start_job(job: Job, runner: JobRunner):
+    """
+    Run the job in the background. The runner must update the job progress
+    (and cursor) as it goes, so it can be resumed if interrupted.
+    """
+    if job.id in running_jobs:
+        return
+    task = asyncio.create_task(_run_job(job, runner))
+    running_jobs[job.id] = (job, task)
+    task.add_done_callback(lambda _: running_jobs.pop(job.id, None))
+
+
+async def _run_job(job: Job, runner: JobRunner):
+    try:
+        job.status = JobStatus.RUNNING.value
+        await update_job(job)
+        await runner(job)
+        job.status = JobStatus.DONE.value
+    except asyncio.CancelledError:
+        # left as running, it is resumed on the next start
+        raise
+    except Exception as ex:
+        logger.warning(f"Job '{job.kind}' ({job.id}) failed: {ex}")
+        job.status = JobStatus.FAILED.value
+        job.message = str(ex)
+    await update_job(job)
+
+
+def stop_jobs():
+    """Cancel the running jobs, they are resumed on the next start."""
+    for _, task in list(running_jobs.values()):
+        task.cancel()
+
+
+async def stop_merchant_jobs(merchant_id: str):
+    """Cancel the running jobs of the merchant and wait until they stopped."""
+    tasks = [
+        task for job, task in running_jobs.values() if job.merchant_id == merchant_id
+    ]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
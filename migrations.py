@@ -1,3 +1,14 @@
+import json
+
+
+async def _create_index(db, name: str, table: str, columns: str):
+    """Create an index in the extension schema, the syntax differs on SQLite."""
+    if db.type == "SQLITE":
+        await db.execute(f"CREATE INDEX nostrmarket.{name} ON {table} ({columns})")
+    else:
+        await db.execute(f"CREATE INDEX {name} ON nostrmarket.{table} ({columns})")
+
+
 async def m001_initial(db):
     """
     Initial merchants table.
@@ -189,3 +200,308 @@ async def m005_update_product_activation(db):
         ADD COLUMN active BOOLEAN NOT NULL DEFAULT true;
         """
     )
+
+
+async def m006_create_outbox(db):
+    """
+    Signed events waiting to be published (or acknowledged) by the relays.
+    """
+    await db.execute(
+        """
+        CREATE TABLE nostrmarket.outbox (
+            event_id TEXT PRIMARY KEY,
+            merchant_id TEXT NOT NULL,
+            event TEXT NOT NULL,
+            event_created_at INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_sent_at INTEGER NOT NULL DEFAULT 0,
+            acked BOOLEAN NOT NULL DEFAULT false
+        );
+        """
+    )
+
+    await _create_index(db, "idx_outbox_pending", "outbox", "acked, event_created_at")
+
+
+async def m007_create_sync_state(db):
+    """
+    Last seen event `created_at` per merchant and per nostr event kind.
+    """
+    await db.execute(
+        """
+        CREATE TABLE nostrmarket.sync_state (
+            merchant_id TEXT NOT NULL,
+            kind INTEGER NOT NULL,
+            last_created_at INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (merchant_id, kind)
+        );
+        """
+    )
+
+    for kind, table in [(4, "direct_messages"), (30017, "stalls"), (30018, "products")]:
+        await db.execute(
+            f"""
+            INSERT INTO nostrmarket.sync_state (merchant_id, kind, last_created_at)
+            SELECT merchant_id, {kind}, MAX(event_created_at)
+            FROM nostrmarket.{table}
+            WHERE event_created_at IS NOT NULL
+            GROUP BY merchant_id
+            """
+        )
+
+
+async def m008_create_customer_profiles(db):
+    """
+    One profile (nostr kind 0) per public key, shared by all merchants.
+    """
+    await db.execute(
+        """
+        CREATE TABLE nostrmarket.customer_profiles (
+            public_key TEXT PRIMARY KEY,
+            event_created_at INTEGER NOT NULL DEFAULT 0,
+            meta TEXT NOT NULL DEFAULT '{}'
+        );
+        """
+    )
+
+    # keep the most recent profile of each customer
+    await db.execute(
+        """
+        INSERT INTO nostrmarket.customer_profiles (public_key, event_created_at, meta)
+        SELECT c.public_key, c.event_created_at, MAX(c.meta)
+        FROM nostrmarket.customers c
+        WHERE c.event_created_at = (
+            SELECT MAX(event_created_at) FROM nostrmarket.customers
+            WHERE public_key = c.public_key
+        )
+        GROUP BY c.public_key, c.event_created_at
+        """
+    )
+
+
+async def m009_add_customer_last_read_at(db):
+    """
+    Unread messages are counted from the last time the chat was read,
+    instead of being incremented for every message. The watermark is on the
+    insert order of the messages (`inserted_at`, in microseconds), not on
+    their `event_created_at`: a message can arrive late.
+    """
+    await db.execute(
+        """
+        ALTER TABLE nostrmarket.direct_messages
+        ADD COLUMN inserted_at BIGINT NOT NULL DEFAULT 0;
+        """
+    )
+    await db.execute(
+        """
+        UPDATE nostrmarket.direct_messages
+        SET inserted_at = COALESCE(event_created_at, 0) * 1000000
+        """
+    )
+    await db.execute(
+        """
+        ALTER TABLE nostrmarket.customers
+        ADD COLUMN last_read_at BIGINT NOT NULL DEFAULT 0;
+        """
+    )
+
+    # keep the current unread counts: the chat was read just before them
+    customers = await db.fetchall(
+        "SELECT merchant_id, public_key, unread_messages FROM nostrmarket.customers"
+    )
+    for customer in customers:
+        unread_messages = max(customer["unread_messages"], 0)
+        messages = await db.fetchall(
+            """
+            SELECT inserted_at FROM nostrmarket.direct_messages
+            WHERE merchant_id = :merchant_id AND public_key = :public_key
+            AND incoming = true
+            ORDER BY inserted_at DESC LIMIT :limit
+            """,
+            {
+                "merchant_id": customer["merchant_id"],
+                "public_key": customer["public_key"],
+                "limit": unread_messages + 1,
+            },
+        )
+        if len(messages) <= unread_messages:
+            continue
+        await db.execute(
+            """
+            UPDATE nostrmarket.customers SET last_read_at = :last_read_at
+            WHERE merchant_id = :merchant_id AND public_key = :public_key
+            """,
+            {
+                "last_read_at": messages[unread_messages]["inserted_at"],
+                "merchant_id": customer["merchant_id"],
+                "public_key": customer["public_key"],
+            },
+        )
+
+    # used by the unread messages count of every customer
+    await _create_index(
+        db,
+        "idx_messages_conversation",
+        "direct_messages",
+        "merchant_id, public_key, incoming, inserted_at",
+    )
+
+
+async def m010_create_jobs(db):
+    """
+    Long running background jobs (eg: orders restore), with a checkpoint.
+    """
+    await db.execute(
+        """
+        CREATE TABLE nostrmarket.jobs (
+            id TEXT PRIMARY KEY,
+            merchant_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            cursor TEXT,
+            progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            message TEXT,
+            updated_at INTEGER,
+            user_id TEXT
+        );
+        """
+    )
+
+
+async def m011_add_order_expired(db):
+    """
+    Unpaid orders are marked as expired once their invoice expires.
+    """
+    await db.execute(
+        """
+        ALTER TABLE nostrmarket.orders
+        ADD COLUMN expired BOOLEAN NOT NULL DEFAULT false
+        """
+    )
+
+    # used by the expiry sweeper
+    await _create_index(db, "idx_orders_unpaid", "orders", "paid, expired, time")
+
+
+async def m012_create_archive_tables(db):
+    """
+    Old direct messages and completed orders are moved to archive tables.
+    The archived rows are stored compressed, only the lookup columns are kept.
+    """
+    await db.execute(
+        """
+        CREATE TABLE nostrmarket.direct_messages_archive (
+            merchant_id TEXT NOT NULL,
+            id TEXT PRIMARY KEY,
+            event_id TEXT,
+            event_created_at INTEGER NOT NULL,
+            public_key TEXT NOT NULL,
+            type INTEGER NOT NULL DEFAULT -1,
+            incoming BOOLEAN NOT NULL DEFAULT false,
+            data TEXT NOT NULL,
+            UNIQUE(event_id)
+        );
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE nostrmarket.orders_archive (
+            merchant_id TEXT NOT NULL,
+            id TEXT PRIMARY KEY,
+            event_id TEXT,
+            event_created_at INTEGER NOT NULL,
+            public_key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            UNIQUE(event_id)
+        );
+        """
+    )
+
+    await _create_index(
+        db,
+        "idx_messages_archive_conversation",
+        "direct_messages_archive",
+        "merchant_id, public_key, event_created_at",
+    )
+    await _create_index(
+        db,
+        "idx_orders_archive_merchant",
+        "orders_archive",
+        "merchant_id, event_created_at",
+    )
+
+
+async def m013_add_outbox_priority(db):
+    """
+    Direct messages in the outbox are (re)sent before catalog events, order
+    messages before the chat ones. Values of `nostr/send_queue.py`.
+    """
+    await db.execute(
+        """
+        ALTER TABLE nostrmarket.outbox
+        ADD COLUMN priority INTEGER NOT NULL DEFAULT 3
+        """
+    )
+    # the kind is read from the event, the message type from the saved message
+    rows = await db.fetchall(
+        """
+        SELECT o.event_id, o.event, d.type FROM nostrmarket.outbox o
+        LEFT JOIN nostrmarket.direct_messages d ON d.event_id = o.event_id
+        """
+    )
+    for row in rows:
+        if json.loads(row["event"]).get("kind") != 4:
+            continue
+        # payment request or order status update: 0, chat: 1
+        priority = 0 if row["type"] in (1, 2) else 1
+        await db.execute(
+            """
+            UPDATE nostrmarket.outbox SET priority = :priority
+            WHERE event_id = :event_id
+            """,
+            {"priority": priority, "event_id": row["event_id"]},
+        )
+
+    # the schema qualified name works on both SQLite and Postgres
+    await db.execute("DROP INDEX IF EXISTS nostrmarket.idx_outbox_pending")
+    await _create_index(
+        db, "idx_outbox_pending", "outbox", "acked, priority, event_created_at"
+    )
+
+
+async def m014_create_events(db):
+    """
+    Append-only store of the raw (signature checked) nostr events received
+    from the relays, to re-apply them without asking the relays again.
+    The `p` tags are kept in their own table, one row per tag, to find the
+    events sent to a merchant.
+    """
+    await db.execute(
+        """
+        CREATE TABLE nostrmarket.events (
+            id TEXT PRIMARY KEY,
+            pubkey TEXT NOT NULL,
+            kind INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            event TEXT NOT NULL
+        );
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE nostrmarket.event_p_tags (
+            event_id TEXT NOT NULL,
+            p_tag TEXT NOT NULL,
+            kind INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (event_id, p_tag)
+        );
+        """
+    )
+
+    await _create_index(db, "idx_events_pubkey", "events", "pubkey, kind, created_at")
+    await _create_index(
+        db, "idx_event_p_tags", "event_p_tags", "p_tag, kind, created_at"
+    )
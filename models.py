@@ -42,11 +42,25 @@ class MerchantProfile(BaseModel):
     lud16: str | None = None
 
 
+class IncomingDmQuotas(BaseModel):
+    """Limits for the live direct messages a merchant receives."""
+
+    # messages per second (and at once) from the same sender
+    sender_rate: float = 1
+    sender_burst: int = 20
+    # messages per second (and at once) from senders that are not customers yet
+    new_customer_rate: float = 5
+    new_customer_burst: int = 50
+    # NIP-13 proof of work (bits) required for the first message, 0 to disable
+    new_customer_pow: int = 0
+
+
 class MerchantConfig(MerchantProfile):
     event_id: str | None = None
     sync_from_nostr: bool = False
     active: bool = False
     restore_in_progress: bool | None = False
+    dm_quotas: IncomingDmQuotas = IncomingDmQuotas()
 
 
 class PartialMerchant(BaseModel):
@@ -70,11 +84,13 @@ class Merchant(PartialMerchant, Nostrable):
         encryption_key = get_shared_secret(self.private_key, public_key)
         return encrypt_message(clear_text_message, encryption_key)
 
-    def build_dm_event(self, message: str, to_pubkey: str) -> NostrEvent:
+    def build_dm_event(
+        self, message: str, to_pubkey: str, created_at: int | None = None
+    ) -> NostrEvent:
         content = self.encrypt_message(message, to_pubkey)
         event = NostrEvent(
             pubkey=self.public_key,
-            created_at=round(time.time()),
+            created_at=created_at or round(time.time()),
             kind=4,
             tags=[["p", to_pubkey]],
             content=content,
@@ -137,6 +153,16 @@ class Merchant(PartialMerchant, Nostrable):
         return delete_event
 
 
+class MerchantSyncState(BaseModel):
+    """Progress of the initial (historical) sync of the merchant events."""
+
+    events_count: int = 0
+    events_per_second: float = 0
+    started_at: int | None = None
+    done: bool = True
+    done_at: int | None = None
+
+
 ######################################## ZONES ########################################
 class Zone(BaseModel):
     id: str | None = None
@@ -180,14 +206,17 @@ class Stall(BaseModel, Nostrable):
                     f"Sipping zone '{z.name}' has different currency than stall."
                 )
 
-    def to_nostr_event(self, pubkey: str) -> NostrEvent:
-        content = {
+    def nostr_content(self) -> dict:
+        return {
             "id": self.id,
             "name": self.name,
             "description": self.config.description,
             "currency": self.currency,
             "shipping": [dict(z) for z in self.shipping_zones],
         }
+
+    def to_nostr_event(self, pubkey: str) -> NostrEvent:
+        content = self.nostr_content()
         assert self.id
         event = NostrEvent(
             pubkey=pubkey,
@@ -252,8 +281,8 @@ class Product(BaseModel, Nostrable):
     event_id: str | None = None
     event_created_at: int | None = None
 
-    def to_nostr_event(self, pubkey: str) -> NostrEvent:
-        content = {
+    def nostr_content(self) -> dict:
+        return {
             "id": self.id,
             "stall_id": self.stall_id,
             "name": self.name,
@@ -265,6 +294,9 @@ class Product(BaseModel, Nostrable):
             "active": self.active,
             "shipping": [dict(s) for s in self.config.shipping or []],
         }
+
+    def to_nostr_event(self, pubkey: str) -> NostrEvent:
+        content = self.nostr_content()
         categories = [["t", tag] for tag in self.categories]
 
         assert self.id
@@ -338,11 +370,14 @@ class OrderExtra(BaseModel):
     fail_message: str | None = None
 
     @classmethod
-    async def from_products(cls, products: list[Product]):
+    async def from_products(
+        cls, products: list[Product], exchange_rate: float | None = None
+    ):
         currency = products[0].config.currency if len(products) else "sat"
-        exchange_rate = (
-            await btc_price(currency) if currency and currency != "sat" else 1
-        )
+        if exchange_rate is None:
+            exchange_rate = (
+                await btc_price(currency) if currency and currency != "sat" else 1
+            )
 
         products_overview = [ProductOverview.from_product(p) for p in products]
         return OrderExtra(
@@ -466,6 +501,7 @@ class Order(PartialOrder):
     total: float
     paid: bool = False
     shipped: bool = False
+    expired: bool = False
     time: int | None = None
     extra: OrderExtra
 
@@ -536,6 +572,8 @@ class PartialDirectMessage(BaseModel):
 
 class DirectMessage(PartialDirectMessage):
     id: str
+    # insert order, in microseconds (see `crud._insert_time()`)
+    inserted_at: int | None = None
 
     @classmethod
     def from_row(cls, row: dict) -> "DirectMessage":
@@ -564,3 +602,40 @@ class Customer(BaseModel):
             CustomerProfile(**json.loads(row["meta"])) if "meta" in row else None
         )
         return customer
+
+
+######################################## JOBS ##########################################
+
+
+class JobStatus(Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class Job(BaseModel):
+    """Long running background work, resumed after a restart."""
+
+    id: str
+    merchant_id: str
+    kind: str
+    status: str = JobStatus.PENDING.value
+    # where to resume from, the format depends on the job kind. The merchant
+    # delete job keeps the merchant public key, the merchant row is gone.
+    cursor: str | None = None
+    progress: int = 0
+    total: int = 0
+    errors: int = 0
+    message: str | None = None
+    updated_at: int | None = None
+    # the user that started it, when the merchant might no longer exist
+    user_id: str | None = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in [JobStatus.DONE.value, JobStatus.FAILED.value]
+
+    @classmethod
+    def from_row(cls, row: dict) -> "Job":
+        return cls(**row)
@@ -47,6 +47,20 @@ class NostrEvent(BaseModel):
         if not valid_signature:
             raise ValueError(f"Invalid signature: '{self.sig}' for event '{self.id}'")
 
+    def pow_difficulty(self) -> int:
+        """
+        NIP-13 proof of work: leading zero bits of the event id. If the event
+        commits to a lower target difficulty (`nonce` tag), that one is used.
+        """
+        event_id = self.event_id
+        if self.id != event_id:
+            return 0
+        difficulty = 256 - int(event_id, 16).bit_length()
+        for tag in self.tags:
+            if tag[0] == "nonce" and len(tag) > 2 and tag[2].isdigit():
+                difficulty = min(difficulty, int(tag[2]))
+        return difficulty
+
     def stringify(self) -> str:
         return json.dumps(dict(self))
 
@@ -0,0 +1,135 @@
+import asyncio
+import inspect
+import sys
+from asyncio import Queue
+from typing import Awaitable, Callable, List, Optional
+
+from loguru import logger
+from starlette.websockets import WebSocketDisconnect
+
+
+# where LNbits loads the 'nostrclient' extension from (current, older versions)
+NOSTRCLIENT_PACKAGES = ["nostrclient", "lnbits.extensions.nostrclient"]
+
+# What is used of nostrclient's `NostrRouter`. It has no public API for
+# in-process clients, so the interface is checked before it is used and the
+# localhost websocket is used when it does not match:
+#   - `NostrRouter(websocket)`, `start()` and `stop()` (sync or async)
+#   - `connected`: False once the router stopped
+#   - `all_routers`: the open routers, stopped when nostrclient stops
+ROUTER_METHODS = ["start", "stop"]
+
+
+def find_nostr_router_class() -> Optional[type]:
+    """
+    The `NostrRouter` class of the 'nostrclient' extension, if that extension
+    is loaded in this process (it is never imported from here) and has the
+    expected interface.
+    """
+    for package in NOSTRCLIENT_PACKAGES:
+        module = sys.modules.get(f"{package}.router")
+        router_class = getattr(module, "NostrRouter", None)
+        if not router_class:
+            continue
+        missing = [
+            m for m in ROUTER_METHODS if not callable(getattr(router_class, m, None))
+        ]
+        if missing:
+            logger.warning(
+                f"Unexpected 'nostrclient' NostrRouter (no {', '.join(missing)})."
+                " Using the websocket."
+            )
+            return None
+        return router_class
+    return None
+
+
+def find_nostr_routers() -> Optional[list]:
+    """The list where 'nostrclient' keeps its open routers, if found."""
+    for package in NOSTRCLIENT_PACKAGES:
+        for name in [f"{package}.router", f"{package}.views_api", package]:
+            routers = getattr(sys.modules.get(name), "all_routers", None)
+            if isinstance(routers, list):
+                return routers
+    return None
+
+
+class LocalConnection:
+    """
+    In-process connection to the 'nostrclient' extension.
+
+    It stands in for both ends of the localhost websocket: `NostrClient` uses
+    it like a `WebSocketApp` (`send()`, `close()`, `keep_running`) and the
+    nostrclient `NostrRouter` like a starlette `WebSocket` (`receive_text()`,
+    `send_text()`). Messages are passed over an asyncio queue, so there is no
+    socket, no ASGI server and no extra thread in between. Frames stay JSON
+    text, the only format the router accepts and produces: each one is still
+    serialized once and parsed once, as over the websocket.
+    """
+
+    def __init__(
+        self, router_class: type, on_message: Callable[[str], Awaitable[None]]
+    ):
+        self._on_message = on_message
+        # messages for nostrclient, `None` closes the connection
+        self._outgoing: Queue = Queue()
+        self._open = False
+        self._tasks: List[asyncio.Task] = []
+        self.router = router_class(self)
+        self._routers = find_nostr_routers()
+
+    async def open(self):
+        started = self.router.start()
+        if inspect.isawaitable(started):
+            await started
+        if not isinstance(getattr(self.router, "connected", None), bool):
+            await self._stop_router()
+            raise TypeError("'nostrclient' NostrRouter has no 'connected' flag")
+        if self._routers is not None:
+            # stopped (and dropped) with the other routers when nostrclient stops
+            self._routers.append(self.router)
+        self._open = True
+
+    @property
+    def keep_running(self) -> bool:
+        return self._open and self.router.connected
+
+    # `WebSocketApp` side, used by `NostrClient`
+
+    def send(self, data: str):
+        if not self.keep_running:
+            raise ConnectionError("Local connection to 'nostrclient' is closed.")
+        self._outgoing.put_nowait(data)
+
+    def close(self):
+        if not self._open:
+            return
+        self._open = False
+        self._outgoing.put_nowait(None)
+        task = asyncio.create_task(self._stop_router())
+        self._tasks.append(task)
+        task.add_done_callback(self._tasks.remove)
+
+    async def _stop_router(self):
+        if self._routers is not None and self.router in self._routers:
+            self._routers.remove(self.router)
+        try:
+            stopped = self.router.stop()
+            if inspect.isawaitable(stopped):
+                await stopped
+        except Exception as ex:
+            logger.warning(f"Failed to stop 'nostrclient' router: {ex}")
+
+    # starlette `WebSocket` side, used by the nostrclient `NostrRouter`
+
+    async def accept(self, *_, **__):
+        pass
+
+    async def receive_text(self) -> str:
+        data = await self._outgoing.get()
+        if data is None:
+            raise WebSocketDisconnect()
+        return data
+
+    async def send_text(self, data: str):
+        await self._on_message(data)
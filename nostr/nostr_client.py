@@ -1,8 +1,11 @@
 import asyncio
 import json
+import re
+import time
 from asyncio import Queue
+from collections import deque
 from threading import Thread
-from typing import Callable, List, Optional
+from typing import Callable, Dict, List, Optional, Union
 
 from loguru import logger
 from websocket import WebSocketApp
@@ -11,15 +14,91 @@ from lnbits.settings import settings
 from lnbits.helpers import encrypt_internal_message, urlsafe_short_hash
 
 from .event import NostrEvent
+from .local_connection import LocalConnection, find_nostr_router_class
+from .send_queue import PrioritySendQueue
+from .subscription import MerchantSubscription, TempSubscription
+
+
+# Nostr event kinds that can be dropped when the client is under pressure.
+# Profiles are refreshed periodically, so losing a few of them is harmless.
+LOW_PRIORITY_KINDS = [0]
+
+# matches the frame type and the subscription id: ["EVENT", "sub_id", ...
+FRAME_HEADER = re.compile(r'^\[\s*"(\w+)"\s*,\s*"([^"]*)"')
 
 
 class NostrClient:
-    def __init__(self):
-        self.recieve_event_queue: Queue = Queue()
-        self.send_req_queue: Queue = Queue()
-        self.ws: Optional[WebSocketApp] = None
-        self.subscription_id = "nostrmarket-" + urlsafe_short_hash()[:32]
+    def __init__(
+        self,
+        max_received_events: int = 10_000,
+        max_pending_requests: int = 1_000,
+        max_retry_events: int = 1_000,
+        shed_high_water_mark: float = 0.8,
+        cursor_window: int = 60 * 60,
+        max_filter_keys: int = 250,
+        eose_timeout: int = 60,
+        max_subscription_attempts: int = 3,
+        max_temp_subscriptions: int = 10,
+        temp_subscription_timeout: int = 30,
+        schedule_interval: int = 3,
+        in_process: bool = True,
+    ):
+        """
+        max_received_events: capacity of the incoming queue. When full, the
+            websocket reader thread blocks until the consumer catches up.
+        max_pending_requests: capacity of the outgoing queue, per priority
+            class (order messages, chat, REQ/CLOSE, other events). When a class
+            is full, its publishers block until the sender catches up.
+        max_retry_events: capacity, per priority class, of the buffer that
+            keeps outgoing events which could not be sent (eg: websocket
+            down). Oldest are dropped.
+        shed_high_water_mark: fill ratio of the incoming queue above which
+            low priority events (see LOW_PRIORITY_KINDS) are dropped.
+        cursor_window: merchants whose sync cursors are less than this many
+            seconds apart share the same subscription.
+        max_filter_keys: maximum number of public keys in a single subscription.
+            Larger merchant sets are split into several subscriptions (shards).
+        eose_timeout: seconds to wait for a subscription to get an answer
+            (EOSE or events) before sending it again.
+        max_subscription_attempts: how many times a subscription is sent
+            before giving up on it.
+        max_temp_subscriptions: maximum number of temporary subscriptions
+            (eg: profile lookups) open at the same time. Others wait their turn.
+        temp_subscription_timeout: temporary subscriptions are closed on EOSE,
+            or after this many seconds if no EOSE is received.
+        schedule_interval: how often (seconds) pending profile lookups are
+            batched and temporary subscriptions are sent.
+        in_process: talk to the 'nostrclient' extension directly when it is
+            loaded in the same process. Falls back to the localhost websocket.
+        """
+        self.recieve_event_queue: Queue = Queue(maxsize=max_received_events)
+        self.send_req_queue = PrioritySendQueue(
+            maxsize=max_pending_requests, max_retries=max_retry_events
+        )
+        self.shed_threshold = int(max_received_events * shed_high_water_mark)
+        self.shed_events_count = 0
+        self.dropped_retry_events_count = 0
+        # incremented on every (re)connect
+        self.connection_count = 0
+        self.ws: Optional[Union[WebSocketApp, LocalConnection]] = None
+        # active merchant subscriptions (shards) by subscription id
+        self.merchant_subscriptions: Dict[str, MerchantSubscription] = {}
+        self.cursor_window = cursor_window
+        self.max_filter_keys = max_filter_keys
+        self.eose_timeout = eose_timeout
+        self.max_subscription_attempts = max_subscription_attempts
+        # temporary subscriptions by subscription id
+        self.temp_subscriptions: Dict[str, TempSubscription] = {}
+        # filters waiting for a free temporary subscription slot
+        self.pending_temp_filters: deque = deque()
+        # public keys whose profile (kind 0) must be fetched
+        self.pending_profile_lookups: set = set()
+        self.max_temp_subscriptions = max_temp_subscriptions
+        self.temp_subscription_timeout = temp_subscription_timeout
+        self.schedule_interval = schedule_interval
+        self.in_process = in_process
         self.running = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
 
     @property
     def is_websocket_connected(self):
@@ -27,6 +106,25 @@ class NostrClient:
             return False
         return self.ws.keep_running
 
+    async def connect(self) -> Union[WebSocketApp, LocalConnection]:
+        router_class = find_nostr_router_class() if self.in_process else None
+        if router_class:
+            try:
+                connection = LocalConnection(router_class, self._receive_local)
+                await connection.open()
+                logger.info("Connected to 'nostrclient' in process")
+                self.connection_count += 1
+                return connection
+            except Exception as ex:
+                logger.warning(
+                    f"Cannot connect to 'nostrclient' in process ({ex})."
+                    " Using the websocket."
+                )
+        ws = await self.connect_to_nostrclient_ws()
+        # be sure the connection is open
+        await asyncio.sleep(5)
+        return ws
+
     async def connect_to_nostrclient_ws(self) -> WebSocketApp:
         logger.debug(f"Connecting to websockets for 'nostrclient' extension...")
 
@@ -48,31 +146,198 @@ class NostrClient:
 
     async def run_forever(self):
         self.running = True
+        self._loop = asyncio.get_running_loop()
         while self.running:
+            req = None
             try:
-                if not self.is_websocket_connected:
-                    self.ws = await self.connect_to_nostrclient_ws()
-                    # be sure the connection is open
-                    await asyncio.sleep(5)
-
-                req = await self.send_req_queue.get()
+                await self._ensure_connected()
+                priority, req = await self.send_req_queue.get()
+                # the connection might have dropped while waiting
+                await self._ensure_connected()
                 assert self.ws
                 self.ws.send(json.dumps(req))
             except Exception as ex:
                 logger.warning(ex)
+                if req:
+                    self._retry_later(priority, req)
                 await asyncio.sleep(60)
 
+    async def _ensure_connected(self):
+        if self.is_websocket_connected:
+            return
+        if isinstance(self.ws, LocalConnection):
+            # nostrclient dropped the connection: force re-subscribe
+            self._safe_ws_stop()
+            await self.recieve_event_queue.put(ValueError("Local connection closed."))
+        self.ws = await self.connect()
+
     async def get_event(self):
         value = await self.recieve_event_queue.get()
         if isinstance(value, ValueError):
             raise value
+        self._track_subscription(value)
+        await self._track_temp_subscription(value)
         return value
 
-    async def publish_nostr_event(self, e: NostrEvent):
-        await self.send_req_queue.put(["EVENT", e.dict()])
+    async def monitor_subscriptions(self):
+        """
+        Re-send the merchant subscriptions that got no answer or were closed.
+        Send the queued temporary subscriptions and close the stale ones.
+        """
+        while True:
+            await asyncio.sleep(self.schedule_interval)
+            try:
+                self._end_idle_backfills()
+                await self._retry_subscriptions()
+                await self._close_expired_temp_subscriptions()
+                self._schedule_profile_lookups()
+                await self._send_temp_subscriptions()
+            except Exception as ex:
+                logger.warning(ex)
 
-    async def subscribe_merchants(
+    def is_backfilling(self, subscription_id: str) -> bool:
+        """
+        True while the subscription is still receiving stored (historical)
+        events, ie: before its EOSE.
+        """
+        if subscription_id in self.temp_subscriptions:
+            # temporary subscriptions only fetch stored events
+            return True
+        sub = self.merchant_subscriptions.get(subscription_id)
+        return bool(sub and sub.is_backfilling)
+
+    def backfill_state(self, public_key: str) -> Optional[dict]:
+        """Backfill progress of the subscription that covers this merchant."""
+        sub = next(
+            (
+                s
+                for s in self.merchant_subscriptions.values()
+                if public_key in s.public_keys
+            ),
+            None,
+        )
+        if not sub:
+            return None
+        return {
+            "events_count": sub.events_count,
+            "events_per_second": sub.backfill_rate,
+            "started_at": round(sub.sent_at),
+            "done": not sub.is_backfilling,
+            "done_at": round(sub.backfill_done_at) or None,
+        }
+
+    async def publish_nostr_event(self, e: NostrEvent, priority: Optional[int] = None):
+        """priority: see `send_queue`, by default computed from the event kind."""
+        # blocks the publisher if the queue is full (backpressure)
+        await self.send_req_queue.put(["EVENT", e.dict()], priority)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "in_process": isinstance(self.ws, LocalConnection),
+            "received_queue_size": self.recieve_event_queue.qsize(),
+            "send_queue_size": self.send_req_queue.qsize(),
+            "send_queue_sizes": self.send_req_queue.sizes(),
+            "retry_buffer_size": self.send_req_queue.retry_size(),
+            "shed_events": self.shed_events_count,
+            "dropped_retry_events": self.dropped_retry_events_count,
+            "subscriptions": len(self.merchant_subscriptions),
+            "subscriptions_eose": len(
+                [s for s in self.merchant_subscriptions.values() if s.eose]
+            ),
+            "subscriptions_backfilling": len(
+                [s for s in self.merchant_subscriptions.values() if s.is_backfilling]
+            ),
+            "temp_subscriptions": len(self.temp_subscriptions),
+            "pending_temp_subscriptions": len(self.pending_temp_filters),
+            "pending_profile_lookups": len(self.pending_profile_lookups),
+        }
+
+    async def subscribe_merchants(self, merchant_cursors: Dict[str, Dict[int, int]]):
+        """
+        Replace all merchant subscriptions. Used on (re)connect, when the relays
+        have no subscription for us anyway.
+
+        merchant_cursors: merchant public key -> {event kind: last seen created_at}
+
+        Merchants with close DM cursors share a subscription, so that a merchant
+        far behind (eg: a new one) does not force a replay for everybody else.
+        """
+        self.merchant_subscriptions = {}
+        for group in self._group_by_cursor(merchant_cursors):
+            for i in range(0, len(group), self.max_filter_keys):
+                shard = group[i : i + self.max_filter_keys]
+                subscription_id = "nostrmarket-" + urlsafe_short_hash()[:32]
+                await self._subscribe(
+                    subscription_id,
+                    shard,
+                    self._min_cursor(merchant_cursors, shard, 4),
+                    self._min_cursor(merchant_cursors, shard, 30017),
+                    self._min_cursor(merchant_cursors, shard, 30018),
+                    0,
+                )
+
+    def _group_by_cursor(
+        self, merchant_cursors: Dict[str, Dict[int, int]]
+    ) -> List[List[str]]:
+        public_keys = sorted(
+            merchant_cursors, key=lambda pk: merchant_cursors[pk].get(4, 0)
+        )
+        groups: List[List[str]] = []
+        group_start = 0
+        for pk in public_keys:
+            dm_cursor = merchant_cursors[pk].get(4, 0)
+            if not groups or dm_cursor - group_start > self.cursor_window:
+                groups.append([])
+                group_start = dm_cursor
+            groups[-1].append(pk)
+        return groups
+
+    def _min_cursor(
+        self, merchant_cursors: Dict[str, Dict[int, int]], group: List[str], kind: int
+    ) -> int:
+        return min(merchant_cursors[pk].get(kind, 0) for pk in group)
+
+    async def subscribe_merchant(self, public_key: str, since=0):
+        """
+        Add a subscription for one merchant. Existing subscriptions keep streaming.
+        """
+        subscription_id = "merchant-" + urlsafe_short_hash()[:32]
+        await self._subscribe(subscription_id, [public_key], since, since, since, since)
+
+    async def unsubscribe_merchant(self, public_key: str):
+        """
+        Remove one merchant. The other merchants sharing its subscription are
+        re-subscribed starting from now, so the relays do not replay old events.
+        The new subscription is sent before the old one is closed, so no events
+        are missed in between (the duplicates are ignored).
+        """
+        subscription_id = next(
+            (
+                sub_id
+                for sub_id, sub in self.merchant_subscriptions.items()
+                if public_key in sub.public_keys
+            ),
+            None,
+        )
+        if not subscription_id:
+            return
+
+        public_keys = self.merchant_subscriptions.pop(subscription_id).public_keys
+
+        remaining_keys = [pk for pk in public_keys if pk != public_key]
+        if remaining_keys:
+            now = round(time.time())
+            new_subscription_id = "nostrmarket-" + urlsafe_short_hash()[:32]
+            await self._subscribe(
+                new_subscription_id, remaining_keys, now, now, now, now
+            )
+
+        await self.unsubscribe(subscription_id)
+
+    async def _subscribe(
         self,
+        subscription_id: str,
         public_keys: List[str],
         dm_time=0,
         stall_time=0,
@@ -88,51 +353,138 @@ class NostrClient:
             dm_filters + stall_filters + product_filters + profile_filters
         )
 
-        self.subscription_id = "nostrmarket-" + urlsafe_short_hash()[:32]
-        await self.send_req_queue.put(["REQ", self.subscription_id] + merchant_filters)
+        sub = MerchantSubscription(list(public_keys), merchant_filters)
+        await self._send_subscription(subscription_id, sub)
 
         logger.debug(
-            f"Subscribing to events for: {len(public_keys)} keys. New subscription id: {self.subscription_id}"
+            f"Subscribing to events for: {len(public_keys)} keys. New subscription id: {subscription_id}"
         )
 
-    async def merchant_temp_subscription(self, pk, duration=10):
-        dm_filters = self._filters_for_direct_messages([pk], 0)
-        stall_filters = self._filters_for_stall_events([pk], 0)
-        product_filters = self._filters_for_product_events([pk], 0)
-        profile_filters = self._filters_for_user_profile([pk], 0)
+    async def _send_subscription(self, subscription_id: str, sub: MerchantSubscription):
+        sub.sent_at = time.time()
+        sub.attempts += 1
+        sub.events_count = 0
+        sub.last_event_at = 0
+        sub.eose = False
+        sub.backfill_done_at = 0
+        sub.closed_reason = None
+        self.merchant_subscriptions[subscription_id] = sub
+        await self.send_req_queue.put(["REQ", subscription_id] + sub.filters)
+
+    async def _retry_subscriptions(self):
+        now = time.time()
+        for subscription_id, sub in list(self.merchant_subscriptions.items()):
+            if sub.is_alive:
+                continue
+            if sub.closed_reason is None and now - sub.sent_at < self.eose_timeout:
+                continue
+            if sub.attempts >= self.max_subscription_attempts:
+                continue
 
-        merchant_filters = (
-            dm_filters + stall_filters + product_filters + profile_filters
-        )
+            logger.debug(
+                f"Retrying subscription {subscription_id} ({len(sub.public_keys)} keys)."
+                f" Attempt: {sub.attempts + 1}. Closed: '{sub.closed_reason}'"
+            )
+            self.merchant_subscriptions.pop(subscription_id, None)
+            await self.unsubscribe(subscription_id)
+            new_subscription_id = "nostrmarket-" + urlsafe_short_hash()[:32]
+            await self._send_subscription(new_subscription_id, sub)
+
+    def _end_idle_backfills(self):
+        """
+        Not all relays (or proxies) forward EOSE. Consider the backfill done
+        if nothing was received for a while, or if the relays never answered.
+        """
+        now = time.time()
+        for subscription_id, sub in self.merchant_subscriptions.items():
+            if not sub.is_backfilling:
+                continue
+            if now - max(sub.sent_at, sub.last_event_at) < self.eose_timeout:
+                continue
+            if sub.events_count == 0 and sub.attempts < self.max_subscription_attempts:
+                continue
+            logger.debug(
+                f"No EOSE for subscription {subscription_id}."
+                f" Backfill considered done after {sub.events_count} events."
+            )
+            sub.backfill_done_at = now
 
-        subscription_id = "merchant-" + urlsafe_short_hash()[:32]
-        logger.debug(
-            f"New merchant temp subscription ({duration} sec). Subscription id: {subscription_id}"
+    def _track_subscription(self, message: str):
+        header = FRAME_HEADER.match(message)
+        if not header:
+            return
+        type_, subscription_id = header.groups()
+        sub = self.merchant_subscriptions.get(subscription_id)
+        if not sub:
+            return
+        if type_ == "EVENT":
+            sub.events_count += 1
+            sub.last_event_at = time.time()
+        elif type_ == "EOSE":
+            sub.eose = True
+            sub.backfill_done_at = sub.backfill_done_at or time.time()
+        elif type_ == "CLOSED":
+            _, _, *reason = json.loads(message)
+            sub.closed_reason = (reason and reason[0]) or "closed"
+
+    def merchant_temp_subscription(self, public_key: str):
+        """Fetch all the stored events of a merchant once."""
+        self.pending_temp_filters.append(
+            self._filters_for_direct_messages([public_key], 0)
+            + self._filters_for_stall_events([public_key], 0)
+            + self._filters_for_product_events([public_key], 0)
+            + self._filters_for_user_profile([public_key], 0)
         )
-        await self.send_req_queue.put(["REQ", subscription_id] + merchant_filters)
 
-        async def unsubscribe_with_delay(sub_id, d):
-            await asyncio.sleep(d)
-            await self.unsubscribe(sub_id)
+    def request_profile(self, public_key: str):
+        """
+        Fetch the profile (kind 0) of a user. Lookups are batched and sent
+        every `schedule_interval` seconds.
+        """
+        self.pending_profile_lookups.add(public_key)
 
-        asyncio.create_task(unsubscribe_with_delay(subscription_id, duration))
-
-    async def user_profile_temp_subscribe(self, public_key: str, duration=5):
-        try:
-            profile_filter = [{"kinds": [0], "authors": [public_key]}]
-            subscription_id = "profile-" + urlsafe_short_hash()[:32]
-            logger.debug(
-                f"New user temp subscription ({duration} sec). Subscription id: {subscription_id}"
+    def _schedule_profile_lookups(self):
+        if not self.pending_profile_lookups:
+            return
+        public_keys = list(self.pending_profile_lookups)
+        self.pending_profile_lookups = set()
+        for i in range(0, len(public_keys), self.max_filter_keys):
+            chunk = public_keys[i : i + self.max_filter_keys]
+            self.pending_temp_filters.append([{"kinds": [0], "authors": chunk}])
+
+    async def _send_temp_subscriptions(self):
+        while (
+            self.pending_temp_filters
+            and len(self.temp_subscriptions) < self.max_temp_subscriptions
+        ):
+            filters = self.pending_temp_filters.popleft()
+            subscription_id = "temp-" + urlsafe_short_hash()[:32]
+            self.temp_subscriptions[subscription_id] = TempSubscription(
+                filters, time.time()
             )
-            await self.send_req_queue.put(["REQ", subscription_id] + profile_filter)
-
-            async def unsubscribe_with_delay(sub_id, d):
-                await asyncio.sleep(d)
-                await self.unsubscribe(sub_id)
-
-            asyncio.create_task(unsubscribe_with_delay(subscription_id, duration))
-        except Exception as ex:
-            logger.debug(ex)
+            await self.send_req_queue.put(["REQ", subscription_id] + filters)
+            logger.debug(f"New temp subscription. Subscription id: {subscription_id}")
+
+    async def _close_expired_temp_subscriptions(self):
+        now = time.time()
+        for subscription_id, sub in list(self.temp_subscriptions.items()):
+            if now - sub.sent_at > self.temp_subscription_timeout:
+                self.temp_subscriptions.pop(subscription_id, None)
+                await self.unsubscribe(subscription_id)
+
+    async def _track_temp_subscription(self, message: str):
+        header = FRAME_HEADER.match(message)
+        if not header:
+            return
+        type_, subscription_id = header.groups()
+        if type_ not in ["EOSE", "CLOSED"]:
+            return
+        if not self.temp_subscriptions.pop(subscription_id, None):
+            return
+        if type_ == "EOSE":
+            await self.unsubscribe(subscription_id)
+        # try to fill the freed slot right away
+        await self._send_temp_subscriptions()
 
     def _filters_for_direct_messages(self, public_keys: List[str], since: int) -> List:
         in_messages_filter = {"kinds": [4], "#p": public_keys}
@@ -173,12 +525,57 @@ class NostrClient:
             pass
         self.ws = None
 
+    def _retry_later(self, priority: int, req: List):
+        # only events are worth re-sending, subscriptions are re-created on reconnect
+        if req[0] != "EVENT":
+            return
+        if not self.send_req_queue.retry(req, priority):
+            self.dropped_retry_events_count += 1
+            logger.warning("Retry buffer full. Dropping oldest outgoing event.")
+
+    def _is_low_priority(self, message: str) -> bool:
+        try:
+            type_, *rest = json.loads(message)
+            return type_ == "EVENT" and rest[-1]["kind"] in LOW_PRIORITY_KINDS
+        except Exception:
+            return False
+
+    def _should_shed(self, message) -> bool:
+        if (
+            isinstance(message, str)
+            and self.recieve_event_queue.qsize() >= self.shed_threshold
+            and self._is_low_priority(message)
+        ):
+            self.shed_events_count += 1
+            return True
+        return False
+
+    async def _receive_local(self, message: str):
+        """Called by the in-process connection. Waits while the queue is full."""
+        if self._should_shed(message):
+            return
+        await self.recieve_event_queue.put(message)
+
+    def _enqueue_received(self, message):
+        """Called from the websocket thread. Blocks it while the queue is full."""
+        if self._should_shed(message):
+            return
+
+        if not self._loop or self._loop.is_closed():
+            logger.warning("Event loop not available. Dropping received message.")
+            return
+        future = asyncio.run_coroutine_threadsafe(
+            self.recieve_event_queue.put(message), self._loop
+        )
+        future.result()
+
     def _ws_handlers(self):
         def on_open(_):
             logger.info("Connected to 'nostrclient' websocket")
+            self.connection_count += 1
 
         def on_message(_, message):
-            self.recieve_event_queue.put_nowait(message)
+            self._enqueue_received(message)
 
         def on_error(_, error):
             logger.warning(error)
@@ -186,7 +583,7 @@ class NostrClient:
         def on_close(x, status_code, message):
             logger.warning(f"Websocket closed: {x}: '{status_code}' '{message}'")
             # force re-subscribe
-            self.recieve_event_queue.put_nowait(ValueError("Websocket close."))
+            self._enqueue_received(ValueError("Websocket close."))
 
         return on_open, on_message, on_error, on_close
 
@@ -209,10 +606,13 @@ class NostrClient:
         self._safe_ws_stop()
 
     async def unsubscribe_merchants(self):
-        await self.send_req_queue.put(["CLOSE", self.subscription_id])
-        logger.debug(
-            f"Unsubscribed from all merchants events. Subscription id: {self.subscription_id}"
-        )
+        for subscription_id in list(self.merchant_subscriptions):
+            await self.send_req_queue.put(["CLOSE", subscription_id])
+        self.merchant_subscriptions = {}
+        for subscription_id in list(self.temp_subscriptions):
+            await self.send_req_queue.put(["CLOSE", subscription_id])
+        self.temp_subscriptions = {}
+        logger.debug("Unsubscribed from all merchants events.")
 
     async def unsubscribe(self, subscription_id):
         await self.send_req_queue.put(["CLOSE", subscription_id])
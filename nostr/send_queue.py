@@ -0,0 +1,95 @@
+import asyncio
+from asyncio import Queue
+from collections import deque
+from typing import List, Optional, Tuple
+
+# priority classes of the outgoing frames, lower is sent first
+PRIORITY_ORDER_MESSAGE = 0  # payment requests and order status updates
+PRIORITY_DIRECT_MESSAGE = 1  # chat
+PRIORITY_SUBSCRIPTION = 2  # REQ and CLOSE
+PRIORITY_BULK = 3  # everything else, eg: stall and product (re)publishing
+
+PRIORITIES = [
+    PRIORITY_ORDER_MESSAGE,
+    PRIORITY_DIRECT_MESSAGE,
+    PRIORITY_SUBSCRIPTION,
+    PRIORITY_BULK,
+]
+
+
+def frame_priority(frame: List) -> int:
+    """
+    Priority class of a frame. Direct messages are encrypted, so order
+    messages cannot be told from chat here: their priority is given by the
+    sender (see `PrioritySendQueue.put()`).
+    """
+    if frame[0] in ("REQ", "CLOSE"):
+        return PRIORITY_SUBSCRIPTION
+    if frame[0] == "EVENT" and frame[-1].get("kind") == 4:
+        return PRIORITY_DIRECT_MESSAGE
+    return PRIORITY_BULK
+
+
+class PrioritySendQueue:
+    """
+    Outgoing frames, one FIFO queue per priority class. `get()` returns the
+    oldest frame of the most urgent class, so a bulk publish does not delay
+    direct messages or subscriptions.
+
+    Each class has its own capacity: publishers of a full class wait, the
+    other classes are not affected. Frames that could not be sent are retried
+    before the other frames of their class, but not before a more urgent one.
+    """
+
+    def __init__(self, maxsize: int = 0, max_retries: int = 0):
+        self.queues: List[Queue] = [Queue(maxsize=maxsize) for _ in PRIORITIES]
+        # oldest are dropped when full
+        self.retries: List[deque] = [
+            deque(maxlen=max_retries or None) for _ in PRIORITIES
+        ]
+        # one permit per queued frame
+        self._frames = asyncio.Semaphore(0)
+
+    async def put(self, frame: List, priority: Optional[int] = None):
+        if priority is None:
+            priority = frame_priority(frame)
+        await self.queues[priority].put(frame)
+        self._frames.release()
+
+    def put_nowait(self, frame: List, priority: Optional[int] = None):
+        if priority is None:
+            priority = frame_priority(frame)
+        self.queues[priority].put_nowait(frame)
+        self._frames.release()
+
+    def retry(self, frame: List, priority: int) -> bool:
+        """
+        Send the frame again. Returns False if the oldest retried frame of
+        the same class had to be dropped to make room for it.
+        """
+        retries = self.retries[priority]
+        dropped = len(retries) == retries.maxlen
+        retries.append(frame)
+        if not dropped:
+            # a dropped frame gives its permit to the new one
+            self._frames.release()
+        return not dropped
+
+    async def get(self) -> Tuple[int, List]:
+        """The next frame to send, with its priority class."""
+        await self._frames.acquire()
+        for priority, (retries, queue) in enumerate(zip(self.retries, self.queues)):
+            if retries:
+                return priority, retries.popleft()
+            if not queue.empty():
+                return priority, queue.get_nowait()
+        raise RuntimeError("Send queue out of sync.")
+
+    def qsize(self) -> int:
+        return sum(self.sizes())
+
+    def sizes(self) -> List[int]:
+        return [q.qsize() + len(r) for q, r in zip(self.queues, self.retries)]
+
+    def retry_size(self) -> int:
+        return sum(len(r) for r in self.retries)
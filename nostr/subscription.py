@@ -0,0 +1,44 @@
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass
+class MerchantSubscription:
+    """A single REQ (shard) covering a subset of the merchant public keys."""
+
+    public_keys: List[str]
+    filters: List[dict]
+    sent_at: float = 0
+    attempts: int = 0
+    events_count: int = 0
+    eose: bool = False
+    closed_reason: Optional[str] = None
+    last_event_at: float = 0
+    # when the stored events were fully received (EOSE or idle timeout)
+    backfill_done_at: float = 0
+
+    @property
+    def is_alive(self) -> bool:
+        """The relays answered: either end of stored events or some events."""
+        return self.closed_reason is None and (self.eose or self.events_count != 0)
+
+    @property
+    def is_backfilling(self) -> bool:
+        """Stored (historical) events are still being received."""
+        return self.backfill_done_at == 0
+
+    @property
+    def backfill_rate(self) -> float:
+        """Events per second received while backfilling."""
+        end = self.backfill_done_at or time.time()
+        elapsed = end - self.sent_at
+        return round(self.events_count / elapsed, 2) if elapsed > 0 else 0
+
+
+@dataclass
+class TempSubscription:
+    """A short lived REQ (eg: profile lookups). Closed on EOSE or timeout."""
+
+    filters: List[dict]
+    sent_at: float = 0
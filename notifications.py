@@ -0,0 +1,49 @@
+import asyncio
+import json
+
+from lnbits.core.services import websocket_manager, websocket_updater
+
+
+class MerchantNotifications:
+    """
+    Websocket updates for the merchant UI. The updates of each merchant are
+    collected for a short window and sent as a single frame:
+        {"type": "batch", "items": [update, ...]}
+    Updates for merchants without an open UI are dropped.
+    """
+
+    def __init__(self, window: float = 0.5, max_batch_size: int = 100):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.pending: dict[str, list[dict]] = {}
+        self.updated = asyncio.Event()
+
+    def add(self, merchant_id: str, update: dict):
+        if not websocket_manager.has_connection(merchant_id):
+            return
+        self.pending.setdefault(merchant_id, []).append(update)
+        self.updated.set()
+
+    async def wait_and_flush(self):
+        await self.updated.wait()
+        await asyncio.sleep(self.window)
+        self.updated.clear()
+        await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        for merchant_id, updates in pending.items():
+            for i in range(0, len(updates), self.max_batch_size):
+                await websocket_updater(
+                    merchant_id,
+                    json.dumps(
+                        {
+                            "type": "batch",
+                            "items": updates[i : i + self.max_batch_size],
+                        },
+                        separators=(",", ":"),
+                    ),
+                )
+
+
+merchant_notifications = MerchantNotifications()
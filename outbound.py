@@ -0,0 +1,35 @@
+import time
+
+from .cache import LRUCache
+from .crud import get_last_outgoing_dm_time
+
+
+class OutboundMessages:
+    """
+    Paces the direct messages the merchant sends on its own (order status
+    updates, product autoreplies). Messages to the same customer get
+    `created_at` values at least `interval` seconds apart, so clients show
+    them in the right order. Other customers are not delayed.
+
+    A message is saved right away (with its outbox event), the outbox only
+    publishes it once its `created_at` is reached. Nothing is lost on restart.
+    """
+
+    def __init__(self, interval: int = 1, max_customers: int = 10_000):
+        self.interval = interval
+        # (merchant_id, customer public key) -> `created_at` of the last message
+        self.last_created_at = LRUCache(maxsize=max_customers)
+
+    async def next_created_at(self, merchant_id: str, public_key: str) -> int:
+        key = (merchant_id, public_key)
+        last_created_at = self.last_created_at.get(key)
+        if last_created_at is None:
+            last_created_at = await get_last_outgoing_dm_time(merchant_id, public_key)
+            # another message might have been scheduled meanwhile
+            last_created_at = max(last_created_at, self.last_created_at.get(key, 0))
+        created_at = max(round(time.time()), last_created_at + self.interval)
+        self.last_created_at.set(key, created_at)
+        return created_at
+
+
+outbound_messages = OutboundMessages()
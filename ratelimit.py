@@ -0,0 +1,82 @@
+import time
+
+from .cache import LRUCache
+from .models import IncomingDmQuotas
+
+
+class TokenBucket:
+    """
+    Token bucket per key: up to `burst` events at once, refilled with `rate`
+    events per second. The rate and burst are given on every call, so they
+    can differ per key and change at any time. The least recently used keys
+    are forgotten once more than `max_keys` are tracked (they start again with
+    a full bucket).
+    """
+
+    def __init__(self, max_keys: int = 10_000):
+        # key -> (tokens, last refill time)
+        self.buckets = LRUCache(maxsize=max_keys)
+
+    def take(self, key, rate: float, burst: int) -> bool:
+        """Take one token, False if the bucket of this key is empty."""
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        if tokens < 1:
+            self.buckets.set(key, (tokens, now))
+            return False
+        self.buckets.set(key, (tokens - 1, now))
+        return True
+
+
+class IncomingDmLimits:
+    """
+    Limits the live direct messages that get processed (decrypted, stored,
+    answered), checked before anything expensive is done. The quotas are set
+    per merchant (`MerchantConfig.dm_quotas`):
+      - every sender gets `sender_rate` messages per second (`sender_burst` at once)
+      - each merchant accepts `new_customer_rate` messages per second from
+        senders that are not customers yet, so a flood of new public keys
+        does not slow down the chats of the existing customers
+      - optionally, the first message of a new customer must come with a
+        NIP-13 proof of work of at least `new_customer_pow` bits
+    """
+
+    def __init__(self):
+        self.senders = TokenBucket()
+        self.new_customers = TokenBucket()
+        # reason -> number of dropped messages
+        self.shed: dict[str, int] = {"sender": 0, "new_customer": 0, "pow": 0}
+
+    def allow_sender(
+        self, merchant_id: str, public_key: str, quotas: IncomingDmQuotas
+    ) -> bool:
+        if self.senders.take(
+            (merchant_id, public_key), quotas.sender_rate, quotas.sender_burst
+        ):
+            return True
+        self.shed["sender"] += 1
+        return False
+
+    def allow_new_customer(
+        self, merchant_id: str, pow_difficulty: int, quotas: IncomingDmQuotas
+    ) -> bool:
+        if pow_difficulty < quotas.new_customer_pow:
+            self.shed["pow"] += 1
+            return False
+        if self.new_customers.take(
+            merchant_id, quotas.new_customer_rate, quotas.new_customer_burst
+        ):
+            return True
+        self.shed["new_customer"] += 1
+        return False
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "tracked_senders": len(self.senders.buckets),
+            "shed": dict(self.shed),
+        }
+
+
+incoming_dm_limits = IncomingDmLimits()
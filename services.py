@@ -1,45 +1,78 @@
 import asyncio
+import gzip
+import hashlib
 import json
+import time
+from contextlib import asynccontextmanager
 
 from bolt11 import decode
 from lnbits.core.crud import get_wallet
-from lnbits.core.services import create_invoice, websocket_updater
+from lnbits.core.services import create_invoice
+from lnbits.db import Connection
+from lnbits.settings import settings
+from lnbits.utils.exchange_rates import btc_price
 from loguru import logger
 
 from . import nostr_client
+from .cache import LRUCache, catalog_cache
 from .crud import (
+    ARCHIVE_AFTER_SECONDS,
     CustomerProfile,
+    archive_direct_messages,
+    archive_orders,
+    count_merchant_rows,
+    count_order_direct_messages,
     create_customer,
     create_direct_message,
+    create_job,
     create_order,
-    create_product,
-    create_stall,
+    create_outbox_event,
+    delete_merchant_customers,
+    delete_merchant_events,
+    delete_merchant_jobs,
+    delete_merchant_outbox_events,
+    delete_merchant_rows,
+    delete_merchant_stalls,
+    delete_merchant_sync_cursors,
+    delete_merchant_zones,
+    delete_outbox_events_older_than,
+    expire_unpaid_orders,
     get_customer,
-    get_last_direct_messages_created_at,
-    get_last_product_update_time,
-    get_last_stall_update_time,
+    get_last_job,
+    get_merchant_by_id,
     get_merchant_by_pubkey,
+    get_merchant_events_page,
     get_merchants_ids_with_pubkeys,
     get_order,
     get_order_by_event_id,
+    get_order_direct_messages_page,
+    get_order_follow_up_messages,
     get_products,
     get_products_by_ids,
     get_stalls,
+    get_sync_cursors,
+    get_unacked_outbox_events,
+    get_unsent_outbox_events,
     get_wallet_for_product,
     get_zone,
     increment_customer_unread_messages,
-    update_customer_profile,
+    mark_outbox_event_acked,
+    mark_outbox_events_sent,
+    run_after_commit,
+    unit_of_work,
+    update_job,
     update_order,
     update_order_paid_status,
     update_order_shipped_status,
     update_product,
-    update_product_quantity,
     update_stall,
 )
+from .jobs import start_job
 from .models import (
     Customer,
     DirectMessage,
     DirectMessageType,
+    Job,
     Merchant,
     Nostrable,
     Order,
@@ -55,6 +88,88 @@ from .models import (
     Stall,
 )
 from .nostr.event import NostrEvent
+from .nostr.send_queue import PRIORITY_DIRECT_MESSAGE, PRIORITY_ORDER_MESSAGE
+from .notifications import merchant_notifications
+from .outbound import outbound_messages
+from .ratelimit import incoming_dm_limits
+from .sync import catalog_sync, dm_batch, event_store, profile_updates, sync_cursors
+
+# set whenever new events are written to the outbox
+outbox_updated = asyncio.Event()
+
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_RETENTION_SECONDS = 24 * 60 * 60
+# direct messages published before the chat ones
+ORDER_MESSAGE_TYPES = [
+    DirectMessageType.PAYMENT_REQUEST.value,
+    DirectMessageType.ORDER_PAID_OR_SHIPPED.value,
+]
+# orders older than this, found while backfilling, are saved but not answered
+# (no invoice is sent). The merchant can reissue the invoice.
+HISTORICAL_ORDER_MAX_AGE = 60 * 60
+
+# unpaid orders are marked as expired this long after their invoice expired
+ORDER_EXPIRY_GRACE_PERIOD = 10 * 60
+ORDER_EXPIRY_BATCH_SIZE = 500
+# let the customers know (DM) that their order expired
+ORDER_EXPIRY_NOTIFY_CUSTOMERS = False
+
+ARCHIVE_BATCH_SIZE = 500
+
+MERCHANT_DELETE_JOB = "delete_merchant"
+MERCHANT_DELETE_CHUNK_SIZE = 1000
+# the tables that can be large, deleted in chunks
+MERCHANT_DELETE_TABLES = [
+    "direct_messages",
+    "direct_messages_archive",
+    "orders",
+    "orders_archive",
+    "products",
+]
+
+ORDER_RESTORE_JOB = "restore_orders"
+ORDER_RESTORE_PAGE_SIZE = 500
+
+# nostr event kinds that are handled, and kept in the local event store
+STORED_EVENT_KINDS = [0, 4, 30017, 30018]
+EVENTS_REPLAY_JOB = "replay_events"
+EVENTS_REPLAY_KINDS = [4, 30017, 30018]
+EVENTS_REPLAY_PAGE_SIZE = 500
+
+# direct message fields sent to the chat over the websocket
+CHAT_MESSAGE_FIELDS = {
+    "id",
+    "event_id",
+    "event_created_at",
+    "inserted_at",
+    "message",
+    "incoming",
+}
+
+# (merchant_id, public_key) of the customers known to exist
+known_customers = LRUCache(maxsize=10_000)
+
+# paid invoices are handled concurrently: one at a time per order and the
+# product quantities are updated one order at a time per merchant
+order_locks: dict[str, tuple[asyncio.Lock, int]] = {}
+inventory_locks: dict[str, tuple[asyncio.Lock, int]] = {}
+
+
+@asynccontextmanager
+async def _locked(locks: dict[str, tuple[asyncio.Lock, int]], key: str):
+    """Lock by key. The lock is dropped once nobody holds or waits for it."""
+    lock, users = locks.get(key, (asyncio.Lock(), 0))
+    locks[key] = (lock, users + 1)
+    try:
+        async with lock:
+            yield
+    finally:
+        lock, users = locks[key]
+        if users == 1:
+            locks.pop(key)
+        else:
+            locks[key] = (lock, users - 1)
 
 
 async def create_new_order(
@@ -63,15 +178,18 @@ async def create_new_order(
     merchant = await get_merchant_by_pubkey(merchant_public_key)
     assert merchant, "Cannot find merchant for order!"
 
-    if await get_order(merchant.id, data.id):
+    if await get_order(merchant.id, data.id, include_archived=True):
         return None
-    if data.event_id and await get_order_by_event_id(merchant.id, data.event_id):
+    if data.event_id and await get_order_by_event_id(
+        merchant.id, data.event_id, include_archived=True
+    ):
         return None
 
     order, invoice, receipt = await build_order_with_payment(
         merchant.id, merchant.public_key, data
     )
-    await create_order(merchant.id, order)
+    async with unit_of_work() as conn:
+        await create_order(merchant.id, order, conn)
 
     return PaymentRequest(
         id=data.id,
@@ -135,20 +253,25 @@ async def build_order_with_payment(
 async def update_merchant_to_nostr(
     merchant: Merchant, delete_merchant=False
 ) -> Merchant:
-    stalls = await get_stalls(merchant.id)
+    # the cached stalls and products are not changed
+    stalls = [s.copy(deep=True) for s in await get_stalls(merchant.id)]
     event: NostrEvent | None = None
     for stall in stalls:
         assert stall.id
         products = await get_products(merchant.id, stall.id)
-        for product in products:
-            event = await sign_and_send_to_nostr(merchant, product, delete_merchant)
+        for product in [p.copy(deep=True) for p in products]:
+            event = sign_nostr_event(merchant, product, delete_merchant)
             product.event_id = event.id
             product.event_created_at = event.created_at
-            await update_product(merchant.id, product)
-        event = await sign_and_send_to_nostr(merchant, stall, delete_merchant)
+            async with unit_of_work() as conn:
+                await update_product(merchant.id, product, conn)
+                await send_to_nostr(merchant.id, event, conn)
+        event = sign_nostr_event(merchant, stall, delete_merchant)
         stall.event_id = event.id
         stall.event_created_at = event.created_at
-        await update_stall(merchant.id, stall)
+        async with unit_of_work() as conn:
+            await update_stall(merchant.id, stall, conn)
+            await send_to_nostr(merchant.id, event, conn)
     # Always publish merchant profile (kind 0)
     event = await sign_and_send_to_nostr(merchant, merchant, delete_merchant)
     assert event
@@ -159,35 +282,218 @@ async def update_merchant_to_nostr(
 async def sign_and_send_to_nostr(
     merchant: Merchant, n: Nostrable, delete=False
 ) -> NostrEvent:
+    event = sign_nostr_event(merchant, n, delete)
+    await send_to_nostr(merchant.id, event)
+
+    return event
+
+
+def sign_nostr_event(merchant: Merchant, n: Nostrable, delete=False) -> NostrEvent:
+    """Sign before opening a transaction, the database lock is held until commit."""
     event = (
         n.to_nostr_delete_event(merchant.public_key)
         if delete
         else n.to_nostr_event(merchant.public_key)
     )
     event.sig = merchant.sign_hash(bytes.fromhex(event.id))
-    await nostr_client.publish_nostr_event(event)
-
     return event
 
 
+async def send_to_nostr(
+    merchant_id: str, event: NostrEvent, conn: Connection | None = None
+):
+    """
+    Queue the event in the outbox. If a connection is provided the event is
+    only published after the caller's transaction commits.
+    """
+    await create_outbox_event(merchant_id, event, conn)
+    # the sender must not wake up before the event is committed
+    run_after_commit(outbox_updated.set, conn)
+
+
+async def get_public_catalog(merchant: Merchant) -> tuple[str, bytes, bytes]:
+    """
+    The stalls and active products of a merchant, as served by the public
+    catalog API. Returns the ETag, the JSON body and the gzipped JSON body.
+    Cached until the catalog of the merchant changes.
+    """
+    key = ("public_catalog",)
+    found, catalog = catalog_cache.get(merchant.id, key)
+    if found:
+        return catalog
+    generation = catalog_cache.generation(merchant.id)
+
+    stalls = await get_stalls(merchant.id, pending=False)
+    products: list[Product] = []
+    for stall in stalls:
+        assert stall.id
+        stall_products = await get_products(merchant.id, stall.id, pending=False)
+        products.extend(p for p in stall_products if p.active)
+
+    content = {
+        "public_key": merchant.public_key,
+        "stalls": [
+            {**s.nostr_content(), "event_created_at": s.event_created_at}
+            for s in stalls
+        ],
+        "products": [
+            {
+                **p.nostr_content(),
+                "categories": p.categories,
+                "event_created_at": p.event_created_at,
+            }
+            for p in products
+        ],
+    }
+    body = json.dumps(content, separators=(",", ":"), ensure_ascii=False).encode()
+
+    # the digest also catches changes that are not (yet) published to nostr
+    last_created_at = max(
+        [s.event_created_at or 0 for s in stalls]
+        + [p.event_created_at or 0 for p in products],
+        default=0,
+    )
+    etag = f'"{last_created_at}-{hashlib.sha256(body).hexdigest()[:16]}"'
+
+    catalog = etag, body, gzip.compress(body, mtime=0)
+    catalog_cache.set(merchant.id, key, catalog, generation)
+    return catalog
+
+
+async def persist_and_publish_dm(
+    merchant: Merchant, dm: PartialDirectMessage, dm_event: NostrEvent
+) -> DirectMessage:
+    # encrypted, the send queue cannot tell order messages from chat
+    priority = (
+        PRIORITY_ORDER_MESSAGE
+        if dm.type in ORDER_MESSAGE_TYPES
+        else PRIORITY_DIRECT_MESSAGE
+    )
+    async with unit_of_work() as conn:
+        new_dm = await create_direct_message(merchant.id, dm, conn)
+        await create_outbox_event(merchant.id, dm_event, conn, priority)
+    outbox_updated.set()
+    delay = dm_event.created_at - time.time()
+    if delay > 0:
+        # scheduled message, wake up the outbox sender when it is due
+        asyncio.get_running_loop().call_later(delay, outbox_updated.set)
+
+    return new_dm
+
+
+async def send_outbox_events(resend_before: int = 0) -> int:
+    """
+    Publish the outbox events that were never sent. If `resend_before` is set,
+    also re-send the unacknowledged events last sent before that time.
+    """
+    count = 0
+    while True:
+        events = await get_unsent_outbox_events(OUTBOX_BATCH_SIZE)
+        if resend_before and not events:
+            events = await get_unacked_outbox_events(
+                resend_before, OUTBOX_MAX_ATTEMPTS, OUTBOX_BATCH_SIZE
+            )
+        if not events:
+            return count
+
+        for priority, e in events:
+            await nostr_client.publish_nostr_event(e, priority)
+        await mark_outbox_events_sent([e.id for _, e in events], round(time.time()))
+        count += len(events)
+
+
+async def prune_outbox_events():
+    await delete_outbox_events_older_than(round(time.time()) - OUTBOX_RETENTION_SECONDS)
+
+
 async def handle_order_paid(order_id: str, merchant_pubkey: str):
     try:
-        order = await update_order_paid_status(order_id, True)
-        assert order, f"Paid order cannot be found. Order id: {order_id}"
+        async with _locked(order_locks, order_id):
+            order = await update_order_paid_status(order_id, True)
+            assert order, f"Paid order cannot be found. Order id: {order_id}"
 
-        merchant = await get_merchant_by_pubkey(merchant_pubkey)
-        assert merchant, f"Merchant cannot be found for order {order_id}"
+            merchant = await get_merchant_by_pubkey(merchant_pubkey)
+            assert merchant, f"Merchant cannot be found for order {order_id}"
 
-        # todo: lock
-        success, message = await update_products_for_order(merchant, order)
-        await notify_client_of_order_status(order, merchant, success, message)
+            async with _locked(inventory_locks, merchant.id):
+                success, message = await update_products_for_order(merchant, order)
+            await notify_client_of_order_status(order, merchant, success, message)
 
-        await autoreply_for_products_in_order(merchant, order)
+            await autoreply_for_products_in_order(merchant, order)
 
     except Exception as ex:
         logger.warning(ex)
 
 
+async def expire_orders() -> int:
+    """
+    Mark the unpaid orders with an expired invoice as expired, in batches.
+    Returns the number of expired orders.
+    """
+    created_before = round(time.time()) - (
+        settings.lightning_invoice_expiry + ORDER_EXPIRY_GRACE_PERIOD
+    )
+    count = 0
+    while True:
+        orders = await expire_unpaid_orders(created_before, ORDER_EXPIRY_BATCH_SIZE)
+        count += len(orders)
+        if ORDER_EXPIRY_NOTIFY_CUSTOMERS:
+            await notify_customers_of_expired_orders(orders)
+        if len(orders) < ORDER_EXPIRY_BATCH_SIZE:
+            return count
+
+
+async def archive_old_records() -> tuple[int, int]:
+    """
+    Move old direct messages and completed orders to the archive, in batches.
+    Returns the number of archived messages and orders.
+    """
+    created_before = round(time.time()) - ARCHIVE_AFTER_SECONDS
+    messages_count, orders_count = 0, 0
+    while True:
+        count = await archive_direct_messages(created_before, ARCHIVE_BATCH_SIZE)
+        messages_count += count
+        if count < ARCHIVE_BATCH_SIZE:
+            break
+    while True:
+        count = await archive_orders(created_before, ARCHIVE_BATCH_SIZE)
+        orders_count += count
+        if count < ARCHIVE_BATCH_SIZE:
+            break
+    return messages_count, orders_count
+
+
+async def notify_customers_of_expired_orders(orders: list[Order]):
+    merchants: dict[str, Merchant | None] = {}
+    for order in orders:
+        pubkey = order.merchant_public_key
+        if pubkey not in merchants:
+            merchants[pubkey] = await get_merchant_by_pubkey(pubkey)
+        merchant = merchants[pubkey]
+        if not merchant:
+            continue
+        order_status = OrderStatusUpdate(
+            id=order.id,
+            message="Order expired. The invoice was not paid in time.",
+            paid=False,
+            shipped=False,
+        )
+        dm_content = json.dumps(
+            {
+                "type": DirectMessageType.ORDER_PAID_OR_SHIPPED.value,
+                **order_status.dict(),
+            },
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        await send_paced_dm(
+            merchant,
+            order.public_key,
+            DirectMessageType.ORDER_PAID_OR_SHIPPED.value,
+            dm_content,
+        )
+
+
 async def notify_client_of_order_status(
     order: Order, merchant: Merchant, success: bool, message: str
 ):
@@ -215,7 +521,7 @@ async def notify_client_of_order_status(
         if success
         else DirectMessageType.PLAIN_TEXT.value
     )
-    await send_dm(merchant, order.public_key, dm_type, dm_content)
+    await send_paced_dm(merchant, order.public_key, dm_type, dm_content)
 
 
 async def update_products_for_order(
@@ -228,13 +534,16 @@ async def update_products_for_order(
     if not success:
         return success, message
 
+    events = []
     for p in products:
-        assert p.id
-        product = await update_product_quantity(p.id, p.quantity)
-        assert product
-        event = await sign_and_send_to_nostr(merchant, product)
-        product.event_id = event.id
-        await update_product(merchant.id, product)
+        event = sign_nostr_event(merchant, p)
+        p.event_id = event.id
+        p.event_created_at = event.created_at
+        events.append(event)
+    async with unit_of_work() as conn:
+        for p, event in zip(products, events, strict=True):
+            await update_product(merchant.id, p, conn)
+            await send_to_nostr(merchant.id, event, conn)
 
     return True, "ok"
 
@@ -247,13 +556,12 @@ async def autoreply_for_products_in_order(merchant: Merchant, order: Order):
 
     for p in products_with_autoreply:
         dm_content = p.config.autoreply_message or ""
-        await send_dm(
+        await send_paced_dm(
             merchant,
             order.public_key,
             DirectMessageType.PLAIN_TEXT.value,
             dm_content,
         )
-        await asyncio.sleep(1)  # do not send all autoreplies at once
 
 
 async def send_dm(
@@ -261,8 +569,13 @@ async def send_dm(
     other_pubkey: str,
     type_: int,
     dm_content: str,
+    created_at: int | None = None,
 ):
-    dm_event = merchant.build_dm_event(dm_content, other_pubkey)
+    """
+    created_at: if in the future, the message is saved now but only
+        published at that time.
+    """
+    dm_event = merchant.build_dm_event(dm_content, other_pubkey, created_at)
 
     dm = PartialDirectMessage(
         event_id=dm_event.id,
@@ -271,26 +584,25 @@ async def send_dm(
         public_key=other_pubkey,
         type=type_,
     )
-    dm_reply = await create_direct_message(merchant.id, dm)
+    dm_reply = await persist_and_publish_dm(merchant, dm, dm_event)
+    notify_new_dm(merchant.id, dm_reply)
 
-    await nostr_client.publish_nostr_event(dm_event)
 
-    await websocket_updater(
-        merchant.id,
-        json.dumps(
-            {
-                "type": f"dm:{dm.type}",
-                "customerPubkey": other_pubkey,
-                "dm": dm_reply.dict(),
-            }
-        ),
-    )
+async def send_paced_dm(
+    merchant: Merchant, other_pubkey: str, type_: int, dm_content: str
+):
+    """Send a message at least `outbound_messages.interval` after the last one."""
+    created_at = await outbound_messages.next_created_at(merchant.id, other_pubkey)
+    await send_dm(merchant, other_pubkey, type_, dm_content, created_at)
 
 
 async def compute_products_new_quantity(
     merchant_id: str, product_ids: list[str], items: list[OrderItem]
 ) -> tuple[bool, list[Product], str]:
-    products: list[Product] = await get_products_by_ids(merchant_id, product_ids)
+    # the quantities are changed on copies, not on the cached products
+    products: list[Product] = [
+        p.copy(deep=True) for p in await get_products_by_ids(merchant_id, product_ids)
+    ]
 
     for p in products:
         required_quantity = next(
@@ -316,32 +628,63 @@ async def process_nostr_message(msg: str):
         type_, *rest = json.loads(msg)
 
         if type_.upper() == "EVENT":
-            _, event = rest
+            subscription_id, event = rest
             event = NostrEvent(**event)
+            if event.kind not in STORED_EVENT_KINDS:
+                return
+            # stored events replayed by the relays, not live ones
+            historical = nostr_client.is_backfilling(subscription_id)
+            merchant = await _dm_merchant(event) if event.kind == 4 else None
+            if merchant and not historical:
+                # Checked before the signature, which costs more. Tradeoff: a
+                # forged message uses up the quota of the sender it claims.
+                if not await _allow_incoming_dm(event, merchant):
+                    logger.debug(f"Incoming message '{event.id}' dropped (rate limit).")
+                    return
+            event.check_signature()
+            # kept even if handling it fails, a replay can apply it later
+            event_store.add(event)
             if event.kind == 0:
                 await _handle_customer_profile_update(event)
             elif event.kind == 4:
-                await _handle_nip04_message(event)
+                await _handle_nip04_message(event, merchant, historical)
             elif event.kind == 30017:
                 await _handle_stall(event)
             elif event.kind == 30018:
                 await _handle_product(event)
             return
 
+        if type_.upper() == "OK":
+            event_id, accepted, *_ = rest
+            if accepted:
+                await mark_outbox_event_acked(event_id)
+            return
+
+        if type_.upper() == "EOSE":
+            await flush_pending_writes()
+            return
+
     except Exception as ex:
         logger.debug(ex)
 
 
 async def create_or_update_order_from_dm(
-    merchant_id: str, merchant_pubkey: str, dm: DirectMessage
+    merchant_id: str,
+    merchant_pubkey: str,
+    dm: DirectMessage,
+    products: dict[str, Product] | None = None,
+    exchange_rates: dict[str, float] | None = None,
 ):
+    """
+    products, exchange_rates: optional caches, shared when restoring many orders.
+    """
     type_, json_data = PartialDirectMessage.parse_message(dm.message)
     if not json_data or "id" not in json_data:
         return
 
     if type_ == DirectMessageType.CUSTOMER_ORDER:
         order = await extract_customer_order_from_dm(
-            merchant_id, merchant_pubkey, dm, json_data
+            merchant_id, merchant_pubkey, dm, json_data, products, exchange_rates
         )
         new_order = await create_order(merchant_id, order)
         if new_order.stall_id == "None" and order.stall_id != "None":
@@ -356,18 +699,14 @@ async def create_or_update_order_from_dm(
         return
 
     if type_ == DirectMessageType.PAYMENT_REQUEST:
-        payment_request = PaymentRequest(**json_data)
-        pr = next(
-            (o.link for o in payment_request.payment_options if o.type == "ln"), None
-        )
-        if not pr:
+        invoice = _invoice_of_payment_request(json_data)
+        if not invoice:
             return
-        invoice = decode(pr)
-        total = invoice.amount_msat / 1000 if invoice.amount_msat else 0
+        total, invoice_id = invoice
         await update_order(
             merchant_id,
-            payment_request.id,
-            **{"total": total, "invoice_id": invoice.payment_hash},
+            str(json_data["id"]),
+            **{"total": total, "invoice_id": invoice_id},
         )
         return
 
@@ -379,14 +718,41 @@ async def create_or_update_order_from_dm(
             await update_order_shipped_status(merchant_id, order_update.id, True)
 
 
+def _invoice_of_payment_request(json_data: dict) -> tuple[float, str] | None:
+    """The (total, payment hash) of the lightning invoice of a payment request."""
+    payment_request = PaymentRequest(**json_data)
+    pr = next((o.link for o in payment_request.payment_options if o.type == "ln"), None)
+    if not pr:
+        return None
+    invoice = decode(pr)
+    total = invoice.amount_msat / 1000 if invoice.amount_msat else 0
+    return total, invoice.payment_hash
+
+
 async def extract_customer_order_from_dm(
-    merchant_id: str, merchant_pubkey: str, dm: DirectMessage, json_data: dict
+    merchant_id: str,
+    merchant_pubkey: str,
+    dm: DirectMessage,
+    json_data: dict,
+    products_cache: dict[str, Product] | None = None,
+    exchange_rates: dict[str, float] | None = None,
 ) -> Order:
     order_items = [OrderItem(**i) for i in json_data.get("items", [])]
-    products = await get_products_by_ids(
-        merchant_id, [p.product_id for p in order_items]
-    )
-    extra = await OrderExtra.from_products(products)
+    product_ids = [p.product_id for p in order_items]
+    if products_cache is None:
+        products = await get_products_by_ids(merchant_id, product_ids)
+    else:
+        products = [products_cache[i] for i in product_ids if i in products_cache]
+
+    exchange_rate = None
+    if exchange_rates is not None:
+        currency = (products[0].config.currency if len(products) else None) or "sat"
+        if currency not in exchange_rates:
+            exchange_rates[currency] = (
+                await btc_price(currency) if currency != "sat" else 1
+            )
+        exchange_rate = exchange_rates[currency]
+    extra = await OrderExtra.from_products(products, exchange_rate)
     order = Order(
         id=str(json_data.get("id")),
         event_id=dm.event_id,
@@ -410,62 +776,393 @@ async def extract_customer_order_from_dm(
     return order
 
 
-async def _handle_nip04_message(event: NostrEvent):
-    merchant_public_key = event.pubkey
-    merchant = await get_merchant_by_pubkey(merchant_public_key)
+async def restore_orders_from_direct_messages(job: Job):
+    """
+    Rebuild the orders of a merchant from the order related direct messages.
+    The customer order messages are read in pages. The payment requests and
+    status updates that follow them are read with one query per page. Each
+    order is then built from all its messages and written once. The job cursor
+    is moved after each page.
+    """
+    merchant = await get_merchant_by_id(job.merchant_id)
+    assert merchant, "Merchant cannot be found"
+
+    products: dict[str, Product] = {}
+    exchange_rates: dict[str, float] = {}
+
+    after = None
+    if job.cursor:
+        created_at, dm_id = job.cursor.split(":", 1)
+        after = (int(created_at), dm_id)
+
+    while True:
+        page = await get_order_direct_messages_page(
+            merchant.id, after, ORDER_RESTORE_PAGE_SIZE
+        )
+        if not page:
+            break
+        follow_ups = await get_order_follow_up_messages(
+            merchant.id,
+            list({dm.public_key for dm in page}),
+            page[0].event_created_at or 0,
+        )
+        await _load_order_products(merchant.id, page, products)
+
+        orders = _group_dms_by_order_id(page + follow_ups)
+        page_order_ids = set(_group_dms_by_order_id(page))
+        for order_id in page_order_ids:
+            try:
+                order = await _build_restored_order(
+                    merchant, orders[order_id], products, exchange_rates
+                )
+                if order:
+                    await _save_restored_order(merchant.id, order)
+            except Exception as e:
+                job.errors += 1
+                logger.debug(f"Failed to restore order '{order_id}': '{e!s}'.")
+
+        last_dm = page[-1]
+        after = (last_dm.event_created_at or 0, last_dm.id)
+        job.progress += len(page)
+        job.cursor = f"{last_dm.event_created_at}:{last_dm.id}"
+        await update_job(job)
+
+
+async def _build_restored_order(
+    merchant: Merchant,
+    dms: list[DirectMessage],
+    products: dict[str, Product],
+    exchange_rates: dict[str, float],
+) -> Order | None:
+    """The order described by its messages (sorted oldest first)."""
+    order = None
+    for dm in dms:
+        type_, json_data = PartialDirectMessage.parse_message(dm.message)
+        if not json_data:
+            continue
+        if type_ == DirectMessageType.CUSTOMER_ORDER:
+            if not order:
+                order = await extract_customer_order_from_dm(
+                    merchant.id,
+                    merchant.public_key,
+                    dm,
+                    json_data,
+                    products,
+                    exchange_rates,
+                )
+        elif order and type_ == DirectMessageType.PAYMENT_REQUEST:
+            invoice = _invoice_of_payment_request(json_data)
+            if invoice:
+                order.total, order.invoice_id = invoice
+        elif order and type_ == DirectMessageType.ORDER_PAID_OR_SHIPPED:
+            order_update = OrderStatusUpdate(**json_data)
+            order.paid = order.paid or bool(order_update.paid)
+            order.shipped = order.shipped or bool(order_update.shipped)
+    return order
+
+
+async def _save_restored_order(merchant_id: str, order: Order):
+    """Create the order, or complete the existing one, in one transaction."""
+    async with unit_of_work() as conn:
+        live = await get_order(merchant_id, order.id, conn=conn)
+        if not live and await get_order(
+            merchant_id, order.id, include_archived=True, conn=conn
+        ):
+            # archived orders are completed, nothing to restore
+            return
+        existing = await create_order(merchant_id, order, conn)
+        changes: dict = {}
+        if existing.stall_id == "None" and order.stall_id != "None":
+            changes["stall_id"] = order.stall_id
+            changes["extra_data"] = json.dumps(order.extra.dict())
+        if existing.invoice_id != order.invoice_id and order.invoice_id != "None":
+            changes["total"] = order.total
+            changes["invoice_id"] = order.invoice_id
+        if order.paid and not existing.paid:
+            # an invoice can still be paid after the order was marked as expired
+            changes["paid"] = True
+            changes["expired"] = False
+        if order.shipped and not existing.shipped:
+            changes["shipped"] = True
+        if changes:
+            await update_order(merchant_id, order.id, conn=conn, **changes)
+
+
+def _group_dms_by_order_id(dms: list[DirectMessage]) -> dict[str, list[DirectMessage]]:
+    orders: dict[str, list[DirectMessage]] = {}
+    for dm in dms:
+        _, json_data = PartialDirectMessage.parse_message(dm.message)
+        if json_data and "id" in json_data:
+            orders.setdefault(str(json_data["id"]), []).append(dm)
+    for order_dms in orders.values():
+        order_dms.sort(key=lambda dm: (dm.event_created_at or 0, dm.type))
+    return orders
+
+
+async def _load_order_products(
+    merchant_id: str, dms: list[DirectMessage], products: dict[str, Product]
+):
+    """Fetch (once) the products of all the orders in `dms`."""
+    product_ids = set()
+    for dm in dms:
+        type_, json_data = PartialDirectMessage.parse_message(dm.message)
+        if type_ != DirectMessageType.CUSTOMER_ORDER or not json_data:
+            continue
+        for item in json_data.get("items", []):
+            if item.get("product_id") not in products:
+                product_ids.add(item.get("product_id"))
+    product_ids.discard(None)
+    if not product_ids:
+        return
+    for p in await get_products_by_ids(merchant_id, list(product_ids)):
+        if p.id:
+            products[p.id] = p
+
+
+async def replay_events(job: Job):
+    """
+    Re-apply the events of the local event store to the direct messages,
+    stalls and products of a merchant, without asking the relays. The events
+    are replayed in pages, as if they were received while backfilling. The
+    orders are then restored from the direct messages.
+
+    Nothing is deleted first: missing rows are added and outdated ones updated,
+    the local only data (eg: stall wallet, read messages) is kept. Events
+    received before the event store existed (migration m014) are not in it,
+    use a resync from the relays for those.
+    """
+    merchant = await get_merchant_by_id(job.merchant_id)
+    assert merchant, "Merchant cannot be found"
+
+    after = None
+    if job.cursor:
+        created_at, event_id = job.cursor.split(":", 1)
+        after = (int(created_at), event_id)
+
+    while True:
+        page = await get_merchant_events_page(
+            merchant.public_key, EVENTS_REPLAY_KINDS, after, EVENTS_REPLAY_PAGE_SIZE
+        )
+        if not page:
+            break
+        for event in page:
+            try:
+                if event.kind == 4:
+                    dm_merchant = await _dm_merchant(event)
+                    await _handle_nip04_message(event, dm_merchant, historical=True)
+                elif event.kind == 30017:
+                    await _handle_stall(event)
+                elif event.kind == 30018:
+                    await _handle_product(event)
+            except Exception as e:
+                job.errors += 1
+                logger.debug(f"Failed to replay event '{event.id}': '{e!s}'.")
+        # the job cursor must not move past unsaved data
+        await flush_pending_writes()
+
+        last_event = page[-1]
+        after = (last_event.created_at, last_event.id)
+        job.progress += len(page)
+        job.cursor = f"{last_event.created_at}:{last_event.id}"
+        await update_job(job)
+
+    restore_job = await get_last_job(merchant.id, ORDER_RESTORE_JOB)
+    if not restore_job or restore_job.is_finished:
+        total = await count_order_direct_messages(merchant.id)
+        restore_job = await create_job(merchant.id, ORDER_RESTORE_JOB, total)
+    start_job(restore_job, restore_orders_from_direct_messages)
+
+
+async def count_merchant_data(merchant_id: str) -> int:
+    """Number of rows deleted in chunks when the merchant is deleted."""
+    return sum(
+        [await count_merchant_rows(t, merchant_id) for t in MERCHANT_DELETE_TABLES]
+    )
+
+
+async def delete_merchant_data(job: Job):
+    """
+    Delete everything that belongs to an (already deleted) merchant.
+    The large tables are deleted in chunks, so no table is locked for long.
+    Deleting is idempotent, an interrupted job simply starts again.
+    """
+    merchant_id = job.merchant_id
+    for table in MERCHANT_DELETE_TABLES:
+        while True:
+            count = await delete_merchant_rows(
+                table, merchant_id, MERCHANT_DELETE_CHUNK_SIZE
+            )
+            job.progress += count
+            await update_job(job)
+            if count < MERCHANT_DELETE_CHUNK_SIZE:
+                break
+            # let the other writers in
+            await asyncio.sleep(0)
+
+    # the events are found by public key, kept in the job cursor
+    while job.cursor:
+        count = await delete_merchant_events(job.cursor, MERCHANT_DELETE_CHUNK_SIZE)
+        job.progress += count
+        await update_job(job)
+        if count < MERCHANT_DELETE_CHUNK_SIZE:
+            break
+        await asyncio.sleep(0)
+
+    await delete_merchant_stalls(merchant_id)
+    await delete_merchant_zones(merchant_id)
+    await delete_merchant_customers(merchant_id)
+    await delete_merchant_outbox_events(merchant_id)
+    await delete_merchant_sync_cursors(merchant_id)
+    await delete_merchant_jobs(merchant_id, keep_job_id=job.id)
+
+
+# background job runners, by job kind
+JOB_RUNNERS = {
+    ORDER_RESTORE_JOB: restore_orders_from_direct_messages,
+    MERCHANT_DELETE_JOB: delete_merchant_data,
+    EVENTS_REPLAY_JOB: replay_events,
+}
+
+
+def has_full_batches() -> bool:
+    return (
+        event_store.is_full
+        or dm_batch.is_full
+        or profile_updates.is_full
+        or catalog_sync.is_full
+    )
+
 
-    if not merchant:
-        p_tags = event.tag_values("p")
-        if len(p_tags) and p_tags[0]:
-            merchant_public_key = p_tags[0]
-            merchant = await get_merchant_by_pubkey(merchant_public_key)
+async def flush_batched_writes():
+    await event_store.flush()
+    await dm_batch.flush()
+    await profile_updates.flush()
+    await catalog_sync.flush()
 
-    assert merchant, f"Merchant not found for public key '{merchant_public_key}'"
+
+async def flush_pending_writes():
+    """Save the batched writes, then move the sync cursors past them."""
+    await flush_batched_writes()
+    await sync_cursors.flush()
+
+
+async def _dm_merchant(event: NostrEvent) -> Merchant | None:
+    """The merchant that sent or received the message, if any."""
+    merchant = await get_merchant_by_pubkey(event.pubkey)
+    if merchant:
+        return merchant
+    p_tags = event.tag_values("p")
+    if len(p_tags) and p_tags[0]:
+        return await get_merchant_by_pubkey(p_tags[0])
+    return None
+
+
+async def _handle_nip04_message(
+    event: NostrEvent, merchant: Merchant | None, historical=False
+):
+    """merchant: see `_dm_merchant()`"""
+    assert merchant, f"Merchant not found for message '{event.id}'"
+    merchant_public_key = merchant.public_key
 
     if event.pubkey == merchant_public_key:
         assert len(event.tag_values("p")) != 0, "Outgong message has no 'p' tag"
         clear_text_msg = merchant.decrypt_message(
             event.content, event.tag_values("p")[0]
         )
-        await _handle_outgoing_dms(event, merchant, clear_text_msg)
+        await _handle_outgoing_dms(event, merchant, clear_text_msg, historical)
     elif event.has_tag_value("p", merchant_public_key):
         clear_text_msg = merchant.decrypt_message(event.content, event.pubkey)
-        await _handle_incoming_dms(event, merchant, clear_text_msg)
+        await _handle_incoming_dms(event, merchant, clear_text_msg, historical)
     else:
         logger.warning(f"Bad NIP04 event: '{event.id}'")
+        return
+
+    sync_cursors.advance(merchant.id, event.kind, event.created_at)
+
+
+async def _allow_incoming_dm(event: NostrEvent, merchant: Merchant) -> bool:
+    """Rate limits for live incoming messages, checked before anything else."""
+    if event.pubkey == merchant.public_key:
+        return True
+    quotas = merchant.config.dm_quotas
+    if not incoming_dm_limits.allow_sender(merchant.id, event.pubkey, quotas):
+        return False
+    customer_key = (merchant.id, event.pubkey)
+    if customer_key in known_customers:
+        return True
+    if await get_customer(merchant.id, event.pubkey):
+        known_customers.set(customer_key, True)
+        return True
+    # the proof of work is only computed when it is required
+    pow_difficulty = event.pow_difficulty() if quotas.new_customer_pow > 0 else 0
+    return incoming_dm_limits.allow_new_customer(merchant.id, pow_difficulty, quotas)
 
 
 async def _handle_incoming_dms(
-    event: NostrEvent, merchant: Merchant, clear_text_msg: str
+    event: NostrEvent, merchant: Merchant, clear_text_msg: str, historical=False
 ):
-    customer = await get_customer(merchant.id, event.pubkey)
-    if not customer:
-        await _handle_new_customer(event, merchant)
-    else:
-        await increment_customer_unread_messages(merchant.id, event.pubkey)
-
     dm_type, json_data = PartialDirectMessage.parse_message(clear_text_msg)
-    new_dm = await _persist_dm(
-        merchant.id,
-        dm_type.value,
-        event.pubkey,
-        event.id,
-        event.created_at,
-        clear_text_msg,
+    dm = PartialDirectMessage(
+        event_id=event.id,
+        event_created_at=event.created_at,
+        message=clear_text_msg,
+        public_key=event.pubkey,
+        incoming=True,
+        type=dm_type.value,
+    )
+    # no live updates while backfilling, the UI loads the messages later.
+    # Structured (order) messages are never batched, the order is saved now.
+    batched = historical and not json_data
+    answered = not historical or (
+        time.time() - event.created_at < HISTORICAL_ORDER_MAX_AGE
     )
 
-    if json_data:
+    customer_key = (merchant.id, event.pubkey)
+    new_dm = None
+    if not batched or customer_key not in known_customers:
+        # the (new) customer and the message are written in one transaction
+        async with unit_of_work() as conn:
+            if customer_key not in known_customers:
+                if not await get_customer(merchant.id, event.pubkey, conn):
+                    await _handle_new_customer(event, merchant, conn)
+            if not batched:
+                new_dm = await create_direct_message(merchant.id, dm, conn)
+            if not historical:
+                # the cached unread count is bumped once the message is saved
+                run_after_commit(
+                    lambda: increment_customer_unread_messages(
+                        merchant.id, event.pubkey
+                    ),
+                    conn,
+                )
+        known_customers.set(customer_key, True)
+
+    if batched:
+        dm_batch.add(merchant.id, dm)
+        return
+    assert new_dm
+    if not historical:
+        notify_new_dm(merchant.id, new_dm)
+
+    if json_data and not answered:
+        try:
+            await create_or_update_order_from_dm(
+                merchant.id, merchant.public_key, new_dm
+            )
+        except Exception as ex:
+            logger.warning(f"Cannot save order from event '{event.id}': {ex}")
+    elif json_data:
         reply_type, dm_reply = await _handle_incoming_structured_dm(
             merchant, new_dm, json_data
         )
         if dm_reply:
             await reply_to_structured_dm(
-                merchant, event.pubkey, reply_type.value, dm_reply
+                merchant, event.pubkey, reply_type.value, dm_reply, historical
             )
 
 
 async def _handle_outgoing_dms(
-    event: NostrEvent, merchant: Merchant, clear_text_msg: str
+    event: NostrEvent, merchant: Merchant, clear_text_msg: str, historical=False
 ):
     sent_to = event.tag_values("p")
     type_, _ = PartialDirectMessage.parse_message(clear_text_msg)
@@ -477,7 +1174,10 @@ async def _handle_outgoing_dms(
             public_key=sent_to[0],
             type=type_.value,
         )
-        await create_direct_message(merchant.id, dm)
+        if historical:
+            dm_batch.add(merchant.id, dm)
+        else:
+            await create_direct_message(merchant.id, dm)
 
 
 async def _handle_incoming_structured_dm(
@@ -497,39 +1197,24 @@ async def _handle_incoming_structured_dm(
     return DirectMessageType.PLAIN_TEXT, None
 
 
-async def _persist_dm(
-    merchant_id: str,
-    dm_type: int,
-    from_pubkey: str,
-    event_id: str,
-    event_created_at: int,
-    msg: str,
-) -> DirectMessage:
-    dm = PartialDirectMessage(
-        event_id=event_id,
-        event_created_at=event_created_at,
-        message=msg,
-        public_key=from_pubkey,
-        incoming=True,
-        type=dm_type,
-    )
-    new_dm = await create_direct_message(merchant_id, dm)
-
-    await websocket_updater(
+def notify_new_dm(merchant_id: str, dm: PartialDirectMessage):
+    """Push a new chat message to the merchant UI, only with the fields it uses."""
+    merchant_notifications.add(
         merchant_id,
-        json.dumps(
-            {
-                "type": f"dm:{dm_type}",
-                "customerPubkey": from_pubkey,
-                "dm": new_dm.dict(),
-            }
-        ),
+        {
+            "type": f"dm:{dm.type}",
+            "customerPubkey": dm.public_key,
+            "dm": dm.dict(include=CHAT_MESSAGE_FIELDS),
+        },
     )
-    return new_dm
 
 
 async def reply_to_structured_dm(
-    merchant: Merchant, customer_pubkey: str, dm_type: int, dm_reply: str
+    merchant: Merchant,
+    customer_pubkey: str,
+    dm_type: int,
+    dm_reply: str,
+    historical=False,
 ):
     dm_event = merchant.build_dm_event(dm_reply, customer_pubkey)
     dm = PartialDirectMessage(
@@ -539,15 +1224,9 @@ async def reply_to_structured_dm(
         public_key=customer_pubkey,
         type=dm_type,
     )
-    await create_direct_message(merchant.id, dm)
-    await nostr_client.publish_nostr_event(dm_event)
-
-    await websocket_updater(
-        merchant.id,
-        json.dumps(
-            {"type": f"dm:{dm_type}", "customerPubkey": dm.public_key, "dm": dm.dict()}
-        ),
-    )
+    new_dm = await persist_and_publish_dm(merchant, dm, dm_event)
+    if not historical:
+        notify_new_dm(merchant.id, new_dm)
 
 
 async def _handle_new_order(
@@ -606,37 +1285,29 @@ async def create_new_failed_order(
     return PaymentRequest(id=order.id, message=fail_message, payment_options=[])
 
 
-async def resubscribe_to_all_merchants():
-    await nostr_client.unsubscribe_merchants()
-    # give some time for the message to propagate
-    await asyncio.sleep(1)
-    await subscribe_to_all_merchants()
-
-
 async def subscribe_to_all_merchants():
+    await flush_pending_writes()
     ids = await get_merchants_ids_with_pubkeys()
-    public_keys = [pk for _, pk in ids]
-
-    last_dm_time = await get_last_direct_messages_created_at()
-    last_stall_time = await get_last_stall_update_time()
-    last_prod_time = await get_last_product_update_time()
+    cursors = await get_sync_cursors()
 
     await nostr_client.subscribe_merchants(
-        public_keys, last_dm_time, last_stall_time, last_prod_time, 0
+        {public_key: cursors.get(merchant_id, {}) for merchant_id, public_key in ids}
     )
 
 
-async def _handle_new_customer(event: NostrEvent, merchant: Merchant):
+async def _handle_new_customer(
+    event: NostrEvent, merchant: Merchant, conn: Connection | None = None
+):
     await create_customer(
-        merchant.id, Customer(merchant_id=merchant.id, public_key=event.pubkey)
+        merchant.id, Customer(merchant_id=merchant.id, public_key=event.pubkey), conn
     )
-    await nostr_client.user_profile_temp_subscribe(event.pubkey)
+    run_after_commit(lambda: nostr_client.request_profile(event.pubkey), conn)
 
 
 async def _handle_customer_profile_update(event: NostrEvent):
     try:
         profile = json.loads(event.content)
-        await update_customer_profile(
+        profile_updates.add(
             event.pubkey,
             event.created_at,
             CustomerProfile(
@@ -668,7 +1339,8 @@ async def _handle_stall(event: NostrEvent):
             event_created_at=event.created_at,
         )
         stall.config.description = stall_json.get("description", "")
-        await create_stall(merchant.id, stall)
+        await catalog_sync.add(merchant.id, event.kind, stall)
+        sync_cursors.advance(merchant.id, event.kind, event.created_at)
 
     except Exception as ex:
         logger.error(ex)
@@ -697,7 +1369,8 @@ async def _handle_product(event: NostrEvent):
         )
         product.config.description = product_json.get("description", "")
         product.config.currency = product_json.get("currency", "sat")
-        await create_product(merchant.id, product)
+        await catalog_sync.add(merchant.id, event.kind, product)
+        sync_cursors.advance(merchant.id, event.kind, event.created_at)
 
     except Exception as ex:
         logger.error(ex)
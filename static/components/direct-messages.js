@@ -1,3 +1,9 @@
+// number of messages loaded at once when opening a chat or scrolling back
+const DM_PAGE_SIZE = 50
+// the chat delta starts this long (microseconds) before the last inserted
+// message, for the messages of a transaction that committed after it
+const DM_DELTA_LOOKBACK = 10 * 1000 * 1000
+
 window.app.component('direct-messages', {
   name: 'direct-messages',
   props: ['active-chat-customer', 'merchant-id', 'adminkey', 'inkey'],
@@ -40,6 +46,9 @@ window.app.component('direct-messages', {
       unreadMessages: 0,
       activePublicKey: null,
       messages: [],
+      // loaded messages by customer public key: {messages, hasOlder}
+      chats: {},
+      hasOlderMessages: false,
       newMessage: '',
       showAddPublicKey: false,
       newPublicKey: null,
@@ -65,21 +74,78 @@ window.app.component('direct-messages', {
     getDirectMessages: async function (pubkey) {
       if (!pubkey) {
         this.messages = []
+        this.hasOlderMessages = false
         return
       }
       try {
+        const chat = this.chats[pubkey]
+        // only fetch what was inserted since the chat was last opened, a late
+        // message can be older than the last one. The first page includes the
+        // archive, a chat can be older than the archive age
+        const insertedAt = Math.max(
+          0,
+          ...(chat?.messages || []).map(m => m.inserted_at || 0)
+        )
+        const query = insertedAt
+          ? `inserted_after=${insertedAt - DM_DELTA_LOOKBACK}`
+          : `limit=${DM_PAGE_SIZE}&include_archived=true`
         const {data} = await LNbits.api.request(
           'GET',
-          '/nostrmarket/api/v1/message/' + pubkey,
+          `/nostrmarket/api/v1/message/${pubkey}?${query}`,
           this.inkey
         )
-        this.messages = data
-
+        if (!chat) {
+          this.chats[pubkey] = {
+            messages: [],
+            hasOlder: data.length === DM_PAGE_SIZE
+          }
+        }
+        this.addMessages(pubkey, data)
+        if (pubkey !== this.activePublicKey) return
+        this.showChat(pubkey)
         this.focusOnChatBox(this.messages.length - 1)
       } catch (error) {
         LNbits.utils.notifyApiError(error)
       }
     },
+    loadOlderMessages: async function () {
+      const pubkey = this.activePublicKey
+      const chat = this.chats[pubkey]
+      if (!chat?.messages.length) return
+      try {
+        // page on (event_created_at, id), many messages can share a timestamp
+        const {event_created_at: until, id: beforeId} = chat.messages[0]
+        const {data} = await LNbits.api.request(
+          'GET',
+          `/nostrmarket/api/v1/message/${pubkey}?until=${until}&before_id=${beforeId}&limit=${DM_PAGE_SIZE}&include_archived=true`,
+          this.inkey
+        )
+        chat.hasOlder = data.length === DM_PAGE_SIZE
+        this.addMessages(pubkey, data)
+        if (pubkey === this.activePublicKey) this.showChat(pubkey)
+      } catch (error) {
+        LNbits.utils.notifyApiError(error)
+      }
+    },
+    addMessages: function (pubkey, newMessages) {
+      const chat = this.chats[pubkey]
+      if (!chat) return
+      // the delta queries overlap, skip what is already loaded
+      const loaded = new Set(chat.messages.map(m => m.event_id || m.id))
+      const messages = newMessages.filter(m => !loaded.has(m.event_id || m.id))
+      chat.messages = chat.messages
+        .concat(messages)
+        .sort(
+          (a, b) =>
+            a.event_created_at - b.event_created_at ||
+            (a.id < b.id ? -1 : a.id > b.id ? 1 : 0)
+        )
+    },
+    showChat: function (pubkey) {
+      const chat = this.chats[pubkey]
+      this.messages = chat ? chat.messages : []
+      this.hasOlderMessages = !!chat?.hasOlder
+    },
     getCustomers: async function () {
       try {
         const {data} = await LNbits.api.request(
@@ -105,7 +171,8 @@ window.app.component('direct-messages', {
             public_key: this.activePublicKey
           }
         )
-        this.messages = this.messages.concat([data])
+        this.addMessages(this.activePublicKey, [data])
+        this.showChat(this.activePublicKey)
         this.newMessage = ''
         this.focusOnChatBox(this.messages.length - 1)
       } catch (error) {
@@ -134,8 +201,9 @@ window.app.component('direct-messages', {
       }
     },
     handleNewMessage: async function (data) {
+      this.addMessages(data.customerPubkey, [data.dm])
       if (data.customerPubkey === this.activePublicKey) {
-        this.messages.push(data.dm)
+        this.showChat(data.customerPubkey)
         this.focusOnChatBox(this.messages.length - 1)
         // focus back on input box
       }
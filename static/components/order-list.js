@@ -215,12 +215,30 @@ window.app.component('order-list', {
     restoreOrders: async function () {
       try {
         this.search.restoring = true
-        await LNbits.api.request(
+        let {data: job} = await LNbits.api.request(
           'PUT',
           `/nostrmarket/api/v1/orders/restore`,
           this.adminkey
         )
+        // the restore runs in the background, wait for it to finish
+        while (job && ['pending', 'running'].includes(job.status)) {
+          await new Promise(resolve => setTimeout(resolve, 2000))
+          const {data} = await LNbits.api.request(
+            'GET',
+            `/nostrmarket/api/v1/orders/restore`,
+            this.inkey
+          )
+          job = data
+        }
         await this.getOrders()
+        if (job?.status === 'failed') {
+          this.$q.notify({
+            type: 'warning',
+            message: 'Orders restore failed',
+            caption: job.message
+          })
+          return
+        }
         this.$q.notify({
           type: 'positive',
           message: 'Orders restored!'
@@ -202,39 +202,11 @@ window.app = Vue.createApp({
         this.wsConnection = new WebSocket(wsUrl)
         this.wsConnection.onmessage = async e => {
           const data = JSON.parse(e.data)
-          if (data.type === 'dm:0') {
-            this.$q.notify({
-              timeout: 5000,
-              type: 'positive',
-              message: 'New Order'
-            })
-
-            await this.$refs.directMessagesRef.handleNewMessage(data)
-            return
+          // updates are sent in batches
+          const items = data.type === 'batch' ? data.items : [data]
+          for (const item of items) {
+            await this.handleNotification(item)
           }
-          if (data.type === 'dm:1') {
-            await this.$refs.directMessagesRef.handleNewMessage(data)
-            await this.$refs.orderListRef.addOrder(data)
-            return
-          }
-          if (data.type === 'dm:2') {
-            const orderStatus = JSON.parse(data.dm.message)
-            this.$q.notify({
-              timeout: 5000,
-              type: 'positive',
-              message: orderStatus.message
-            })
-            if (orderStatus.paid) {
-              await this.$refs.orderListRef.orderPaid(orderStatus.id)
-            }
-            await this.$refs.directMessagesRef.handleNewMessage(data)
-            return
-          }
-          if (data.type === 'dm:-1') {
-            await this.$refs.directMessagesRef.handleNewMessage(data)
-          }
-          // order paid
-          // order shipped
         }
       } catch (error) {
         this.$q.notify({
@@ -245,6 +217,41 @@ window.app = Vue.createApp({
         })
       }
     },
+    handleNotification: async function (data) {
+      if (data.type === 'dm:0') {
+        this.$q.notify({
+          timeout: 5000,
+          type: 'positive',
+          message: 'New Order'
+        })
+
+        await this.$refs.directMessagesRef.handleNewMessage(data)
+        return
+      }
+      if (data.type === 'dm:1') {
+        await this.$refs.directMessagesRef.handleNewMessage(data)
+        await this.$refs.orderListRef.addOrder(data)
+        return
+      }
+      if (data.type === 'dm:2') {
+        const orderStatus = JSON.parse(data.dm.message)
+        this.$q.notify({
+          timeout: 5000,
+          type: 'positive',
+          message: orderStatus.message
+        })
+        if (orderStatus.paid) {
+          await this.$refs.orderListRef.orderPaid(orderStatus.id)
+        }
+        await this.$refs.directMessagesRef.handleNewMessage(data)
+        return
+      }
+      if (data.type === 'dm:-1') {
+        await this.$refs.directMessagesRef.handleNewMessage(data)
+      }
+      // order paid
+      // order shipped
+    },
     checkNostrStatus: async function (showNotification = false) {
       try {
         const response = await fetch('/nostrclient/api/v1/relays')
@@ -0,0 +1,273 @@
+import time
+
+from .cache import LRUCache, catalog_cache
+from .crud import (
+    create_direct_messages,
+    create_events,
+    create_product,
+    create_stall,
+    get_catalog_event_times,
+    get_product,
+    get_stall,
+    unit_of_work,
+    update_customer_profiles,
+    update_product,
+    update_stall,
+    update_sync_cursors,
+)
+from .models import CustomerProfile, PartialDirectMessage, Product, Stall
+from .nostr.event import NostrEvent
+
+
+class SyncCursors:
+    """
+    Tracks the `created_at` of the last processed event, per merchant and kind.
+    Cursors are advanced in memory and written to the database in batches.
+    """
+
+    def __init__(self, batch_size: int = 100, flush_interval: int = 10):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending: dict[tuple[str, int], int] = {}
+        self.last_flush_time = time.time()
+
+    def advance(self, merchant_id: str, kind: int, created_at: int):
+        # a paced message is created in the future: the relays are asked for
+        # the events `since` the cursor, the ones sent until then would be lost
+        created_at = min(created_at, round(time.time()))
+        key = (merchant_id, kind)
+        if created_at > self.pending.get(key, 0):
+            self.pending[key] = created_at
+
+    def drop(self, merchant_id: str):
+        """Forget the cursors of a deleted merchant, they are not written."""
+        for key in [key for key in self.pending if key[0] == merchant_id]:
+            del self.pending[key]
+
+    @property
+    def needs_flush(self) -> bool:
+        if not self.pending:
+            return False
+        return (
+            len(self.pending) >= self.batch_size
+            or time.time() - self.last_flush_time > self.flush_interval
+        )
+
+    async def flush(self):
+        self.last_flush_time = time.time()
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        await update_sync_cursors(pending)
+
+
+class DirectMessageBatch:
+    """
+    Direct messages received while backfilling (historical sync).
+    They are written to the database in large batches instead of one by one.
+    """
+
+    def __init__(self, batch_size: int = 500):
+        self.batch_size = batch_size
+        self.pending: list[tuple[str, PartialDirectMessage]] = []
+
+    def add(self, merchant_id: str, dm: PartialDirectMessage):
+        self.pending.append((merchant_id, dm))
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.pending) >= self.batch_size
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        try:
+            await create_direct_messages(pending)
+        except Exception:
+            # keep them, the sync cursors must not move past unsaved messages
+            self.pending = pending + self.pending
+            raise
+
+
+class EventStoreBatch:
+    """
+    Raw events received from the relays, appended to the local event store
+    in batches.
+    """
+
+    def __init__(self, batch_size: int = 500):
+        self.batch_size = batch_size
+        self.pending: list[NostrEvent] = []
+
+    def add(self, event: NostrEvent):
+        self.pending.append(event)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.pending) >= self.batch_size
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        try:
+            await create_events(pending)
+        except Exception:
+            # keep them, the sync cursors must not move past unsaved events
+            self.pending = pending + self.pending
+            raise
+
+
+class CustomerProfileUpdates:
+    """
+    Latest profile (kind 0) of each public key, written to the database in
+    batches. Profiles older than the last saved one are ignored.
+    """
+
+    def __init__(self, batch_size: int = 100, max_known_profiles: int = 10_000):
+        self.batch_size = batch_size
+        self.pending: dict[str, tuple[int, CustomerProfile]] = {}
+        # public_key -> `created_at` of the saved profile
+        self.saved = LRUCache(maxsize=max_known_profiles)
+
+    def add(self, public_key: str, created_at: int, profile: CustomerProfile):
+        pending_created_at, _ = self.pending.get(public_key, (0, None))
+        if created_at <= max(pending_created_at, self.saved.get(public_key, 0)):
+            return
+        self.pending[public_key] = (created_at, profile)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.pending) >= self.batch_size
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            await update_customer_profiles(pending)
+        except Exception:
+            # keep them, unless a newer profile was received meanwhile
+            for public_key, (created_at, profile) in pending.items():
+                pending_created_at, _ = self.pending.get(public_key, (0, None))
+                if created_at > pending_created_at:
+                    self.pending[public_key] = (created_at, profile)
+            raise
+        for public_key, (created_at, _) in pending.items():
+            self.saved.set(public_key, created_at)
+
+
+class CatalogSync:
+    """
+    Stalls and products received from nostr.
+
+    An in-memory index of the saved `event_created_at` (per merchant) is used
+    to skip the events that are not newer than what is already saved, without
+    touching the database. The index of a merchant is reloaded whenever its
+    catalog is changed (the catalog cache generation moves). New and updated
+    items are written in batches, an item is never overwritten by an older
+    event.
+    """
+
+    def __init__(self, batch_size: int = 200, max_merchants: int = 100):
+        self.batch_size = batch_size
+        # (merchant_id, kind, item id) -> (is new, item)
+        self.pending: dict[tuple[str, int, str], tuple[bool, Stall | Product]] = {}
+        # merchant_id -> (catalog generation, {(kind, item id): event_created_at})
+        self.index = LRUCache(maxsize=max_merchants)
+        self.skipped_count = 0
+
+    async def add(self, merchant_id: str, kind: int, item: Stall | Product):
+        assert item.id, "Missing stall or product id"
+        index = await self._get_index(merchant_id)
+
+        key = (kind, item.id)
+        created_at = item.event_created_at or 0
+        pending = self.pending.get((merchant_id, kind, item.id))
+        if pending and (pending[1].event_created_at or 0) >= created_at:
+            self.skipped_count += 1
+            return
+        if key in index and index[key] >= created_at:
+            self.skipped_count += 1
+            return
+
+        is_new = key not in index and not pending
+        self.pending[(merchant_id, kind, item.id)] = (is_new, item)
+
+    async def _get_index(self, merchant_id: str) -> dict[tuple[int, str], int]:
+        # taken before reading, a change made meanwhile forces a new read
+        generation = catalog_cache.generation(merchant_id)
+        cached = self.index.get(merchant_id)
+        if cached and cached[0] == generation:
+            return cached[1]
+        index = await get_catalog_event_times(merchant_id)
+        self.index.set(merchant_id, (generation, index))
+        return index
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.pending) >= self.batch_size
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            async with unit_of_work() as conn:
+                for (merchant_id, _, _), (is_new, item) in pending.items():
+                    if isinstance(item, Stall):
+                        await _save_synced_stall(merchant_id, item, is_new, conn)
+                    else:
+                        await _save_synced_product(merchant_id, item, is_new, conn)
+        except Exception:
+            # keep them, unless a newer event was received meanwhile
+            for key, (is_new, item) in pending.items():
+                newer = self.pending.get(key)
+                if not newer or (newer[1].event_created_at or 0) < (
+                    item.event_created_at or 0
+                ):
+                    self.pending[key] = (is_new, item)
+            raise
+
+
+async def _save_synced_stall(merchant_id: str, stall: Stall, is_new: bool, conn):
+    assert stall.id
+    existing = None if is_new else await get_stall(merchant_id, stall.id, conn)
+    if not existing:
+        await create_stall(merchant_id, stall, conn)
+        return
+    # keep the local only settings (wallet, pending, image)
+    existing.name = stall.name
+    existing.currency = stall.currency
+    existing.shipping_zones = stall.shipping_zones
+    existing.config.description = stall.config.description
+    existing.event_id = stall.event_id
+    existing.event_created_at = stall.event_created_at
+    await update_stall(merchant_id, existing, conn, only_if_newer=True)
+
+
+async def _save_synced_product(merchant_id: str, product: Product, is_new: bool, conn):
+    assert product.id
+    existing = None if is_new else await get_product(merchant_id, product.id, conn)
+    if not existing:
+        await create_product(merchant_id, product, conn)
+        return
+    # keep the local only settings (pending, active, autoreply, shipping)
+    existing.name = product.name
+    existing.images = product.images
+    existing.categories = product.categories
+    existing.price = product.price
+    existing.quantity = product.quantity
+    existing.config.description = product.config.description
+    existing.config.currency = product.config.currency
+    existing.event_id = product.event_id
+    existing.event_created_at = product.event_created_at
+    await update_product(merchant_id, existing, conn, only_if_newer=True)
+
+
+sync_cursors = SyncCursors()
+dm_batch = DirectMessageBatch()
+event_store = EventStoreBatch()
+profile_updates = CustomerProfileUpdates()
+catalog_sync = CatalogSync()
@@ -1,16 +1,33 @@
 import asyncio
+import time
 from asyncio import Queue
 
 from lnbits.core.models import Payment
 from lnbits.tasks import register_invoice_listener
 from loguru import logger
 
+from .crud import get_unfinished_jobs
+from .jobs import start_job
 from .nostr.nostr_client import NostrClient
+from .notifications import merchant_notifications
 from .services import (
+    JOB_RUNNERS,
+    archive_old_records,
+    expire_orders,
+    flush_batched_writes,
+    flush_pending_writes,
     handle_order_paid,
+    has_full_batches,
+    outbox_updated,
     process_nostr_message,
+    prune_outbox_events,
+    send_outbox_events,
     subscribe_to_all_merchants,
 )
+from .sync import sync_cursors
+
+# keeps a reference to the paid invoice handlers running in the background
+paid_invoice_tasks: set[asyncio.Task] = set()
 
 
 async def wait_for_paid_invoices():
@@ -19,7 +36,9 @@ async def wait_for_paid_invoices():
 
     while True:
         payment = await invoice_queue.get()
-        await on_invoice_paid(payment)
+        task = asyncio.create_task(on_invoice_paid(payment))
+        paid_invoice_tasks.add(task)
+        task.add_done_callback(paid_invoice_tasks.discard)
 
 
 async def on_invoice_paid(payment: Payment) -> None:
@@ -42,6 +61,79 @@ async def wait_for_nostr_events(nostr_client: NostrClient):
             while True:
                 message = await nostr_client.get_event()
                 await process_nostr_message(message)
+                if nostr_client.recieve_event_queue.empty() or has_full_batches():
+                    await flush_batched_writes()
+                if sync_cursors.needs_flush:
+                    await flush_pending_writes()
         except Exception as e:
             logger.warning(f"Subcription failed. Will retry in one minute: {e}")
             await asyncio.sleep(10)
+
+
+async def wait_for_outbox_events(nostr_client: NostrClient):
+    connection_count = 0
+    last_prune_time = 0.0
+    while True:
+        try:
+            outbox_updated.clear()
+            resend_before = 0
+            if nostr_client.connection_count != connection_count:
+                # (re)connected: re-send everything not acknowledged by the relays
+                connection_count = nostr_client.connection_count
+                resend_before = round(time.time())
+            await send_outbox_events(resend_before)
+
+            if time.time() - last_prune_time > 60 * 60:
+                await prune_outbox_events()
+                last_prune_time = time.time()
+        except Exception as e:
+            logger.warning(f"Failed to send outbox events: {e}")
+
+        try:
+            await asyncio.wait_for(outbox_updated.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def expire_orders_periodically(interval: int = 5 * 60):
+    while True:
+        try:
+            count = await expire_orders()
+            if count:
+                logger.info(f"Marked {count} unpaid orders as expired.")
+        except Exception as ex:
+            logger.warning(f"Cannot expire unpaid orders: {ex}")
+        await asyncio.sleep(interval)
+
+
+async def archive_periodically(interval: int = 60 * 60):
+    while True:
+        try:
+            messages_count, orders_count = await archive_old_records()
+            if messages_count or orders_count:
+                logger.info(
+                    f"Archived {messages_count} direct messages"
+                    f" and {orders_count} orders."
+                )
+        except Exception as ex:
+            logger.warning(f"Cannot archive old records: {ex}")
+        await asyncio.sleep(interval)
+
+
+async def wait_for_merchant_notifications():
+    while True:
+        try:
+            await merchant_notifications.wait_and_flush()
+        except Exception as ex:
+            logger.warning(ex)
+
+
+async def resume_jobs():
+    """Restart the background jobs interrupted by a shutdown."""
+    for job in await get_unfinished_jobs():
+        runner = JOB_RUNNERS.get(job.kind)
+        if not runner:
+            logger.warning(f"Unknown job kind '{job.kind}' ({job.id}).")
+            continue
+        logger.info(f"Resuming job '{job.kind}' ({job.id}).")
+        start_job(job, runner)
@@ -0,0 +1,63 @@
+import json
+import time
+
+from ..crud import ARCHIVE_AFTER_SECONDS, _maybe_archived, _pack, _unpack
+from ..models import (
+    DirectMessage,
+    Order,
+    OrderContact,
+    OrderExtra,
+    OrderItem,
+    ProductOverview,
+)
+
+
+def test_pack_unpack_direct_message():
+    dm = DirectMessage(
+        id="dm1",
+        event_id="e" * 64,
+        event_created_at=1700000000,
+        message=json.dumps({"type": 0, "id": "order1"}),
+        public_key="a" * 64,
+        type=0,
+        incoming=True,
+    )
+    packed = _pack(dm)
+    assert isinstance(packed, str)
+    assert _unpack(DirectMessage, packed) == dm
+
+
+def test_pack_unpack_order():
+    order = Order(
+        id="order1",
+        event_id="e" * 64,
+        event_created_at=1700000000,
+        public_key="a" * 64,
+        merchant_public_key="b" * 64,
+        shipping_id="zone1",
+        items=[OrderItem(product_id="p1", quantity=2)],
+        contact=OrderContact(email="alice@example.com"),
+        stall_id="stall1",
+        invoice_id="invoice1",
+        total=2100,
+        paid=True,
+        shipped=True,
+        extra=OrderExtra(
+            products=[ProductOverview(id="p1", name="Tea", price=1000)],
+            currency="sat",
+            btc_price="1",
+            shipping_cost=100,
+            shipping_cost_sat=100,
+        ),
+    )
+    unpacked = _unpack(Order, _pack(order))
+    assert unpacked == order
+    assert unpacked.items[0].quantity == 2
+    assert unpacked.extra.products[0].name == "Tea"
+
+
+def test_only_old_events_can_be_archived():
+    now = round(time.time())
+    assert _maybe_archived(now - ARCHIVE_AFTER_SECONDS - 60)
+    assert not _maybe_archived(now)
+    assert not _maybe_archived(None)
@@ -0,0 +1,98 @@
+from ..cache import CatalogCache, LRUCache
+
+
+def test_lru_cache_evicts_the_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # read: "b" is now the least recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_replace_and_pop():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("a", 10)
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 10
+    assert cache.pop("a") == 10
+    assert cache.get("a", "missing") == "missing"
+    assert cache.pop("a") is None
+
+
+def test_catalog_cache_hit_and_miss():
+    cache = CatalogCache()
+    generation = cache.generation("m1")
+    assert cache.get("m1", ("stalls",)) == (False, None)
+    cache.set("m1", ("stall", "s1"), None, generation)
+    # nothing in the database is cached too
+    assert cache.get("m1", ("stall", "s1")) == (True, None)
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 1
+
+
+def test_catalog_cache_stores_a_copy_and_returns_it_as_is():
+    cache = CatalogCache()
+    stalls = ["s1"]
+    cache.set("m1", ("stalls",), stalls, cache.generation("m1"))
+    stalls.append("changed by the caller")
+
+    _, cached = cache.get("m1", ("stalls",))
+    assert cached == ["s1"]
+    # no copy on hits
+    assert cache.get("m1", ("stalls",))[1] is cached
+
+
+def test_catalog_cache_invalidation():
+    cache = CatalogCache()
+    generation = cache.generation("m1")
+    cache.set("m1", ("stalls",), ["s1"], generation)
+    cache.set("m2", ("stalls",), ["s2"], cache.generation("m2"))
+
+    cache.invalidate("m1")
+    assert cache.get("m1", ("stalls",)) == (False, None)
+    assert cache.get("m2", ("stalls",)) == (True, ["s2"])
+    assert cache.size_bytes == len("s2")
+
+    # read before the invalidation: might be stale, not cached
+    cache.set("m1", ("stalls",), ["s1"], generation)
+    assert cache.get("m1", ("stalls",)) == (False, None)
+    cache.set("m1", ("stalls",), ["s1"], cache.generation("m1"))
+    assert cache.get("m1", ("stalls",)) == (True, ["s1"])
+
+
+def test_catalog_cache_evicts_the_least_recently_used_merchant():
+    cache = CatalogCache(max_merchants=2)
+    for merchant_id in ("m1", "m2"):
+        cache.set(merchant_id, ("stalls",), [merchant_id], 0)
+    cache.get("m1", ("stalls",))
+    cache.set("m3", ("stalls",), ["m3"], 0)
+    assert cache.get("m2", ("stalls",)) == (False, None)
+    assert cache.get("m1", ("stalls",)) == (True, ["m1"])
+
+
+def test_catalog_cache_size_limit():
+    cache = CatalogCache(max_bytes=10)
+    cache.set("m1", ("stalls",), ["a" * 6], 0)
+    cache.set("m2", ("stalls",), ["b" * 6], 0)
+    assert cache.get("m1", ("stalls",)) == (False, None)
+    assert cache.size_bytes == 6
+    # too large on its own
+    cache.set("m3", ("stalls",), ["c" * 11], 0)
+    assert cache.get("m3", ("stalls",)) == (False, None)
+    # a replaced entry is counted once
+    cache.set("m2", ("stalls",), ["d" * 4], 0)
+    assert cache.size_bytes == 4
+
+
+def test_catalog_cache_disabled():
+    cache = CatalogCache(enabled=False)
+    cache.set("m1", ("stalls",), ["s1"], 0)
+    assert cache.get("m1", ("stalls",)) == (False, None)
@@ -0,0 +1,36 @@
+from ..nostr.event import NostrEvent
+
+
+def _leading_zero_bits(hex_id: str) -> int:
+    bits = bin(int(hex_id, 16))[2:].zfill(256)
+    return len(bits) - len(bits.lstrip("0"))
+
+
+def _mine(difficulty: int, target: int | None = None) -> NostrEvent:
+    """NIP-13: change the `nonce` tag until the id has enough leading zeros."""
+    event = NostrEvent(pubkey="a" * 64, created_at=1700000000, kind=4)
+    nonce = 0
+    while True:
+        event.tags = [["nonce", str(nonce), str(target or difficulty)]]
+        event.id = event.event_id
+        if _leading_zero_bits(event.id) >= difficulty:
+            return event
+        nonce += 1
+
+
+def test_pow_difficulty_counts_the_leading_zero_bits():
+    event = _mine(8)
+    assert event.pow_difficulty() == _leading_zero_bits(event.id)
+    assert event.pow_difficulty() >= 8
+
+
+def test_pow_difficulty_of_a_lower_target():
+    # a lucky id does not count more than the committed target
+    event = _mine(8, target=4)
+    assert event.pow_difficulty() == 4
+
+
+def test_pow_difficulty_of_a_wrong_id():
+    event = _mine(8)
+    event.content = "changed"
+    assert event.pow_difficulty() == 0
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import sys
+from types import ModuleType
+from typing import ClassVar
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from ..nostr.local_connection import LocalConnection, find_nostr_router_class
+from ..nostr.nostr_client import NostrClient
+
+
+class StandInRouter:
+    """Behaves like the nostrclient `NostrRouter`: answers every REQ with EOSE."""
+
+    instances: ClassVar[list["StandInRouter"]] = []
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.connected = False
+        self.received: list = []
+        self.task: asyncio.Task | None = None
+        StandInRouter.instances.append(self)
+
+    def start(self):
+        self.connected = True
+        self.task = asyncio.create_task(self._client_to_nostr())
+
+    async def stop(self):
+        self.connected = False
+        if self.task:
+            self.task.cancel()
+
+    async def _client_to_nostr(self):
+        try:
+            while True:
+                req = json.loads(await self.websocket.receive_text())
+                self.received.append(req)
+                if req[0] == "REQ":
+                    await self.websocket.send_text(json.dumps(["EOSE", req[1]]))
+        except WebSocketDisconnect:
+            self.connected = False
+
+
+@pytest.fixture
+def all_routers(monkeypatch) -> list:
+    StandInRouter.instances = []
+    module = ModuleType("nostrclient.router")
+    module.NostrRouter = StandInRouter  # type: ignore
+    module.all_routers = []  # type: ignore
+    monkeypatch.setitem(sys.modules, "nostrclient.router", module)
+    return module.all_routers  # type: ignore
+
+
+async def _wait_until(condition, timeout: float = 1):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Condition not met in time")
+
+
+def test_router_class_must_match_the_interface(all_routers, monkeypatch):
+    assert find_nostr_router_class() is StandInRouter
+
+    monkeypatch.delattr(StandInRouter, "stop")
+    assert find_nostr_router_class() is None
+
+
+@pytest.mark.asyncio
+async def test_connect_receive_and_drop(all_routers):
+    messages: list[str] = []
+
+    async def on_message(message: str):
+        messages.append(message)
+
+    connection = LocalConnection(StandInRouter, on_message)
+    await connection.open()
+    router = StandInRouter.instances[0]
+    assert connection.keep_running
+    assert all_routers == [router]
+
+    connection.send(json.dumps(["REQ", "sub", {"kinds": [4]}]))
+    await _wait_until(lambda: messages)
+    assert router.received == [["REQ", "sub", {"kinds": [4]}]]
+    assert messages == [json.dumps(["EOSE", "sub"])]
+
+    # nostrclient stops the router (eg: the extension is disabled)
+    await router.stop()
+    assert not connection.keep_running
+    with pytest.raises(ConnectionError):
+        connection.send(json.dumps(["REQ", "sub", {}]))
+
+    connection.close()
+    await _wait_until(lambda: not all_routers)
+
+
+@pytest.mark.asyncio
+async def test_client_resubscribes_after_drop(all_routers):
+    client = NostrClient()
+    task = asyncio.create_task(client.run_forever())
+    try:
+        await client.send_req_queue.put(["REQ", "sub1", {}])
+        message = await asyncio.wait_for(client.get_event(), 1)
+        assert message == json.dumps(["EOSE", "sub1"])
+
+        first_router = StandInRouter.instances[0]
+        await first_router.stop()
+
+        await client.send_req_queue.put(["REQ", "sub2", {}])
+        # the drop is reported, so the merchants get subscribed again
+        with pytest.raises(ValueError):
+            await asyncio.wait_for(client.get_event(), 1)
+
+        await _wait_until(lambda: len(StandInRouter.instances) == 2)
+        second_router = StandInRouter.instances[1]
+        await _wait_until(lambda: second_router.received)
+        assert second_router.received == [["REQ", "sub2", {}]]
+        await _wait_until(lambda: all_routers == [second_router])
+    finally:
+        client.running = False
+        task.cancel()
@@ -0,0 +1,74 @@
+import pytest
+
+from ..models import IncomingDmQuotas
+from ..ratelimit import IncomingDmLimits, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Monotonic time moved by the test."""
+    now = [1000.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+    return now
+
+
+def test_burst_then_empty(clock):
+    bucket = TokenBucket()
+    assert all(bucket.take("alice", rate=1, burst=3) for _ in range(3))
+    assert not bucket.take("alice", rate=1, burst=3)
+    # every key has its own bucket
+    assert bucket.take("bob", rate=1, burst=3)
+
+
+def test_refill(clock):
+    bucket = TokenBucket()
+    for _ in range(2):
+        bucket.take("alice", rate=2, burst=2)
+    assert not bucket.take("alice", rate=2, burst=2)
+
+    clock[0] += 0.5
+    assert bucket.take("alice", rate=2, burst=2)
+    assert not bucket.take("alice", rate=2, burst=2)
+
+    # refilled up to the burst, not more
+    clock[0] += 60
+    assert bucket.take("alice", rate=2, burst=2)
+    assert bucket.take("alice", rate=2, burst=2)
+    assert not bucket.take("alice", rate=2, burst=2)
+
+
+def test_failed_take_does_not_reset_the_refill(clock):
+    bucket = TokenBucket()
+    bucket.take("alice", rate=1, burst=1)
+    clock[0] += 0.5
+    assert not bucket.take("alice", rate=1, burst=1)
+    clock[0] += 0.5
+    assert bucket.take("alice", rate=1, burst=1)
+
+
+def test_forgotten_keys_start_full(clock):
+    bucket = TokenBucket(max_keys=1)
+    bucket.take("alice", rate=1, burst=1)
+    assert not bucket.take("alice", rate=1, burst=1)
+    bucket.take("bob", rate=1, burst=1)
+    assert bucket.take("alice", rate=1, burst=1)
+
+
+def test_incoming_dm_limits(clock):
+    limits = IncomingDmLimits()
+    quotas = IncomingDmQuotas(
+        sender_rate=1, sender_burst=1, new_customer_rate=1, new_customer_burst=2
+    )
+    assert limits.allow_sender("m1", "alice", quotas)
+    assert not limits.allow_sender("m1", "alice", quotas)
+    # per merchant
+    assert limits.allow_sender("m2", "alice", quotas)
+
+    assert limits.allow_new_customer("m1", 0, quotas)
+    assert limits.allow_new_customer("m1", 0, quotas)
+    assert not limits.allow_new_customer("m1", 0, quotas)
+
+    quotas.new_customer_pow = 8
+    assert not limits.allow_new_customer("m2", 7, quotas)
+    assert limits.allow_new_customer("m2", 8, quotas)
+    assert limits.stats["shed"] == {"sender": 1, "new_customer": 1, "pow": 1}
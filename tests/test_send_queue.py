@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from ..nostr.send_queue import (
+    PRIORITY_BULK,
+    PRIORITY_DIRECT_MESSAGE,
+    PRIORITY_ORDER_MESSAGE,
+    PRIORITY_SUBSCRIPTION,
+    PrioritySendQueue,
+    frame_priority,
+)
+
+
+def _event(kind: int, content: str = "") -> list:
+    return ["EVENT", {"kind": kind, "content": content}]
+
+
+def test_frame_priority():
+    assert frame_priority(["REQ", "sub", {}]) == PRIORITY_SUBSCRIPTION
+    assert frame_priority(["CLOSE", "sub"]) == PRIORITY_SUBSCRIPTION
+    assert frame_priority(_event(4)) == PRIORITY_DIRECT_MESSAGE
+    assert frame_priority(_event(30018)) == PRIORITY_BULK
+
+
+@pytest.mark.asyncio
+async def test_most_urgent_class_first():
+    queue = PrioritySendQueue()
+    await queue.put(_event(30017, "stall"))
+    await queue.put(_event(4, "chat"))
+    await queue.put(["REQ", "sub", {}])
+    await queue.put(_event(4, "payment request"), PRIORITY_ORDER_MESSAGE)
+    await queue.put(_event(30018, "product"))
+    assert queue.sizes() == [1, 1, 1, 2]
+
+    frames = [await queue.get() for _ in range(5)]
+    assert [priority for priority, _ in frames] == [0, 1, 2, 3, 3]
+    # first in, first out within a class
+    assert [frame[-1]["content"] for _, frame in frames[-2:]] == ["stall", "product"]
+    assert queue.qsize() == 0
+
+
+@pytest.mark.asyncio
+async def test_retries_keep_their_class():
+    queue = PrioritySendQueue()
+    await queue.put(_event(30018, "product"))
+    priority, frame = await queue.get()
+    await queue.put(_event(30017, "stall"))
+    await queue.put(_event(4, "chat"))
+
+    assert queue.retry(frame, priority)
+    assert queue.retry_size() == 1
+    # not before a more urgent class, but before the others of its class
+    assert await queue.get() == (PRIORITY_DIRECT_MESSAGE, _event(4, "chat"))
+    assert await queue.get() == (PRIORITY_BULK, _event(30018, "product"))
+    assert await queue.get() == (PRIORITY_BULK, _event(30017, "stall"))
+
+
+@pytest.mark.asyncio
+async def test_full_retries_drop_the_oldest():
+    queue = PrioritySendQueue(max_retries=1)
+    assert queue.retry(_event(4, "first"), PRIORITY_DIRECT_MESSAGE)
+    assert not queue.retry(_event(4, "second"), PRIORITY_DIRECT_MESSAGE)
+    assert queue.qsize() == 1
+
+    assert await queue.get() == (PRIORITY_DIRECT_MESSAGE, _event(4, "second"))
+    # the dropped frame did not leave a permit behind
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(queue.get(), timeout=0.05)
+
+
+@pytest.mark.asyncio
+async def test_get_waits_for_a_frame():
+    queue = PrioritySendQueue()
+    task = asyncio.create_task(queue.get())
+    await asyncio.sleep(0)
+    assert not task.done()
+
+    queue.put_nowait(["CLOSE", "sub"])
+    assert await asyncio.wait_for(task, timeout=1) == (
+        PRIORITY_SUBSCRIPTION,
+        ["CLOSE", "sub"],
+    )
+
+
+@pytest.mark.asyncio
+async def test_full_class_does_not_block_the_others():
+    queue = PrioritySendQueue(maxsize=1)
+    await queue.put(_event(30018, "product"))
+    blocked = asyncio.create_task(queue.put(_event(30018, "other product")))
+    await asyncio.sleep(0)
+    assert not blocked.done()
+
+    await asyncio.wait_for(queue.put(_event(4, "chat")), timeout=1)
+    assert await queue.get() == (PRIORITY_DIRECT_MESSAGE, _event(4, "chat"))
+    assert await queue.get() == (PRIORITY_BULK, _event(30018, "product"))
+    await asyncio.wait_for(blocked, timeout=1)
+    assert await queue.get() == (PRIORITY_BULK, _event(30018, "other product"))
@@ -1,31 +1,32 @@
 import json
 from http import HTTPStatus
 
-from fastapi import Depends
+from fastapi import Depends, Query, Request, Response
 from fastapi.exceptions import HTTPException
 from lnbits.core.models import WalletTypeInfo
-from lnbits.core.services import websocket_updater
 from lnbits.decorators import (
+    check_admin,
     require_admin_key,
     require_invoice_key,
 )
+from lnbits.helpers import urlsafe_short_hash
 from lnbits.utils.exchange_rates import currencies
 from loguru import logger
 
 from . import nostr_client, nostrmarket_ext
+from .cache import catalog_cache
 from .crud import (
+    count_merchant_events,
+    count_order_direct_messages,
+    count_unsent_outbox_events,
     create_customer,
-    create_direct_message,
+    create_job,
     create_merchant,
     create_product,
     create_stall,
     create_zone,
     delete_merchant,
-    delete_merchant_direct_messages,
-    delete_merchant_orders,
-    delete_merchant_products,
-    delete_merchant_stalls,
-    delete_merchant_zones,
+    delete_merchant_jobs,
     delete_product,
     delete_stall,
     delete_zone,
@@ -33,14 +34,13 @@ from .crud import (
     get_customers,
     get_direct_message_by_event_id,
     get_direct_messages,
-    get_last_direct_messages_time,
+    get_last_job,
     get_merchant_by_pubkey,
     get_merchant_for_user,
     get_order,
     get_order_by_event_id,
     get_orders,
     get_orders_for_stall,
-    get_orders_from_direct_messages,
     get_product,
     get_products,
     get_stall,
@@ -48,6 +48,7 @@ from .crud import (
     get_zone,
     get_zones,
     touch_merchant,
+    unit_of_work,
     update_customer_no_unread_messages,
     update_merchant,
     update_order,
@@ -57,12 +58,15 @@ from .crud import (
     update_zone,
 )
 from .helpers import normalize_public_key
+from .jobs import start_job, stop_merchant_jobs
 from .models import (
     Customer,
     DirectMessage,
     DirectMessageType,
+    Job,
     Merchant,
     MerchantConfig,
+    MerchantSyncState,
     Order,
     OrderReissue,
     OrderStatusUpdate,
@@ -75,15 +79,27 @@ from .models import (
     Stall,
     Zone,
 )
+from .ratelimit import incoming_dm_limits
 from .services import (
+    EVENTS_REPLAY_JOB,
+    EVENTS_REPLAY_KINDS,
+    MERCHANT_DELETE_JOB,
+    ORDER_RESTORE_JOB,
     build_order_with_payment,
+    count_merchant_data,
     create_or_update_order_from_dm,
+    delete_merchant_data,
+    get_public_catalog,
+    persist_and_publish_dm,
+    replay_events,
     reply_to_structured_dm,
-    resubscribe_to_all_merchants,
-    sign_and_send_to_nostr,
-    subscribe_to_all_merchants,
+    restore_orders_from_direct_messages,
+    send_dm,
+    send_to_nostr,
+    sign_nostr_event,
     update_merchant_to_nostr,
 )
+from .sync import sync_cursors
 
 ######################################## MERCHANT ######################################
 
@@ -111,9 +127,8 @@ async def api_create_merchant(
             ),
         )
 
-        await resubscribe_to_all_merchants()
-
-        await nostr_client.merchant_temp_subscription(data.public_key)
+        # new merchant: fetch all its past events and keep streaming new ones
+        await nostr_client.subscribe_merchant(data.public_key)
 
         return merchant
     except AssertionError as ex:
@@ -141,9 +156,10 @@ async def api_get_merchant(
 
         merchant = await touch_merchant(wallet.wallet.user, merchant.id)
         assert merchant
-        last_dm_time = await get_last_direct_messages_time(merchant.id)
-        assert merchant.time
-        merchant.config.restore_in_progress = (merchant.time - last_dm_time) < 30
+        sync_state = nostr_client.backfill_state(merchant.public_key)
+        merchant.config.restore_in_progress = bool(
+            sync_state and not sync_state["done"]
+        )
 
         return merchant
     except Exception as ex:
@@ -158,23 +174,39 @@ async def api_get_merchant(
 async def api_delete_merchant(
     merchant_id: str,
     wallet: WalletTypeInfo = Depends(require_admin_key),
-):
-
+) -> Job:
+    """
+    The merchant is deleted right away, its data by a background job.
+    """
     try:
         merchant = await get_merchant_for_user(wallet.wallet.user)
         assert merchant, "Merchant cannot be found"
         assert merchant.id == merchant_id, "Wrong merchant ID"
 
-        await nostr_client.unsubscribe_merchants()
-
-        await delete_merchant_orders(merchant.id)
-        await delete_merchant_products(merchant.id)
-        await delete_merchant_stalls(merchant.id)
-        await delete_merchant_direct_messages(merchant.id)
-        await delete_merchant_zones(merchant.id)
-
-        await delete_merchant(merchant.id)
+        await nostr_client.unsubscribe_merchant(merchant.public_key)
+        # the restore and replay jobs would keep writing the merchant data
+        await stop_merchant_jobs(merchant.id)
+
+        total = await count_merchant_data(merchant.id)
+        total += await count_merchant_events(merchant.public_key, None)
+        async with unit_of_work() as conn:
+            await delete_merchant(merchant.id, conn)
+            # not resumed on the next start either
+            await delete_merchant_jobs(merchant.id, conn=conn)
+            # the merchant is gone, its owner and public key are kept on the job
+            job = await create_job(
+                merchant.id,
+                MERCHANT_DELETE_JOB,
+                total,
+                conn,
+                user_id=wallet.wallet.user,
+                cursor=merchant.public_key,
+            )
+        # the merchant is gone, no new cursors: do not write the pending ones
+        sync_cursors.drop(merchant.id)
+        start_job(job, delete_merchant_data)
 
+        return job
     except AssertionError as ex:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
@@ -186,8 +218,30 @@ async def api_delete_merchant(
             status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
             detail="Cannot get merchant",
         ) from ex
-    finally:
-        await subscribe_to_all_merchants()
+
+
+@nostrmarket_ext.get("/api/v1/merchant/{merchant_id}/delete")
+async def api_get_merchant_delete_status(
+    merchant_id: str,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+) -> Job | None:
+    """Progress of the data deletion. The merchant itself is already deleted."""
+    try:
+        job = await get_last_job(merchant_id, MERCHANT_DELETE_JOB)
+        if not job or job.user_id != wallet.wallet.user:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND,
+                detail="Merchant delete job does not exist.",
+            )
+        return job
+    except HTTPException as ex:
+        raise ex
+    except Exception as ex:
+        logger.warning(ex)
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail="Cannot get merchant delete status",
+        ) from ex
 
 
 @nostrmarket_ext.patch("/api/v1/merchant/{merchant_id}")
@@ -255,7 +309,7 @@ async def api_refresh_merchant(
         assert merchant, "Merchant cannot be found"
         assert merchant.id == merchant_id, "Wrong merchant ID"
 
-        await nostr_client.merchant_temp_subscription(merchant.public_key)
+        nostr_client.merchant_temp_subscription(merchant.public_key)
 
     except AssertionError as ex:
         raise HTTPException(
@@ -270,6 +324,92 @@ async def api_refresh_merchant(
         ) from ex
 
 
+@nostrmarket_ext.get("/api/v1/merchant/{merchant_id}/sync")
+async def api_get_merchant_sync_state(
+    merchant_id: str,
+    wallet: WalletTypeInfo = Depends(require_invoice_key),
+) -> MerchantSyncState:
+    try:
+        merchant = await get_merchant_for_user(wallet.wallet.user)
+        assert merchant, "Merchant cannot be found"
+        assert merchant.id == merchant_id, "Wrong merchant ID"
+
+        sync_state = nostr_client.backfill_state(merchant.public_key)
+        return MerchantSyncState(**sync_state) if sync_state else MerchantSyncState()
+    except AssertionError as ex:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=str(ex),
+        ) from ex
+    except Exception as ex:
+        logger.warning(ex)
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail="Cannot get merchant sync state",
+        ) from ex
+
+
+@nostrmarket_ext.put("/api/v1/merchant/{merchant_id}/replay")
+async def api_replay_merchant_events(
+    merchant_id: str,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+) -> Job:
+    """
+    Re-apply the locally stored events (nothing is deleted first). Only the
+    events received since the event store exists are replayed, older data
+    must be resynced from the relays.
+    """
+    try:
+        merchant = await get_merchant_for_user(wallet.wallet.user)
+        assert merchant, "Merchant cannot be found"
+        assert merchant.id == merchant_id, "Wrong merchant ID"
+
+        job = await get_last_job(merchant.id, EVENTS_REPLAY_JOB)
+        if not job or job.is_finished:
+            total = await count_merchant_events(
+                merchant.public_key, EVENTS_REPLAY_KINDS
+            )
+            job = await create_job(merchant.id, EVENTS_REPLAY_JOB, total)
+        start_job(job, replay_events)
+
+        return job
+    except AssertionError as ex:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=str(ex),
+        ) from ex
+    except Exception as ex:
+        logger.warning(ex)
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail="Cannot replay merchant events",
+        ) from ex
+
+
+@nostrmarket_ext.get("/api/v1/merchant/{merchant_id}/replay")
+async def api_get_replay_merchant_events_status(
+    merchant_id: str,
+    wallet: WalletTypeInfo = Depends(require_invoice_key),
+) -> Job | None:
+    try:
+        merchant = await get_merchant_for_user(wallet.wallet.user)
+        assert merchant, "Merchant cannot be found"
+        assert merchant.id == merchant_id, "Wrong merchant ID"
+
+        return await get_last_job(merchant.id, EVENTS_REPLAY_JOB)
+    except AssertionError as ex:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=str(ex),
+        ) from ex
+    except Exception as ex:
+        logger.warning(ex)
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail="Cannot get merchant events replay status",
+        ) from ex
+
+
 @nostrmarket_ext.put("/api/v1/merchant/{merchant_id}/toggle")
 async def api_toggle_merchant(
     merchant_id: str,
@@ -442,12 +582,14 @@ async def api_create_stall(
 
         merchant = await get_merchant_for_user(wallet.wallet.user)
         assert merchant, "Merchant cannot be found"
-        stall = await create_stall(merchant.id, data=data)
-
-        event = await sign_and_send_to_nostr(merchant, stall)
 
-        stall.event_id = event.id
-        await update_stall(merchant.id, stall)
+        data.id = data.id or urlsafe_short_hash()
+        event = sign_nostr_event(merchant, data)
+        data.event_id = event.id
+        data.event_created_at = event.created_at
+        async with unit_of_work() as conn:
+            stall = await create_stall(merchant.id, data, conn)
+            await send_to_nostr(merchant.id, event, conn)
 
         return stall
 
@@ -475,13 +617,13 @@ async def api_update_stall(
         merchant = await get_merchant_for_user(wallet.wallet.user)
         assert merchant, "Merchant cannot be found"
 
-        stall = await update_stall(merchant.id, data)
-        assert stall, "Cannot update stall"
-
-        event = await sign_and_send_to_nostr(merchant, stall)
-
-        stall.event_id = event.id
-        await update_stall(merchant.id, stall)
+        event = sign_nostr_event(merchant, data)
+        data.event_id = event.id
+        data.event_created_at = event.created_at
+        async with unit_of_work() as conn:
+            stall = await update_stall(merchant.id, data, conn)
+            assert stall, "Cannot update stall"
+            await send_to_nostr(merchant.id, event, conn)
 
         return stall
 
@@ -579,6 +721,7 @@ async def api_get_stall_orders(
     stall_id: str,
     paid: bool | None = None,
     shipped: bool | None = None,
+    expired: bool | None = None,
     pubkey: str | None = None,
     wallet: WalletTypeInfo = Depends(require_invoice_key),
 ):
@@ -586,7 +729,12 @@ async def api_get_stall_orders(
         merchant = await get_merchant_for_user(wallet.wallet.user)
         assert merchant, "Merchant cannot be found"
         orders = await get_orders_for_stall(
-            merchant.id, stall_id, paid=paid, shipped=shipped, public_key=pubkey
+            merchant.id,
+            stall_id,
+            paid=paid,
+            shipped=shipped,
+            expired=expired,
+            public_key=pubkey,
         )
         return orders
     except AssertionError as ex:
@@ -616,12 +764,10 @@ async def api_delete_stall(
                 detail="Stall does not exist.",
             )
 
-        await delete_stall(merchant.id, stall_id)
-
-        event = await sign_and_send_to_nostr(merchant, stall, True)
-
-        stall.event_id = event.id
-        await update_stall(merchant.id, stall)
+        event = sign_nostr_event(merchant, stall, True)
+        async with unit_of_work() as conn:
+            await delete_stall(merchant.id, stall_id, conn)
+            await send_to_nostr(merchant.id, event, conn)
 
     except AssertionError as ex:
         raise HTTPException(
@@ -652,12 +798,13 @@ async def api_create_product(
         assert stall, "Stall missing for product"
         data.config.currency = stall.currency
 
-        product = await create_product(merchant.id, data=data)
-
-        event = await sign_and_send_to_nostr(merchant, product)
-
-        product.event_id = event.id
-        await update_product(merchant.id, product)
+        data.id = data.id or urlsafe_short_hash()
+        event = sign_nostr_event(merchant, data)
+        data.event_id = event.id
+        data.event_created_at = event.created_at
+        async with unit_of_work() as conn:
+            product = await create_product(merchant.id, data, conn)
+            await send_to_nostr(merchant.id, event, conn)
 
         return product
     except (ValueError, AssertionError) as ex:
@@ -690,10 +837,12 @@ async def api_update_product(
         assert stall, "Stall missing for product"
         product.config.currency = stall.currency
 
-        product = await update_product(merchant.id, product)
-        event = await sign_and_send_to_nostr(merchant, product)
+        event = sign_nostr_event(merchant, product)
         product.event_id = event.id
-        await update_product(merchant.id, product)
+        product.event_created_at = event.created_at
+        async with unit_of_work() as conn:
+            product = await update_product(merchant.id, product, conn)
+            await send_to_nostr(merchant.id, event, conn)
 
         return product
     except (ValueError, AssertionError) as ex:
@@ -749,8 +898,10 @@ async def api_delete_product(
                 detail="Product does not exist.",
             )
 
-        await delete_product(merchant.id, product_id)
-        await sign_and_send_to_nostr(merchant, product, True)
+        event = sign_nostr_event(merchant, product, True)
+        async with unit_of_work() as conn:
+            await delete_product(merchant.id, product_id, conn)
+            await send_to_nostr(merchant.id, event, conn)
 
     except AssertionError as ex:
         raise HTTPException(
@@ -770,13 +921,15 @@ async def api_delete_product(
 
 @nostrmarket_ext.get("/api/v1/order/{order_id}")
 async def api_get_order(
-    order_id: str, wallet: WalletTypeInfo = Depends(require_invoice_key)
+    order_id: str,
+    include_archived: bool = False,
+    wallet: WalletTypeInfo = Depends(require_invoice_key),
 ):
     try:
         merchant = await get_merchant_for_user(wallet.wallet.user)
         assert merchant, "Merchant cannot be found"
 
-        order = await get_order(merchant.id, order_id)
+        order = await get_order(merchant.id, order_id, include_archived)
         if not order:
             raise HTTPException(
                 status_code=HTTPStatus.NOT_FOUND,
@@ -800,7 +953,9 @@ async def api_get_order(
 async def api_get_orders(
     paid: bool | None = None,
     shipped: bool | None = None,
+    expired: bool | None = None,
     pubkey: str | None = None,
+    include_archived: bool = False,
     wallet: WalletTypeInfo = Depends(require_invoice_key),
 ):
     try:
@@ -808,7 +963,12 @@ async def api_get_orders(
         assert merchant, "Merchant cannot be found"
 
         orders = await get_orders(
-            merchant_id=merchant.id, paid=paid, shipped=shipped, public_key=pubkey
+            merchant_id=merchant.id,
+            include_archived=include_archived,
+            paid=paid,
+            shipped=shipped,
+            expired=expired,
+            public_key=pubkey,
         )
         return orders
     except AssertionError as ex:
@@ -844,27 +1004,11 @@ async def api_update_order_status(
             ensure_ascii=False,
         )
 
-        dm_event = merchant.build_dm_event(dm_content, order.public_key)
-
-        dm = PartialDirectMessage(
-            event_id=dm_event.id,
-            event_created_at=dm_event.created_at,
-            message=dm_content,
-            public_key=order.public_key,
-            type=DirectMessageType.ORDER_PAID_OR_SHIPPED.value,
-        )
-        await create_direct_message(merchant.id, dm)
-
-        await nostr_client.publish_nostr_event(dm_event)
-        await websocket_updater(
-            merchant.id,
-            json.dumps(
-                {
-                    "type": f"dm:{dm.type}",
-                    "customerPubkey": order.public_key,
-                    "dm": dm.dict(),
-                }
-            ),
+        await send_dm(
+            merchant,
+            order.public_key,
+            DirectMessageType.ORDER_PAID_OR_SHIPPED.value,
+            dm_content,
         )
 
         return order
@@ -914,22 +1058,18 @@ async def api_restore_order(
 @nostrmarket_ext.put("/api/v1/orders/restore")
 async def api_restore_orders(
     wallet: WalletTypeInfo = Depends(require_admin_key),
-) -> None:
+) -> Job:
     try:
         merchant = await get_merchant_for_user(wallet.wallet.user)
         assert merchant, "Merchant cannot be found"
 
-        dms = await get_orders_from_direct_messages(merchant.id)
-        for dm in dms:
-            try:
-                await create_or_update_order_from_dm(
-                    merchant.id, merchant.public_key, dm
-                )
-            except Exception as e:
-                logger.debug(
-                    f"Failed to restore order from event '{dm.event_id}': '{e!s}'."
-                )
+        job = await get_last_job(merchant.id, ORDER_RESTORE_JOB)
+        if not job or job.is_finished:
+            total = await count_order_direct_messages(merchant.id)
+            job = await create_job(merchant.id, ORDER_RESTORE_JOB, total)
+        start_job(job, restore_orders_from_direct_messages)
 
+        return job
     except AssertionError as ex:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
@@ -943,6 +1083,28 @@ async def api_restore_orders(
         ) from ex
 
 
+@nostrmarket_ext.get("/api/v1/orders/restore")
+async def api_get_restore_orders_status(
+    wallet: WalletTypeInfo = Depends(require_invoice_key),
+) -> Job | None:
+    try:
+        merchant = await get_merchant_for_user(wallet.wallet.user)
+        assert merchant, "Merchant cannot be found"
+
+        return await get_last_job(merchant.id, ORDER_RESTORE_JOB)
+    except AssertionError as ex:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=str(ex),
+        ) from ex
+    except Exception as ex:
+        logger.warning(ex)
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail="Cannot get orders restore status",
+        ) from ex
+
+
 @nostrmarket_ext.put("/api/v1/order/reissue")
 async def api_reissue_order_invoice(
     reissue_data: OrderReissue,
@@ -1012,13 +1174,27 @@ async def api_reissue_order_invoice(
 
 @nostrmarket_ext.get("/api/v1/message/{public_key}")
 async def api_get_messages(
-    public_key: str, wallet: WalletTypeInfo = Depends(require_invoice_key)
+    public_key: str,
+    inserted_after: int | None = None,
+    until: int | None = None,
+    limit: int | None = Query(None, ge=1, le=1000),
+    include_archived: bool = False,
+    before_id: str | None = None,
+    wallet: WalletTypeInfo = Depends(require_invoice_key),
 ) -> list[DirectMessage]:
     try:
         merchant = await get_merchant_for_user(wallet.wallet.user)
         assert merchant, "Merchant cannot be found"
 
-        messages = await get_direct_messages(merchant.id, public_key)
+        messages = await get_direct_messages(
+            merchant.id,
+            public_key,
+            inserted_after,
+            until,
+            limit,
+            include_archived,
+            before_id,
+        )
         await update_customer_no_unread_messages(merchant.id, public_key)
         return messages
     except AssertionError as ex:
@@ -1046,10 +1222,7 @@ async def api_create_message(
         data.event_id = dm_event.id
         data.event_created_at = dm_event.created_at
 
-        dm = await create_direct_message(merchant.id, data)
-        await nostr_client.publish_nostr_event(dm_event)
-
-        return dm
+        return await persist_and_publish_dm(merchant, data, dm_event)
     except AssertionError as ex:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
@@ -1108,7 +1281,7 @@ async def api_create_customer(
             merchant.id, Customer(merchant_id=merchant.id, public_key=pubkey)
         )
 
-        await nostr_client.user_profile_temp_subscribe(pubkey)
+        nostr_client.request_profile(pubkey)
 
         return customer
     except (ValueError, AssertionError) as ex:
@@ -1124,6 +1297,59 @@ async def api_create_customer(
         ) from ex
 
 
+######################################## MARKET ########################################
+
+
+@nostrmarket_ext.get("/api/v1/market/{public_key}/catalog")
+async def api_get_public_catalog(public_key: str, request: Request) -> Response:
+    """
+    Public (unauthenticated) catalog of a merchant: stalls and active products.
+    Clients should revalidate with `If-None-Match`, unchanged catalogs get a 304.
+    """
+    try:
+        merchant = await get_merchant_by_pubkey(normalize_public_key(public_key))
+    except ValueError as ex:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=str(ex),
+        ) from ex
+    # inactive merchants do not take orders, their catalog is not served
+    if not merchant or not merchant.config.active:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail="Merchant cannot be found",
+        )
+
+    try:
+        etag, body, gzipped_body = await get_public_catalog(merchant)
+    except Exception as ex:
+        logger.warning(ex)
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail="Cannot get catalog",
+        ) from ex
+
+    # strong validators must differ between encodings
+    gzip_etag = f'{etag[:-1]}-gzip"'
+    headers = {
+        "Cache-Control": "public, no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers.update({"ETag": gzip_etag, "Content-Encoding": "gzip"})
+        body = gzipped_body
+    else:
+        headers["ETag"] = etag
+
+    if_none_match = request.headers.get("if-none-match", "")
+    client_etags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+    if "*" in client_etags or client_etags & {etag, gzip_etag}:
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 ######################################## OTHER ########################################
 
 
@@ -1132,6 +1358,17 @@ async def api_list_currencies_available():
     return list(currencies.keys())
 
 
+@nostrmarket_ext.get("/api/v1/stats", dependencies=[Depends(check_admin)])
+async def api_get_stats() -> dict:
+    """Instance wide, for the LNbits admins only."""
+    return {
+        "nostr_client": nostr_client.stats,
+        "incoming_dm_limits": incoming_dm_limits.stats,
+        "outbox_unsent": await count_unsent_outbox_events(),
+        "catalog_cache": catalog_cache.stats,
+    }
+
+
 @nostrmarket_ext.put("/api/v1/restart")
 async def restart_nostr_client(wallet: WalletTypeInfo = Depends(require_admin_key)):
     try: